@@ -10,6 +10,7 @@ import atexit
 from . import cluster
 from . import dashboard
 from . import database
+from . import metrics
 from . import storages
 
 _WAITLOCK = utils.CountLock()
@@ -30,6 +31,7 @@ async def main():
     await asyncio.gather(*[
         call(m, "init") for m in (
             scheduler,
+            metrics,
             storages,
             database,
             dashboard,
@@ -48,6 +50,7 @@ async def main():
         await asyncio.gather(*[
             call(m, "unload") for m in (
                 scheduler,
+                metrics,
                 cluster,
                 database,
                 dashboard,
@@ -1,7 +1,11 @@
+import asyncio
+from collections import OrderedDict
+from dataclasses import dataclass
 import functools
+import heapq
 import inspect
 import time
-from typing import Any, Iterator, MutableMapping, Optional, TypeVar
+from typing import Any, Callable, Iterator, MutableMapping, Optional, TypeVar
 
 from core import scheduler
 
@@ -14,35 +18,86 @@ class CacheValue[T]:
         self.value: T = value
         self.expires: Optional[float] = expires
         self.timestamp: float = time.monotonic()
+        # absolute monotonic time, None means never
+        self.expires_at: Optional[float] = None if expires is None else self.timestamp + expires
+
+    @property
+    def expired(self) -> bool:
+        return self.expires_at is not None and self.expires_at <= time.monotonic()
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    expirations: int = 0
+    evictions: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0
 
 class TimeoutCache(MutableMapping[K, T]):
-    def __init__(self, default_timeout: Optional[float] = None):
-        self.cache: dict[K, CacheValue] = {}
+    def __init__(self, default_timeout: Optional[float] = None, max_size: Optional[int] = None):
+        # insertion order, or least recently used first when max_size is set
+        self.cache: OrderedDict[K, CacheValue] = OrderedDict()
+        # (expires_at, value id, key), stale entries are skipped when popped
+        self._expiries: list[tuple[float, int, K]] = []
         self.default_timeout = default_timeout
+        self.max_size = max_size
+        self.stats = CacheStats()
         if self.default_timeout is None:
             return
         self.scheduler = scheduler.run_repeat_later(self._prune, self.default_timeout, self.default_timeout)
 
-    def _prune(self):
+    async def _prune(self):
+        # a coroutine, so it runs on the event loop with every other user of the cache
+        self._expire()
+
+    def _expire(self):
         current_time = time.monotonic()
-        keys_to_delete = [key for key, cache_value in self.cache.items() if cache_value.expires is not None and cache_value.expires + cache_value.timestamp < current_time]
-        for key in keys_to_delete:
-            del self.cache[key]
+        while self._expiries and self._expiries[0][0] <= current_time:
+            _, value_id, key = heapq.heappop(self._expiries)
+            cache_value = self.cache.get(key)
+            if cache_value is not None and id(cache_value) == value_id and cache_value.expired:
+                self.cache.pop(key, None)
+                self.stats.expirations += 1
+
+    def _compact(self):
+        # drop heap entries of overwritten or deleted values
+        self._expiries = [
+            (cache_value.expires_at, id(cache_value), key) for key, cache_value in self.cache.items() if cache_value.expires_at is not None
+        ]
+        heapq.heapify(self._expiries)
 
     def keys(self):
-        self._prune()
-        return self.cache.keys()
+        self._expire()
+        return list(self.cache.keys())
 
     def set(self, key: K, value: T, timeout: Optional[float] = None) -> None:
-        self.cache[key] = CacheValue(value, timeout or self.default_timeout)
+        self._expire()
+        cache_value = CacheValue(value, timeout or self.default_timeout)
+        self.cache[key] = cache_value
+        self.cache.move_to_end(key)
+        if cache_value.expires_at is not None:
+            heapq.heappush(self._expiries, (cache_value.expires_at, id(cache_value), key))
+            if len(self._expiries) > len(self.cache) * 2 + 64:
+                self._compact()
+        while self.max_size is not None and len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+            self.stats.evictions += 1
 
     def get(self, key: K, _def: Any = EMPTY) -> Any:
-        self._prune()
-        if key not in self.cache:
-            return _def
-        cache_value = self.cache[key]
-        if cache_value.expires is not None and cache_value.expires < time.monotonic():
+        cache_value = self.cache.get(key)
+        if cache_value is None or cache_value.expired:
+            if cache_value is not None:
+                self.cache.pop(key, None)
+                self.stats.expirations += 1
+            self.stats.misses += 1
             return _def
+        if self.max_size is not None:
+            self.cache.move_to_end(key)
+        self.stats.hits += 1
         return cache_value.value
 
     def delete(self, key: K) -> None:
@@ -50,15 +105,15 @@ class TimeoutCache(MutableMapping[K, T]):
             del self.cache[key]
 
     def __contains__(self, key: K) -> bool:
-        self._prune()
-        return key in self.cache
+        cache_value = self.cache.get(key)
+        return cache_value is not None and not cache_value.expired
 
     def __delitem__(self, key: K) -> None:
         self.delete(key)
 
     def __getitem__(self, key: K) -> T:
         value = self.get(key)
-        if value is None:
+        if value is EMPTY:
             raise KeyError(key)
         return value
 
@@ -66,11 +121,10 @@ class TimeoutCache(MutableMapping[K, T]):
         self.set(key, value)
 
     def __iter__(self) -> Iterator[K]:
-        self._prune()
-        return iter(self.cache)
+        return iter(self.keys())
 
     def __len__(self) -> int:
-        self._prune()
+        self._expire()
         return len(self.cache)
     
     def __del__(self):
@@ -80,15 +134,16 @@ class TimeoutCache(MutableMapping[K, T]):
 
 def cache(
     timeout: Optional[float] = None,
+    max_size: Optional[int] = None,
 ):
     def decorator(func):
-        cache = TimeoutCache(timeout)
+        cache = TimeoutCache(timeout, max_size)
 
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
             key = (args, tuple(sorted(kwargs.items())))
             value = cache.get(key)
-            if value is not None:
+            if value is not EMPTY:
                 return value
             value = func(*args, **kwargs)
             cache.set(key, value)
@@ -96,4 +151,74 @@ def cache(
 
         return wrapper
 
-    return decorator
\ No newline at end of file
+    return decorator
+
+@dataclass
+class CacheResult:
+    value: Any = None
+    error: Optional[BaseException] = None
+
+def async_cache(
+    timeout: Optional[float] = None,
+    error_timeout: Optional[float] = None,
+    max_size: Optional[int] = None,
+    key: Optional[Callable[..., Any]] = None,
+):
+    # timeout None caches forever, 0 only coalesces concurrent calls
+    # error_timeout caches raised exceptions for a while
+    def decorator(func):
+        cache: TimeoutCache[Any, CacheResult] = TimeoutCache(timeout or None, max_size)
+        inflight: dict[Any, asyncio.Task] = {}
+
+        def get_key(*args, **kwargs):
+            if key is not None:
+                return key(*args, **kwargs)
+            return (args, tuple(sorted(kwargs.items())))
+
+        async def call(cache_key, args, kwargs):
+            try:
+                value = await func(*args, **kwargs)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if error_timeout:
+                    cache.set(cache_key, CacheResult(error=e), error_timeout)
+                raise
+            else:
+                if timeout != 0:
+                    cache.set(cache_key, CacheResult(value), timeout)
+                return value
+            finally:
+                inflight.pop(cache_key, None)
+
+        def done(task: asyncio.Task):
+            # every caller may have been cancelled
+            if not task.cancelled():
+                task.exception()
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            cache_key = get_key(*args, **kwargs)
+            result = cache.get(cache_key)
+            if result is not EMPTY:
+                if result.error is not None:
+                    raise result.error
+                return result.value
+            task = inflight.get(cache_key)
+            if task is None:
+                task = asyncio.create_task(call(cache_key, args, kwargs))
+                task.add_done_callback(done)
+                inflight[cache_key] = task
+            # a cancelled caller must not cancel the shared call
+            return await asyncio.shield(task)
+
+        def invalidate(*args, **kwargs):
+            cache.delete(get_key(*args, **kwargs))
+
+        wrapper.cache = cache
+        wrapper.inflight = inflight
+        wrapper.invalidate = invalidate
+        wrapper.clear = cache.clear
+        return wrapper
+
+    return decorator
@@ -1,6 +1,6 @@
 import abc
 import asyncio
-from collections import defaultdict, deque
+from collections import OrderedDict, defaultdict, deque
 from dataclasses import asdict, dataclass, field
 import datetime
 import enum
@@ -8,16 +8,22 @@ import hashlib
 import hmac
 import io
 import json
+import os
 from pathlib import Path
+import random
+import sys
 import time
-from typing import Any, Callable, Coroutine, Optional
+from typing import Any, AsyncIterator, Callable, Coroutine, Iterator, Optional
+import aiofiles
 import aiohttp.client_exceptions
 import pyzstd as zstd
 import aiohttp
 from tqdm import tqdm
 
-from . import web, utils, logger, config, scheduler, units, storages, i18n, dashboard
+from . import web, utils, logger, config, scheduler, units, storages, i18n, dashboard, cache, http, metrics
+from .journal import Journal
 from .storages import File as SFile, MeasureFile
+from .sketches import HdrHistogram
 import socketio
 import urllib.parse as urlparse
 from . import database as db
@@ -34,6 +40,14 @@ class Token:
     token: str
     ttl: float
 
+    @property
+    def expires_at(self) -> float:
+        return self.last + self.ttl
+
+    @property
+    def valid(self) -> bool:
+        return self.expires_at > time.time()
+
 @dataclass
 class File:
     path: str
@@ -53,7 +67,260 @@ class FailedFile:
 
     def __hash__(self) -> int:
         return hash(self.file)
-    
+
+@dataclass
+class HotFile:
+    size: int
+    mtime: float
+
+class HotStorage:
+    def __init__(
+        self,
+        storage: storages.iStorage,
+        max_size: int,
+        promote_hits: int
+    ):
+        self.storage = storage
+        self.max_size = max_size
+        self.promote_hits = max(1, promote_hits)
+        # least recently used first
+        self.files: OrderedDict[str, HotFile] = OrderedDict()
+        self.used = 0
+        # recent hits of the hottest hashes, from the per-hash access statistics
+        self.hits: dict[str, int] = {}
+        # the hot tier only holds copies promoted from the cold storages, it never owns an object
+        self.promoting: dict[str, asyncio.Task] = {}
+        self.semaphore = asyncio.Semaphore(HOT_STORAGE_CONCURRENCY)
+        self.loaded = False
+
+    def init(self):
+        scheduler.run_later(self.load, 0)
+        scheduler.run_repeat_later(self.refresh_hits, HOT_STORAGE_REFRESH_INTERVAL, HOT_STORAGE_REFRESH_INTERVAL)
+
+    async def load(self):
+        files: set[storages.File] = set()
+        try:
+            with WrapperTQDM(tqdm(
+                total=256,
+                desc="List Hot Files",
+                unit="dir",
+                unit_scale=True
+            )) as pbar:
+                files = await self.storage.list_files(pbar)
+        except:
+            logger.traceback()
+        for file in sorted(files, key=lambda x: x.mtime):
+            if file.hash.endswith(HOT_STORAGE_TEMP_SUFFIX):
+                # a promotion interrupted by a crash
+                self.storage.get_local_path(SFile(file.hash, 0, 0, file.hash)).unlink(missing_ok=True)
+                continue
+            self._add(file.hash, file.size, file.mtime)
+        self.loaded = True
+        await self.evict()
+        logger.tinfo("cluster.info.hot_storage.loaded", path=self.storage.path, count=len(self.files), size=units.format_bytes(self.used), max_size=units.format_bytes(self.max_size))
+
+    async def refresh_hits(self):
+        # the hits of the last hours, promote what became hot since the last refresh
+        try:
+            self.hits = await asyncio.get_running_loop().run_in_executor(
+                None, db.query_hash_hits, db.get_hour() - HOT_STORAGE_HIT_HOURS + 1, self.promote_hits, HOT_STORAGE_CANDIDATES
+            )
+        except:
+            logger.traceback()
+            return
+        if not self.loaded:
+            return
+        for hash in self.hits:
+            if hash in self.files or hash in self.promoting:
+                continue
+            storage = next(clusters.storage_manager.select_storages(hash), None)
+            if storage is not None:
+                self._promote(hash, storage)
+
+    def get(self, hash: str) -> Optional['LocalStorageFile']:
+        if hash not in self.files:
+            return None
+        path = self.storage.get_local_path(SFile(hash, 0, 0, hash))
+        if not path.is_file():
+            self._remove(hash)
+            return None
+        self.files.move_to_end(hash)
+        info = self.files[hash]
+        return LocalStorageFile(
+            hash,
+            info.size,
+            info.mtime,
+            self.storage,
+            path
+        )
+
+    def hit(self, hash: str, storage: Optional[storages.iStorage], content: Optional[bytes] = None):
+        if not self.loaded or hash in self.files or hash in self.promoting:
+            return
+        # this request is recorded after the response, count it here
+        if self.hits.get(hash, 0) + db.get_hash_hits(hash) + 1 < self.promote_hits:
+            return
+        self._promote(hash, storage, content)
+
+    def _promote(self, hash: str, storage: Optional[storages.iStorage], content: Optional[bytes] = None):
+        task = asyncio.create_task(self.promote(hash, storage, content))
+        self.promoting[hash] = task
+        task.add_done_callback(lambda _: self.promoting.pop(hash, None))
+
+    async def promote(self, hash: str, storage: Optional[storages.iStorage], content: Optional[bytes] = None):
+        try:
+            async with self.semaphore:
+                if content is not None:
+                    chunks = iter_bytes(content)
+                elif storage is not None:
+                    chunks = storage.iter_file(SFile(hash, 0, 0, hash))
+                else:
+                    return
+                await self.put(hash, chunks)
+        except asyncio.CancelledError:
+            raise
+        except:
+            logger.ttraceback("cluster.error.hot_storage.promote", hash=hash, type=getattr(storage, "type", None), path=getattr(storage, "path", None))
+
+    async def put(self, hash: str, chunks: AsyncIterator[bytes]) -> bool:
+        if not self.loaded:
+            return False
+        if hash not in self.files:
+            size = await self._write(hash, chunks)
+            if size is None:
+                return False
+            self._add(hash, size, time.time())
+            logger.tdebug("cluster.debug.hot_storage.promote", hash=hash, size=units.format_bytes(size))
+        await self.evict()
+        return True
+
+    async def _write(self, hash: str, chunks: AsyncIterator[bytes]) -> Optional[int]:
+        # streamed into a temporary file next to the target, only a verified object is moved in place
+        path = self.storage.get_local_path(SFile(hash, 0, 0, hash))
+        temp = path.with_name(path.name + HOT_STORAGE_TEMP_SUFFIX)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        digest = utils.get_hash_obj(hash)
+        size = 0
+        try:
+            async with aiofiles.open(temp, "wb") as f:
+                async for chunk in chunks:
+                    size += len(chunk)
+                    if size > self.max_size:
+                        return None
+                    digest.update(chunk)
+                    await f.write(chunk)
+            if digest.hexdigest() != hash:
+                return None
+            os.replace(temp, path)
+            return size
+        finally:
+            temp.unlink(missing_ok=True)
+
+    async def evict(self):
+        for hash in list(self.files):
+            if self.used <= self.max_size:
+                break
+            self._remove(hash)
+            try:
+                await self.storage.delete_file(SFile(hash, 0, 0, hash))
+            except:
+                logger.traceback()
+
+    def _add(self, hash: str, size: int, mtime: float):
+        if hash in self.files:
+            self.used -= self.files[hash].size
+        self.files[hash] = HotFile(size, mtime)
+        self.files.move_to_end(hash)
+        self.used += size
+
+    def _remove(self, hash: str):
+        info = self.files.pop(hash, None)
+        if info is not None:
+            self.used -= info.size
+
+async def iter_bytes(content: bytes) -> AsyncIterator[bytes]:
+    yield content
+
+class CircuitState(enum.Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+@dataclass
+class StorageHealth:
+    latency: float = 0
+    errors: float = 0
+    inflight: int = 0
+    state: CircuitState = CircuitState.CLOSED
+    failures: int = 0
+    opened_at: float = 0
+    samples: deque[float] = field(default_factory=lambda: deque(maxlen=STORAGE_LATENCY_SAMPLES))
+    _hedge_delay: Optional[float] = None
+    # called when the circuit changes state
+    on_change: Optional[Callable[[], None]] = field(default=None, repr=False)
+
+    def _set_state(self, state: CircuitState):
+        if self.state == state:
+            return
+        self.state = state
+        if self.on_change is not None:
+            self.on_change()
+
+    def observe(self, latency: float):
+        self.latency += (latency - self.latency) * STORAGE_EWMA_ALPHA
+
+    def update(self, latency: float, error: bool = False):
+        self.observe(latency)
+        self.errors += (float(error) - self.errors) * STORAGE_EWMA_ALPHA
+        if error:
+            self.failure()
+        else:
+            self.samples.append(latency)
+            self._hedge_delay = None
+            self.success()
+
+    @property
+    def hedge_delay(self) -> float:
+        # p95 of the recent successful lookups
+        if len(self.samples) < STORAGE_HEDGE_MIN_SAMPLES:
+            return STORAGE_HEDGE_DEFAULT_DELAY
+        if self._hedge_delay is None:
+            samples = sorted(self.samples)
+            self._hedge_delay = min(max(samples[int(len(samples) * 0.95)], STORAGE_HEDGE_MIN_DELAY), STORAGE_HEDGE_MAX_DELAY)
+        return self._hedge_delay
+
+    def success(self):
+        self.failures = 0
+        self._set_state(CircuitState.CLOSED)
+
+    def failure(self):
+        self.failures += 1
+        if self.state == CircuitState.HALF_OPEN or self.failures >= STORAGE_BREAKER_THRESHOLD:
+            self.opened_at = time.monotonic()
+            self._set_state(CircuitState.OPEN)
+
+    @property
+    def allowed(self) -> bool:
+        if self.state == CircuitState.CLOSED:
+            return True
+        if self.state == CircuitState.OPEN:
+            return time.monotonic() - self.opened_at >= STORAGE_BREAKER_COOLDOWN
+        # half open lets a single trial request through
+        return self.inflight == 0
+
+    def acquire(self):
+        if self.state == CircuitState.OPEN and self.allowed:
+            self._set_state(CircuitState.HALF_OPEN)
+        self.inflight += 1
+
+    def release(self):
+        self.inflight -= 1
+
+    @property
+    def score(self) -> float:
+        # lower is better
+        return (self.latency + STORAGE_BASE_LATENCY) * (self.inflight + 1) * (1 + self.errors * STORAGE_ERROR_PENALTY)
+
 class StorageManager:
     def __init__(self, clusters: 'ClusterManager'):
         self.clusters = clusters
@@ -66,30 +333,38 @@ class StorageManager:
 
         self.check_type_file = config.const.check_type
         self.cache_filelist: defaultdict[storages.iStorage, defaultdict[str, storages.File]] = defaultdict(defaultdict) # type: ignore
+        self.hot_storage: Optional[HotStorage] = None
+        # hashes each storage is known to hold, storages that were never listed are not in here
+        self.storage_files: dict[storages.iStorage, set[str]] = {}
+        self.health: defaultdict[storages.iStorage, StorageHealth] = defaultdict(lambda: StorageHealth(on_change=self._update_selection))
+        # available storages with a closed circuit, each repeated by its weight, sampled directly by select_storages
+        self.selection: list[storages.iStorage] = []
+        # available storages with an open or half open circuit
+        self.tripped: list[storages.iStorage] = []
 
         self.retries = 3
 
     def init(self):
         scheduler.run_repeat_later(self._check_available, 1, 120)
+        if self.hot_storage is not None:
+            self.hot_storage.init()
 
     async def _check_available(self):
         with utils.Status(
             "storage.check_available",
         ):
-            for storage in self.storages:
-                err = None
-                res = False
-                try:
-                    res = await asyncio.wait_for(self.__check_available(storage), 10)
-                except asyncio.CancelledError:
-                    continue
-                except Exception as e:
-                    logger.ttraceback("storage.error.check_available", type=storage.type, path=storage.path, url=getattr(storage, "url", None))
-                    res = False
-                    err = e
+            results = await asyncio.gather(*(
+                self._check_storage_available(storage) for storage in self.storages
+            ))
+            for storage, (res, err) in zip(list(self.storages), results):
+                if res:
+                    self.health[storage].success()
+                else:
+                    self._storage_failure(storage)
                 if res:
                     if storage not in self.available_storages:
                         self.available_storages.append(storage)
+                        self._update_selection()
                         await self.logger.logger(
                             EventLoggerType.storage,
                             "up",
@@ -101,6 +376,7 @@ class StorageManager:
                         )
                 elif storage in self.available_storages:
                     self.available_storages.remove(storage)
+                    self._update_selection()
                     await self.logger.logger(
                         EventLoggerType.storage,
                         "down",
@@ -124,6 +400,15 @@ class StorageManager:
                     logger.twarning("storage.warning.storage.unavailable.for.clusters")
                     await clusters.disable()
         
+    async def _check_storage_available(self, storage: storages.iStorage) -> tuple[bool, Optional[Exception]]:
+        try:
+            return await asyncio.wait_for(self.__check_available(storage), STORAGE_CHECK_TIMEOUT), None
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.ttraceback("storage.error.check_available", type=storage.type, path=storage.path, url=getattr(storage, "url", None))
+            return False, e
+
     async def __check_available(self, storage: storages.iStorage):
         file = MeasureFile(
             0
@@ -144,11 +429,15 @@ class StorageManager:
     def add_storage(self, storage: storages.iStorage):
         self.storages.append(storage)
 
+    def set_hot_storage(self, storage: HotStorage):
+        self.hot_storage = storage
+
     async def available(self):
         await self.check_available.wait()
         return len(self.available_storages) > 0
     
     async def write_file(self, file: File, content: bytes):
+        # written through to the cold storages, a file is only synced once they hold it
         return all(await asyncio.gather(*(asyncio.create_task(self._write_file(
             file,
             io.BytesIO(content),
@@ -202,6 +491,9 @@ class StorageManager:
         result = await storage.list_files(pbar)
         for file in result:
             self.cache_filelist[storage][file.hash] = file
+        self.storage_files[storage] = {
+            sys.intern(file.hash) for file in result
+        }
         return result
 
     async def _get_missing_file_storage(self, function: Callable[..., Coroutine[Any, Any, bool]], missing_files: set[File], files: asyncio.Queue[File], storage: storages.iStorage, pbar: WrapperTQDM):
@@ -237,17 +529,230 @@ class StorageManager:
             0,
             hash
         )
+        if self.hot_storage is not None and not use_master:
+            file = self.hot_storage.get(hash)
+            if file is not None:
+                return file
         if await self.available() and not use_master:
-            storage = self.get_width_storage()
-            if isinstance(storage, storages.LocalStorage) and await storage.exists(storage_file):
-                file = LocalStorageFile(
+            file = await self._get_hedged_storage_file(self.select_storages(hash), storage_file)
+            if file is not None:
+                if self.hot_storage is not None and file.storage is not None:
+                    self.hot_storage.hit(hash, file.storage)
+                return file
+        session = http.get_session(config.const.base_url)
+        for cluster in self.clusters.clusters:
+            async with session.get(
+                f"/openbmclapi/download/{hash}",
+                params={
+                    "noopen": str(1)
+                },
+                headers={
+                    "User-Agent": USER_AGENT,
+                    "Authorization": f"Bearer {await cluster.get_token()}"
+                },
+                # the body is buffered whole, so give it longer than the connect
+                timeout=aiohttp.ClientTimeout(total=MASTER_FALLBACK_TIMEOUT, sock_connect=MASTER_FALLBACK_CONNECT_TIMEOUT)
+            ) as resp:
+                # check hash, if hash is not mismatch.
+                body = await resp.content.read()
+                utils.raise_service_error(body)
+                got_hash = utils.get_hash_hexdigest(hash, body)
+                file = MemoryStorageFile(
                     hash,
-                    await storage.get_size(storage_file),
-                    await storage.get_mtime(storage_file),
-                    storage,
-                    Path(str(storage.get_path(storage_file)))
+                    resp.content_length or -1,
+                    time.time(),
+                    body
+                )
+                if got_hash == hash:
+                    break
+                logger.terror("cluster.error.download_hash", got_hash=got_hash, hash=hash, content=body.decode("utf-8", "ignore")[:64])  
+        if got_hash == hash:
+            scheduler.run_later(
+                self.write_file,
+                1,
+                (
+                    file,
+                    body
                 )
-            elif isinstance(storage, storages.AlistStorage):
+            )
+            if self.hot_storage is not None:
+                self.hot_storage.hit(hash, None, body)
+        return file
+
+    def _storage_failure(self, storage: storages.iStorage, latency: Optional[float] = None):
+        health = self.health[storage]
+        state = health.state
+        if latency is None:
+            health.failure()
+        else:
+            health.update(latency, True)
+        if state != CircuitState.OPEN and health.state == CircuitState.OPEN:
+            logger.twarning("storage.warning.circuit_open", type=storage.type, path=storage.path, failures=health.failures, cooldown=STORAGE_BREAKER_COOLDOWN)
+
+    async def collect_garbage(self, hashes: set[str]) -> list[tuple[storages.iStorage, storages.File]]:
+        dry_run = config.const.gc_dry_run
+        deadline = time.time() - config.const.gc_grace_period
+        await self.available()
+        gc_storages = list(self.available_storages)
+        with utils.Status(
+            "cluster.status.gc",
+            total=0,
+            deleted=0
+        ) as status:
+            with WrapperTQDM(tqdm(
+                total=len(gc_storages) * 256,
+                desc="GC List Files",
+                unit="dir",
+                unit_scale=True
+            )) as pbar:
+                results = await asyncio.gather(*(storage.list_files(pbar) for storage in gc_storages), return_exceptions=True)
+            orphans: list[tuple[storages.iStorage, storages.File]] = []
+            for storage, files in zip(gc_storages, results):
+                if isinstance(files, BaseException):
+                    logger.terror("cluster.error.gc.list_files", type=storage.type, path=storage.path, error=files)
+                    continue
+                orphans.extend(
+                    (storage, file) for file in files
+                    if file.hash not in hashes and file.mtime < deadline
+                )
+            status.params["total"] = len(orphans)
+            logger.tinfo("cluster.info.gc.orphans", count=units.format_number(len(orphans)), size=units.format_bytes(sum(file.size for _, file in orphans)), dry_run=dry_run)
+            if dry_run:
+                for storage, file in orphans:
+                    logger.tdebug("cluster.debug.gc.orphan", type=storage.type, path=storage.path, hash=file.hash, size=units.format_bytes(file.size), mtime=units.format_datetime_from_timestamp(file.mtime))
+                return orphans
+            batch_size = config.const.gc_batch_size
+            for i in range(0, len(orphans), batch_size):
+                deleted = await asyncio.gather(*(self._delete_orphan(storage, file) for storage, file in orphans[i:i + batch_size]))
+                status.params["deleted"] += sum(deleted)
+                await asyncio.sleep(config.const.gc_batch_interval)
+            logger.tsuccess("cluster.success.gc", count=units.format_number(status.params["deleted"]), total=units.format_number(len(orphans)))
+        return orphans
+
+    async def _delete_orphan(self, storage: storages.iStorage, file: storages.File) -> bool:
+        try:
+            await storage.delete_file(file)
+        except asyncio.CancelledError:
+            raise
+        except:
+            logger.ttraceback("cluster.error.gc.delete_file", type=storage.type, path=storage.path, hash=file.hash)
+            return False
+        if storage in self.storage_files:
+            self.storage_files[storage].discard(file.hash)
+        return True
+
+    def _update_selection(self):
+        # only on availability and circuit changes, never per request
+        self.selection = [
+            storage for storage in self.available_storages if self.health[storage].state == CircuitState.CLOSED
+            for _ in range(max(0, storage.weight) + 1)
+        ]
+        self.tripped = [storage for storage in self.available_storages if self.health[storage].state != CircuitState.CLOSED]
+
+    def _may_hold(self, storage: storages.iStorage, hash: str) -> bool:
+        return storage not in self.storage_files or hash in self.storage_files[storage]
+
+    def _sample_storage(self, hash: str, exclude: Optional[storages.iStorage] = None) -> Optional[storages.iStorage]:
+        if not self.selection:
+            return None
+        for _ in range(STORAGE_SAMPLE_ATTEMPTS):
+            storage = random.choice(self.selection)
+            if storage is not exclude and self._may_hold(storage, hash):
+                return storage
+        return None
+
+    def select_storages(self, hash: str) -> Iterator[storages.iStorage]:
+        # lazy, callers usually stop after the first or second candidate
+        selected: set[storages.iStorage] = set()
+        # a circuit past its cooldown gets its trial request, there are none most of the time
+        for storage in self.tripped:
+            if self.health[storage].allowed and self._may_hold(storage, hash):
+                selected.add(storage)
+                yield storage
+        # power of two choices: sample by weight, only switch when the first one is clearly less healthy
+        first = self._sample_storage(hash)
+        second = self._sample_storage(hash, first)
+        if first is not None and second is not None and self.health[first].score > self.health[second].score * STORAGE_SCORE_TOLERANCE:
+            first, second = second, first
+        for storage in (first, second):
+            if storage is not None and storage not in selected:
+                selected.add(storage)
+                yield storage
+        # both missed, or the samples kept hitting storages without the hash
+        for storage in self.available_storages:
+            if storage not in selected and self.health[storage].allowed and self._may_hold(storage, hash):
+                yield storage
+
+    async def _get_hedged_storage_file(self, candidates: Iterator[storages.iStorage], storage_file: SFile) -> Optional['StorageFile']:
+        # start with the best candidate, fire the next one when the current one
+        # is slower than its own p95 or has missed, first hit wins
+        waiting = True
+        running: dict[asyncio.Task, storages.iStorage] = {}
+        started: dict[asyncio.Task, float] = {}
+        deadline = time.monotonic() + STORAGE_LOOKUP_TIMEOUT
+        hedge_at = 0.0
+        try:
+            while waiting or running:
+                now = time.monotonic()
+                if now >= deadline:
+                    break
+                if waiting and len(running) < STORAGE_HEDGE_CONCURRENT and (not running or now >= hedge_at):
+                    # the next candidate is only selected once it is needed
+                    storage = next(candidates, None)
+                    if storage is None:
+                        waiting = False
+                        if not running:
+                            break
+                    else:
+                        task = asyncio.create_task(self._get_storage_file(storage, storage_file))
+                        running[task] = storage
+                        started[task] = time.perf_counter()
+                        hedge_at = now + self.health[storage].hedge_delay
+                timeout = deadline - now
+                if waiting and len(running) < STORAGE_HEDGE_CONCURRENT:
+                    timeout = min(timeout, max(0, hedge_at - now))
+                done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    running.pop(task)
+                    file = task.result()
+                    if file is not None:
+                        return file
+                if done:
+                    # a miss should not wait for the hedge delay
+                    hedge_at = 0
+        finally:
+            now = time.perf_counter()
+            for task, storage in running.items():
+                if task.done():
+                    continue
+                latency = now - started[task]
+                # a hung backend never errors, past the lookup deadline or the longest hedge delay it counts as failed
+                if time.monotonic() >= deadline or latency >= STORAGE_HEDGE_MAX_DELAY:
+                    self._storage_failure(storage, latency)
+                else:
+                    # lost a hedge, still tells how slow it was at least
+                    self.health[storage].observe(latency)
+                task.cancel()
+        return None
+
+    async def _get_storage_file(self, storage: storages.iStorage, storage_file: SFile) -> Optional['StorageFile']:
+        hash = storage_file.hash
+        health = self.health[storage]
+        health.acquire()
+        start = time.perf_counter()
+        file = None
+        try:
+            capabilities = storage.capabilities
+            if storages.StorageCapability.PATH in capabilities:
+                if await storage.exists(storage_file):
+                    file = LocalStorageFile(
+                        hash,
+                        await storage.get_size(storage_file),
+                        await storage.get_mtime(storage_file),
+                        storage,
+                        storage.get_local_path(storage_file)
+                    )
+            elif storages.StorageCapability.URL in capabilities:
                 file = URLStorageFile(
                     hash,
                     await storage.get_size(storage_file),
@@ -255,92 +760,61 @@ class StorageManager:
                     storage,
                     await storage.get_url(storage_file)
                 )
-            elif isinstance(storage, storages.WebDavStorage):
-                result_file = await storage.get_file(
-                    storage_file
-                )
-                if result_file.data_size() == 0 and result_file.url:
-                    file = URLStorageFile(
+            elif storages.StorageCapability.STREAM in capabilities:
+                if await storage.exists(storage_file):
+                    file = StreamStorageFile(
                         hash,
                         await storage.get_size(storage_file),
                         await storage.get_mtime(storage_file),
                         storage,
-                        result_file.url
-                    )
-                if result_file.data_size() > 0:
-                    file = MemoryStorageFile(
-                        hash,
-                        await storage.get_size(storage_file),
-                        await storage.get_mtime(storage_file),
-                        result_file.data.getvalue()
+                        storage_file
                     )
+            elif await storage.exists(storage_file):
+                file = MemoryStorageFile(
+                    hash,
+                    await storage.get_size(storage_file),
+                    await storage.get_mtime(storage_file),
+                    (await storage.read_file(storage_file)).getvalue(),
+                    storage
+                )
+        except asyncio.CancelledError:
+            # reported by the hedged lookup that cancelled it
+            raise
+        except:
+            logger.ttraceback("storage.error.get_file", type=storage.type, path=storage.path, hash=hash)
+            self._storage_failure(storage, time.perf_counter() - start)
+            return None
+        finally:
+            health.release()
         if isinstance(file, URLStorageFile) and not file.url:
             file = None
-        if file is not None:
-            return file
-        async with aiohttp.ClientSession(
-                config.const.base_url,
-            ) as session:
-            for cluster in self.clusters.clusters:
-                async with session.get(
-                    f"/openbmclapi/download/{hash}",
-                    params={
-                        "noopen": str(1)
-                    },
-                    headers={
-                        "User-Agent": USER_AGENT,
-                        "Authorization": f"Bearer {await cluster.get_token()}"
-                    }
-                ) as resp:
-                    # check hash, if hash is not mismatch.
-                    body = await resp.content.read()
-                    utils.raise_service_error(body)
-                    got_hash = utils.get_hash_hexdigest(hash, body)
-                    file = MemoryStorageFile(
-                        hash,
-                        resp.content_length or -1,
-                        time.time(),
-                        body
-                    )
-                    if got_hash == hash:
-                        break
-                    logger.terror("cluster.error.download_hash", got_hash=got_hash, hash=hash, content=body.decode("utf-8", "ignore")[:64])  
-        if got_hash == hash:
-            scheduler.run_later(
-                self.write_file,
-                1,
-                (
-                    file,
-                    body
-                )
-            )
+        if file is None:
+            # do not pick it again for this hash until the next listing
+            if storage in self.storage_files:
+                self.storage_files[storage].discard(hash)
+            return None
+        health.update(time.perf_counter() - start)
         return file
 
-    def get_width_storage(self, c_storage: Optional[storages.iStorage] = None) -> storages.iStorage:
-        current_storage = self.available_storages[0]
-        if current_storage.current_weight < current_storage.weight:
-            current_storage.current_weight += 1
-            return current_storage
-        else:
-            current_storage.current_weight = 0
-            self.available_storages.remove(current_storage)
-            self.available_storages.append(current_storage)
-            if c_storage is not None:
-                return c_storage
-            return self.get_width_storage(c_storage=c_storage or current_storage)
-
     async def _write_file(self, file: File, content: io.BytesIO, storage: storages.iStorage):
         if await self._check_exists(file, storage) and await self._check_size(file, storage):
             return True
         retries = 0
+        health = self.health[storage]
         while retries < self.retries:
             try:
                 if await storage.write_file(convert_file_to_storage_file(file), content):
+                    health.success()
+                    if storage in self.storage_files:
+                        self.storage_files[storage].add(sys.intern(file.hash))
                     return True
             except asyncio.CancelledError:
                 break
             except:
-                retries += 1
+                pass
+            # writes are slow by nature, only let them trip the breaker
+            self._storage_failure(storage)
+            retries += 1
         return False
 
     @property
@@ -379,6 +853,7 @@ class DownloadStatistics:
         self.total_size = size
         self.total_files = total
         self.downloaded_files = 0
+        self.downloaded_size = 0
         self.failed_files = 0
         self.pbar = None
     
@@ -392,12 +867,14 @@ class DownloadStatistics:
         ))
         self.pbar.enter()
         self.downloaded_files = 0
+        self.downloaded_size = 0
         self.failed_files = 0
         return self
 
     def update(self, n: float):
         if self.pbar is None:
             return
+        self.downloaded_size += n
         self.pbar.update(n)
 
     def update_success(self):
@@ -431,49 +908,53 @@ class FileListManager:
         self.failed_hashs: asyncio.Queue[FailedFile] = asyncio.Queue()
         self.failed_hash_urls: defaultdict[str, FileDownloadInfo] = defaultdict(lambda: FileDownloadInfo(set()))
         self.task = None
+        self.gc_lock = asyncio.Lock()
 
     async def _get_filelist(self, cluster: 'Cluster'):
         try:
-            async with aiohttp.ClientSession(
-                config.const.base_url,
-                headers={
-                    "User-Agent": USER_AGENT,
-                    "Authorization": f"Bearer {await cluster.get_token()}"
-                }
-            ) as session:
-                async with session.get(
-                    f"/openbmclapi/files",
-                    params={
-                        "lastModified": str(int(self.cluster_last_modified[cluster]))
-                    }
-                ) as resp:
-                    body = await resp.read()
-                    if utils.is_service_error(body):
-                        utils.raise_service_error(body)
-                        return []
-                    resp.raise_for_status()
-                    if resp.status == 204:
-                        return []
-                    stream = utils.FileStream(zstd.decompress(body))
-                    filelist = [
-                        File(
-                            path=stream.read_string(),
-                            hash=stream.read_string(),
-                            size=stream.read_long(),
-                            mtime=stream.read_long()
-                        )
-                        for _ in range(stream.read_long())
-                    ]
-                    if filelist:
-                        mtime = max(filelist, key=lambda f: f.mtime).mtime
-                        self.cluster_last_modified[cluster] = max(mtime, self.cluster_last_modified[cluster])
-                    return filelist
+            return await self._fetch_filelist(cluster, self.cluster_last_modified[cluster])
         except asyncio.CancelledError:
             return []
         except:
             logger.ttraceback("cluster.error.fetch_filelist", cluster=cluster.id)
             return []
 
+    async def _fetch_filelist(self, cluster: 'Cluster', last_modified: int, full: bool = False) -> list[File]:
+        session = http.get_session(config.const.base_url)
+        async with session.get(
+            f"/openbmclapi/files",
+            params={
+                "lastModified": str(int(last_modified))
+            },
+            headers={
+                "Authorization": f"Bearer {await cluster.get_token()}"
+            }
+        ) as resp:
+            body = await resp.read()
+            if utils.is_service_error(body):
+                utils.raise_service_error(body)
+                if full:
+                    raise RuntimeError(f"cluster {cluster.id} returned a service error")
+                return []
+            resp.raise_for_status()
+            if resp.status == 204:
+                return []
+            stream = utils.FileStream(zstd.decompress(body))
+            filelist = [
+                File(
+                    path=stream.read_string(),
+                    hash=stream.read_string(),
+                    size=stream.read_long(),
+                    mtime=stream.read_long()
+                )
+                for _ in range(stream.read_long())
+            ]
+            # a full catalog must not move the cursor of sync past files it has not downloaded
+            if filelist and not full:
+                mtime = max(filelist, key=lambda f: f.mtime).mtime
+                self.cluster_last_modified[cluster] = max(mtime, self.cluster_last_modified[cluster])
+            return filelist
+
     async def fetch_filelist(self) -> set[File]:
         with utils.Status(
             "cluster.fetch_filelist",
@@ -520,6 +1001,35 @@ class FileListManager:
         scheduler.cancel(self.task)
         self.task = scheduler.run_later(self.sync, config.const.sync_interval)
 
+    async def gc(self):
+        if self.gc_lock.locked():
+            return
+        async with self.gc_lock:
+            # sync only asks for changes, gc needs the whole catalog of every cluster
+            filelists = await asyncio.gather(*(
+                self._get_full_filelist(cluster) for cluster in self.clusters.clusters
+            ))
+            # the files of a cluster missing from the catalog would all look orphaned
+            if not filelists or any(filelist is None for filelist in filelists):
+                return
+            await self.clusters.storage_manager.collect_garbage({
+                file.hash for filelist in filelists for file in filelist # type: ignore
+            })
+
+    async def _get_full_filelist(self, cluster: 'Cluster') -> Optional[list[File]]:
+        try:
+            filelist = await self._fetch_filelist(cluster, 0, full=True)
+        except asyncio.CancelledError:
+            raise
+        except:
+            logger.ttraceback("cluster.error.gc.fetch_filelist", cluster=cluster.id)
+            return None
+        if not filelist:
+            # never treat everything as orphaned because of an empty answer
+            logger.twarning("cluster.warning.gc.empty_filelist", cluster=cluster.id)
+            return None
+        return filelist
+
     async def download(self, filelist: set[File]):
         total = len(filelist)
         size = sum(f.size for f in filelist)
@@ -534,6 +1044,7 @@ class FileListManager:
             total=total,
             size=size
         ) as pbar:
+            self.download_statistics = pbar
             for _ in range(0, max(1, config.const.threads)):
                 if _ % 32 == 0:
                     session = aiohttp.ClientSession(
@@ -649,43 +1160,42 @@ class FileListManager:
                 "/openbmclapi/report", json={
                     "urls": [url.url for url in urls],
                     "error": "Network error",
-                }
+                },
+                headers=headers
             ) as resp:
                 utils.raise_service_error(await resp.read())
-        async with aiohttp.ClientSession(
-            config.const.base_url,
-            headers={
-                "User-Agent": USER_AGENT,
-                "Authorization": f"Bearer {await clusters.clusters[0].get_token()}"
-            }
-        ) as session:
-            await asyncio.gather(*[_r(urls) for urls in urls])
+        session = http.get_session(config.const.base_url)
+        headers = {
+            "Authorization": f"Bearer {await clusters.clusters[0].get_token()}"
+        }
+        await asyncio.gather(*[_r(urls) for urls in urls])
 
     async def _get_configuration(self, cluster: 'Cluster'):
         try:
-            async with aiohttp.ClientSession(
-                config.const.base_url,
-                headers={
-                    "User-Agent": USER_AGENT,
-                    "Authorization": f"Bearer {await cluster.get_token()}"
-                }
-            ) as session:
-                async with session.get(
-                    f"/openbmclapi/configuration"
-                ) as resp:
-                    body = await resp.json()
-                    if utils.raise_service_error(body):
-                        return {}
-                    resp.raise_for_status()
-                    return {
-                        k: OpenBMCLAPIConfiguration(**v) for k, v in (body).items()
-                    }
+            return await self._fetch_configuration(cluster)
         except asyncio.CancelledError: 
             return {}
         except:
             logger.ttraceback("cluster.error.configuration", cluster=cluster.id)
             return {}
 
+    @cache.async_cache(timeout=60, error_timeout=5)
+    async def _fetch_configuration(self, cluster: 'Cluster') -> dict[str, 'OpenBMCLAPIConfiguration']:
+        session = http.get_session(config.const.base_url)
+        async with session.get(
+            f"/openbmclapi/configuration",
+            headers={
+                "Authorization": f"Bearer {await cluster.get_token()}"
+            }
+        ) as resp:
+            body = await resp.json()
+            if utils.raise_service_error(body):
+                return {}
+            resp.raise_for_status()
+            return {
+                k: OpenBMCLAPIConfiguration(**v) for k, v in (body).items()
+            }
+
 @dataclass
 class EventLoggerSchema:
     type: "EventLoggerType"
@@ -850,6 +1360,9 @@ class ClusterManager:
         # check files
         await self.file_manager.sync()
 
+        if config.const.gc_enable:
+            scheduler.run_repeat_later(self.file_manager.gc, config.const.gc_interval, config.const.gc_interval)
+
         # init measure
         await init_measure()
 
@@ -947,6 +1460,7 @@ class Cluster:
         self.secret = secret
         self.token: Optional[Token] = None
         self.token_scheduler: Optional[int] = None
+        self.token_task: Optional[asyncio.Task] = None
         self.socket_io = ClusterSocketIO(self)
         self.want_enable: bool = False
         self.enabled = False
@@ -957,55 +1471,81 @@ class Cluster:
         self.delay_enable_task: Optional[int] = None
         self.counter: defaultdict[storages.iStorage, ClusterCounter] = defaultdict(ClusterCounter)
         self.no_storage_counter = ClusterCounter()
+        # hits not acknowledged by keep-alive yet, replayed into the counters after a crash
+        self.journal = Journal(f"keepalive-{id}")
+        # hits since the last journal write, by storage unique id
+        self.journal_counter: defaultdict[Optional[str], ClusterCounter] = defaultdict(ClusterCounter)
+        self.journal.collector(self._collect_journal)
 
     def __repr__(self):
         return f"Cluster(id={self.id})"
 
     async def get_token(self):
-        if self.token is None or time.time() - self.token.last > self.token.ttl - 300:
-            await self._fetch_token()
+        # a valid token is returned at once, refreshing happens in the background
+        if self.token is None or not self.token.valid:
+            await asyncio.shield(self.refresh_token())
 
-        if self.token is None or self.token.last + self.token.ttl < time.time():
+        if self.token is None or not self.token.valid:
             raise RuntimeError('token expired')
         
         return self.token.token
 
+    def refresh_token(self) -> asyncio.Task:
+        # concurrent callers share one challenge and token round trip
+        if self.token_task is None or self.token_task.done():
+            self.token_task = asyncio.create_task(self._fetch_token())
+            self.token_task.add_done_callback(self._refresh_token_done)
+        return self.token_task
+
+    def _refresh_token_done(self, task: asyncio.Task):
+        if task.cancelled():
+            return
+        if task.exception() is None:
+            return
+        logger.terror("cluster.error.fetch_token", cluster=self.id, err=task.exception())
+        # keep retrying while the current token still works
+        if self.token is not None and self.token.valid:
+            self._schedule_refresh_token(min(TOKEN_RETRY_DELAY, self.token.expires_at - time.time()))
+
+    def _schedule_refresh_token(self, delay: float):
+        if self.token_scheduler is not None:
+            scheduler.cancel(self.token_scheduler)
+        self.token_scheduler = scheduler.run_later(self._background_refresh_token, delay=max(delay, 0))
+
+    async def _background_refresh_token(self):
+        self.refresh_token()
+
     async def _fetch_token(self):
-        async with aiohttp.ClientSession(
-            config.const.base_url,
-            headers={
-                "User-Agent": USER_AGENT
+        session = http.get_session(config.const.base_url)
+        logger.tdebug("cluster.debug.fetch_token", cluster=self.id)
+        async with session.get(
+            f"/openbmclapi-agent/challenge",
+            params={
+                "clusterId": self.id
             }
-        ) as session:
-            logger.tdebug("cluster.debug.fetch_token", cluster=self.id)
-            async with session.get(
-                f"/openbmclapi-agent/challenge",
-                params={
-                    "clusterId": self.id
-                }
-            ) as resp:
-                challenge = (await resp.json())['challenge']
-                signature = hmac.new(
-                    self.secret.encode("utf-8"), digestmod=hashlib.sha256
-                )
-                signature.update(challenge.encode())
-                signature = signature.hexdigest()
-            async with session.post(
-                "/openbmclapi-agent/token",
-                json = {
-                    "clusterId": self.id,
-                    "challenge": challenge,
-                    "signature": signature,
-                }
-            ) as resp:
-                resp.raise_for_status()
-                json = await resp.json()
-                self.token = Token(time.time(), json['token'], json['ttl'] / 1000.0)
-                self.fetch_time = time.monotonic()
-                logger.tdebug("cluster.debug.fetch_token_success", cluster=self.id, ttl=units.format_count_datetime(json['ttl'] / 1000.0))
-                if self.token_scheduler is not None:
-                    scheduler.cancel(self.token_scheduler)
-                self.token_scheduler = scheduler.run_later(self.get_token, delay=self.token.ttl - 300)
+        ) as resp:
+            challenge = (await resp.json())['challenge']
+            signature = hmac.new(
+                self.secret.encode("utf-8"), digestmod=hashlib.sha256
+            )
+            signature.update(challenge.encode())
+            signature = signature.hexdigest()
+        async with session.post(
+            "/openbmclapi-agent/token",
+            json = {
+                "clusterId": self.id,
+                "challenge": challenge,
+                "signature": signature,
+            }
+        ) as resp:
+            resp.raise_for_status()
+            json = await resp.json()
+            self.token = Token(time.time(), json['token'], json['ttl'] / 1000.0)
+            self.fetch_time = time.monotonic()
+            logger.tdebug("cluster.debug.fetch_token_success", cluster=self.id, ttl=units.format_count_datetime(json['ttl'] / 1000.0))
+            # refresh ahead of expiry, jittered so clusters do not refresh together
+            margin = min(TOKEN_REFRESH_MARGIN, self.token.ttl / 2)
+            self._schedule_refresh_token(self.token.ttl - margin - random.uniform(0, min(TOKEN_REFRESH_JITTER, margin)))
 
     async def request_cert(self):
         ssl_dir = Path(config.const.ssl_dir)
@@ -1070,18 +1610,49 @@ class Cluster:
         logger.tsuccess("cluster.success.enabled", cluster=self.id)
 
     def hit(self, storage: Optional[storages.iStorage], bytes: int):
+        unique_id = storage.unique_id if storage is not None else None
+        if self.journal.enabled:
+            self.journal_counter[unique_id].hits += 1
+            self.journal_counter[unique_id].bytes += bytes
+        self._hit(storage, 1, bytes)
+        labels = (self.id, unique_id or "")
+        metrics.SERVED_HITS.inc(1, labels)
+        metrics.SERVED_BYTES.inc(bytes, labels)
+
+    def _hit(self, storage: Optional[storages.iStorage], hits: int, bytes: int):
         if storage is None:
-            self.no_storage_counter.hits += 1
+            self.no_storage_counter.hits += hits
             self.no_storage_counter.bytes += bytes
             return
-        self.counter[storage].hits += 1
+        self.counter[storage].hits += hits
         self.counter[storage].bytes += bytes
 
+    def _collect_journal(self):
+        counter, self.journal_counter = self.journal_counter, defaultdict(ClusterCounter)
+        for unique_id, value in counter.items():
+            yield unique_id, value.hits, value.bytes
+
+    def replay_counter(self, unique_storages: dict[str, storages.iStorage]):
+        # storages removed from the config since are still reported, as no storage
+        records = self.journal.open()
+        total_counter = ClusterCounter()
+        for record in records:
+            try:
+                unique_id, hits, bytes = record
+                self._hit(unique_storages.get(unique_id) if unique_id is not None else None, hits, bytes)
+                total_counter.hits += hits
+                total_counter.bytes += bytes
+            except:
+                logger.traceback()
+        if records:
+            logger.tinfo("cluster.info.replay", cluster=self.id, hits=units.format_number(total_counter.hits), bytes=units.format_bytes(total_counter.bytes))
+
     async def keepalive(self):
         commit_no_storage_counter = self.no_storage_counter.clone()
         commit_counter = {
             storage: counter.clone() for storage, counter in self.counter.items()
         }
+        segment = self.journal.seal()
         total_counter = ClusterCounter()
         for counter in (
             commit_no_storage_counter,
@@ -1115,6 +1686,7 @@ class Cluster:
         self.no_storage_counter -= commit_no_storage_counter
         for storage, counter in commit_counter.items():
             self.counter[storage] -= counter
+        await self.journal.truncate(segment)
         timestamp = result.ack / 1000.0 if isinstance(result.ack, int) else utils.parse_isotime_to_timestamp(result.ack)
         ping = (time.time() - timestamp) // 0.0002
         logger.tsuccess("cluster.success.keepalive", cluster=self.id, hits=units.format_number(total_counter.hits), bytes=units.format_bytes(total_counter.bytes), ping=ping)
@@ -1312,6 +1884,12 @@ class URLStorageFile(StorageFile):
         super().__init__(hash=hash, size=size, mtime=mtime, storage=storage)
         self.url = url
 
+class StreamStorageFile(StorageFile):
+    type: str = "stream"
+    def __init__(self, hash: str, size: int, mtime: float, storage: storages.iStorage, file: SFile) -> None:
+        super().__init__(hash=hash, size=size, mtime=mtime, storage=storage)
+        self.file = file
+
 class MemoryStorageFile(StorageFile):
     type: str = "memory"
     def __init__(self, hash: str, size: int, mtime: float, data: bytes, storage: Optional[storages.iStorage] = None) -> None:
@@ -1328,6 +1906,61 @@ class BandwidthList:
     cluster_id: str
     bytes: deque[int] = field(default_factory=deque)
 
+class DownloadStage(enum.Enum):
+    SIGN = "sign"
+    CLUSTER = "cluster"
+    GET_FILE = "get_file"
+    PREPARE = "prepare"
+    STREAM = "stream"
+    TOTAL = "total"
+
+@dataclass
+class LatencyPercentiles:
+    # milliseconds
+    count: int
+    p50: float
+    p90: float
+    p99: float
+    p999: float
+    max: float
+
+class DownloadLatency:
+    def __init__(self):
+        # microseconds, percentiles cover the current and the previous window
+        self.current: defaultdict[DownloadStage, HdrHistogram] = defaultdict(HdrHistogram)
+        self.previous: defaultdict[DownloadStage, HdrHistogram] = defaultdict(HdrHistogram)
+
+    def init(self):
+        # a coroutine keeps the rotation on the event loop, next to mark and get
+        scheduler.run_repeat_later(self.rotate, DOWNLOAD_LATENCY_WINDOW, DOWNLOAD_LATENCY_WINDOW)
+
+    def mark(self, stage: DownloadStage, since: int) -> int:
+        # records the time since `since` and returns now, for the next stage to start from
+        now = time.perf_counter_ns()
+        self.current[stage].add((now - since) // 1000)
+        return now
+
+    async def rotate(self):
+        self.previous, self.current = self.current, defaultdict(HdrHistogram)
+
+    def get(self) -> dict[str, LatencyPercentiles]:
+        result: dict[str, LatencyPercentiles] = {}
+        for stage in DownloadStage:
+            histogram = HdrHistogram()
+            for histograms in (self.previous, self.current):
+                if stage in histograms:
+                    histogram.merge(histograms[stage])
+            p50, p90, p99, p999 = histogram.percentiles(50, 90, 99, 99.9)
+            result[stage.value] = LatencyPercentiles(
+                histogram.total,
+                p50 / 1000,
+                p90 / 1000,
+                p99 / 1000,
+                p999 / 1000,
+                histogram.max / 1000
+            )
+        return result
+
 class BandwidthCounter:
     def __init__(
         self
@@ -1379,10 +2012,39 @@ CHECK_FILE = File(
 MEASURES_HASH: dict[int, str] = {
 }
 MEASURE_BUFFER: bytes = b'\x00'
+HOT_STORAGE_MAX_SIZE = 1024 * 1024 * 1024 * 10
+HOT_STORAGE_PROMOTE_HITS = 3
+HOT_STORAGE_HIT_HOURS = 2
+HOT_STORAGE_CANDIDATES = 1024
+HOT_STORAGE_REFRESH_INTERVAL = 60
+HOT_STORAGE_CONCURRENCY = 8
+HOT_STORAGE_TEMP_SUFFIX = ".tmp"
+TOKEN_REFRESH_MARGIN = 300
+TOKEN_REFRESH_JITTER = 60
+TOKEN_RETRY_DELAY = 30
+STORAGE_EWMA_ALPHA = 0.2
+STORAGE_BASE_LATENCY = 0.005
+STORAGE_ERROR_PENALTY = 10
+STORAGE_SCORE_TOLERANCE = 2
+STORAGE_SAMPLE_ATTEMPTS = 4
+STORAGE_BREAKER_THRESHOLD = 3
+STORAGE_BREAKER_COOLDOWN = 5
+STORAGE_CHECK_TIMEOUT = 10
+STORAGE_LOOKUP_TIMEOUT = 5
+MASTER_FALLBACK_TIMEOUT = 60
+MASTER_FALLBACK_CONNECT_TIMEOUT = 5
+STORAGE_LATENCY_SAMPLES = 200
+STORAGE_HEDGE_MIN_SAMPLES = 20
+STORAGE_HEDGE_DEFAULT_DELAY = 0.5
+STORAGE_HEDGE_MIN_DELAY = 0.01
+STORAGE_HEDGE_MAX_DELAY = 2
+STORAGE_HEDGE_CONCURRENT = 2
 DEFAULT_MEASURES = [
     10
 ]
+DOWNLOAD_LATENCY_WINDOW = 300
 BANDWIDTH_COUNTER = BandwidthCounter()
+DOWNLOAD_LATENCY = DownloadLatency()
 routes = web.routes
 aweb = web.web
 clusters = ClusterManager()
@@ -1430,8 +2092,67 @@ async def init_measure_files():
     results = await asyncio.gather(*[asyncio.create_task(init_measure_file(storage, size, MEASURES_HASH[size])) for storage in clusters.storage_manager.available_storages for size in MEASURES_HASH])
     logger.debug(results)
 
+@metrics.SYNC_FILES.collector
+def _():
+    statistics = clusters.file_manager.download_statistics
+    yield ("total",), statistics.total_files
+    yield ("downloaded",), statistics.downloaded_files
+    yield ("failed",), statistics.failed_files
+
+@metrics.SYNC_BYTES.collector
+def _():
+    statistics = clusters.file_manager.download_statistics
+    yield ("total",), statistics.total_size
+    yield ("downloaded",), statistics.downloaded_size
+
+@metrics.QUEUE_DEPTH.collector
+def _():
+    statistics = clusters.file_manager.download_statistics
+    yield ("sync_pending",), max(0, statistics.total_files - statistics.downloaded_files)
+    yield ("sync_retry",), clusters.file_manager.failed_hashs.qsize()
+    if clusters.storage_manager.hot_storage is not None:
+        yield ("hot_storage_promote",), len(clusters.storage_manager.hot_storage.promoting)
+
+@metrics.CLUSTER_ENABLED.collector
+def _():
+    for cluster in clusters.clusters:
+        yield (cluster.id,), int(cluster.enabled)
+
+@metrics.STORAGE_UP.collector
+def _():
+    for storage in list(clusters.storage_manager.storages):
+        yield (storage.unique_id, storage.type, storage.name), int(storage in clusters.storage_manager.available_storages)
+
+@metrics.STORAGE_LATENCY.collector
+def _():
+    for storage, health in list(clusters.storage_manager.health.items()):
+        yield (storage.unique_id,), health.latency
+
+@metrics.STORAGE_ERRORS.collector
+def _():
+    for storage, health in list(clusters.storage_manager.health.items()):
+        yield (storage.unique_id,), health.errors
+
+@metrics.STORAGE_INFLIGHT.collector
+def _():
+    for storage, health in list(clusters.storage_manager.health.items()):
+        yield (storage.unique_id,), health.inflight
+
+@metrics.STORAGE_CIRCUIT_OPEN.collector
+def _():
+    for storage, health in list(clusters.storage_manager.health.items()):
+        yield (storage.unique_id,), int(health.state == CircuitState.OPEN)
+
+@metrics.HOT_STORAGE_BYTES.collector
+def _():
+    hot_storage = clusters.storage_manager.hot_storage
+    if hot_storage is not None:
+        yield ("used",), hot_storage.used
+        yield ("max",), hot_storage.max_size
+
 async def init():
     logger.tinfo("cluster.info.init", openbmclapi_version=API_VERSION, version=config.VERSION)
+    DOWNLOAD_LATENCY.init()
     # read clusters from config
     config_clusters = config.Config.get("clusters")
     for ccluster in config_clusters:
@@ -1452,12 +2173,30 @@ async def init():
         storage = storages.init_storage(cstorage)
         if not storage:
             continue
+        if cstorage.get("tier") == "hot":
+            if storages.StorageCapability.PATH in storage.capabilities:
+                clusters.storage_manager.set_hot_storage(HotStorage(
+                    storage,
+                    units.parse_bytes(cstorage.get("max_size", HOT_STORAGE_MAX_SIZE)),
+                    cstorage.get("promote_hits", HOT_STORAGE_PROMOTE_HITS)
+                ))
+                logger.tinfo("cluster.info.hot_storage.enable", path=storage.path)
+                continue
+            logger.twarning("cluster.warning.hot_storage.unsupported", type=storage.type, path=storage.path)
         clusters.storage_manager.add_storage(storage)
     if config.const.measure_storage:
         logger.tinfo("cluster.info.enable.measure_storage")
 
 
     db.init_storages_key(*clusters.storage_manager.storages)
+    if clusters.storage_manager.hot_storage is not None:
+        db.init_storages_key(clusters.storage_manager.hot_storage.storage)
+
+    unique_storages = {storage.unique_id: storage for storage in clusters.storage_manager.storages}
+    if clusters.storage_manager.hot_storage is not None:
+        unique_storages[clusters.storage_manager.hot_storage.storage.unique_id] = clusters.storage_manager.hot_storage.storage
+    for cluster in clusters.clusters:
+        cluster.replay_counter(unique_storages)
 
     scheduler.run_later(
         clusters.start, 0
@@ -1465,9 +2204,11 @@ async def init():
 
 async def unload():
     for storage in clusters.storage_manager.storages:
-        if isinstance(storage, storages.AlistStorage):
-            await storage.close()
+        await storage.close()
     await clusters.stop()
+    for cluster in clusters.clusters:
+        await cluster.journal.close()
+    await http.close()
 
 def check_sign(hash: str, s: str, e: str):
     if not config.const.check_sign:
@@ -1499,29 +2240,15 @@ async def _(request: aweb.Request):
             init_measure_block(size)
             await init_measure_files()
             storage = clusters.storage_manager.storages[0]
-            if isinstance(storage, storages.AlistStorage):
+            if storages.StorageCapability.PATH in storage.capabilities:
+                return aweb.FileResponse(
+                    storage.get_local_path(file)
+                )
+            elif storages.StorageCapability.URL in storage.capabilities:
                 url = await storage.get_url(file)
                 logger.debug("Requested measure url:", url)
                 if url:
                     return aweb.HTTPFound(url)
-            elif isinstance(storage, storages.LocalStorage):
-                return aweb.FileResponse(
-                    Path(str(storage.get_path(file)))
-                )
-            elif isinstance(storage, storages.WebDavStorage):
-                file = await storage.get_file(file)
-                if file.url:
-                    logger.debug("Requested measure url:", file.url)
-                    return aweb.HTTPFound(file.url)
-                elif file.size >= 0:
-                    return aweb.Response(
-                        status=200,
-                        headers={
-                            "Content-Length": str(file.size),
-                            "Content-Type": "application/octet-stream",
-                        },
-                        body=file.data
-                    )
 
         if config.const.measure_storage:
             logger.twarning("cluster.warning.measure_storage")
@@ -1547,9 +2274,28 @@ async def _(request: aweb.Request):
         logger.traceback()
         return aweb.Response(status=400)
 
-@utils.retry(3, 1)
+def get_range(http_range: slice, size: int) -> tuple[int, int]:
+    # aiohttp gives a python slice, stop is exclusive and start is negative for suffix ranges
+    start, stop = http_range.start, http_range.stop
+    if start is None:
+        start = 0
+    elif start < 0:
+        start = max(0, size + start)
+    if stop is None or stop > size:
+        stop = size
+    return start, max(start, stop) - 1
+
 async def get_file(hash: str):
-    return await asyncio.wait_for(asyncio.create_task(clusters.storage_manager.get_file(hash)), 5)
+    # storage lookups are bounded and hedged inside the storage manager
+    return await clusters.storage_manager.get_file(hash)
+
+def record_download(cluster: Cluster, file: 'StorageFile', hash: str, size: int):
+    storage_name = file.storage.unique_id if file.storage is not None else None
+    db.add_file(cluster.id, storage_name, size)
+    hot_storage = clusters.storage_manager.hot_storage
+    cached = hot_storage is not None and file.storage is hot_storage.storage
+    db.add_hash(hash, size, cached)
+    metrics.HOT_STORAGE_REQUESTS.inc(1, ("hit" if cached else "miss",))
 
 @routes.get("/download/{hash}")
 async def _(request: aweb.Request):
@@ -1560,7 +2306,10 @@ async def _(request: aweb.Request):
         user_agent = request.headers.get("User-Agent", "")
         s = query.get("s", "")
         e = query.get("e", "")
-        if not check_sign(request.match_info["hash"], s, e):
+        started = time.perf_counter_ns()
+        signed = check_sign(request.match_info["hash"], s, e)
+        timestamp = DOWNLOAD_LATENCY.mark(DownloadStage.SIGN, started)
+        if not signed:
             db.add_response(
                 address,
                 db.StatusType.FORBIDDEN,
@@ -1571,6 +2320,7 @@ async def _(request: aweb.Request):
 
         # get cluster instance
         cluster = clusters.get_cluster_by_id(cluster_id)
+        timestamp = DOWNLOAD_LATENCY.mark(DownloadStage.CLUSTER, timestamp)
         if cluster is None:
             db.add_response(
                 address,
@@ -1585,6 +2335,7 @@ async def _(request: aweb.Request):
         except:
             logger.ttraceback("cluster.error.get_file", hash=hash)
             file = await asyncio.create_task(clusters.storage_manager.get_file(hash, True))
+        timestamp = DOWNLOAD_LATENCY.mark(DownloadStage.GET_FILE, timestamp)
         if file is None:
             db.add_response(
                 address,
@@ -1594,10 +2345,18 @@ async def _(request: aweb.Request):
             return aweb.Response(status=404)
         
         resp = aweb.Response(status=500)
-        
-        start = request.http_range.start or 0
-        end = request.http_range.stop or file.size - 1
+
+        partial = request.http_range.start is not None or request.http_range.stop is not None
+        file_size = len(file.data) if isinstance(file, MemoryStorageFile) else file.size
+        start, end = get_range(request.http_range, file_size)
         size = end - start + 1
+        if partial and isinstance(file, (MemoryStorageFile, StreamStorageFile)) and start >= file_size:
+            db.add_response(
+                address,
+                db.StatusType.ERROR,
+                user_agent
+            )
+            return aweb.Response(status=416, headers={"Content-Range": f"bytes */{file_size}"})
 
         cluster.hit(file.storage, size)
         BANDWIDTH_COUNTER.hit(cluster.id, size)
@@ -1617,20 +2376,72 @@ async def _(request: aweb.Request):
                 headers=headers
             )
         elif isinstance(file, MemoryStorageFile):
+            if partial:
+                headers["Content-Range"] = f"bytes {start}-{end}/{file_size}"
             resp = aweb.Response(
+                status=206 if partial else 200,
                 body=file.data[start:end + 1],
                 headers={
-                    "Content-Range": f"bytes={start}-{end}/{file.size}",
-                    "Content-Length": str(size),
                     "Content-Type": "application/octet-stream",
                     **headers
                 }
             )
+        elif isinstance(file, StreamStorageFile) and file.storage is not None:
+            # proxied body, only the requested range is read from the storage
+            if partial:
+                headers["Content-Range"] = f"bytes {start}-{end}/{file_size}"
+            resp = aweb.StreamResponse(
+                status=206 if partial else 200,
+                headers={
+                    "Content-Type": "application/octet-stream",
+                    "Accept-Ranges": "bytes",
+                    **headers
+                }
+            )
+            resp.content_length = size
+            await resp.prepare(request)
+            timestamp = DOWNLOAD_LATENCY.mark(DownloadStage.PREPARE, timestamp)
+            try:
+                async for chunk in file.storage.read_range(file.file, start, end):
+                    await resp.write(chunk)
+                await resp.write_eof()
+                timestamp = DOWNLOAD_LATENCY.mark(DownloadStage.STREAM, timestamp)
+            except (ConnectionResetError, aiohttp.ClientConnectionResetError):
+                # the client went away mid body, the response was already sent
+                resp.force_close()
+                record_download(cluster, file, hash, size)
+                db.add_response(
+                    address,
+                    db.StatusType.PARTIAL,
+                    user_agent
+                )
+                return resp
+            except asyncio.CancelledError:
+                # the hit was counted already, keep the statistics in line before the task unwinds
+                record_download(cluster, file, hash, size)
+                db.add_response(
+                    address,
+                    db.StatusType.PARTIAL,
+                    user_agent
+                )
+                raise
+            except:
+                logger.ttraceback("storage.error.get_file", type=file.storage.type, path=file.storage.path, hash=hash)
+                resp.force_close()
+                db.add_response(
+                    address,
+                    db.StatusType.ERROR,
+                    user_agent
+                )
+                return resp
         elif isinstance(file, URLStorageFile):
             resp = aweb.HTTPFound(
                 file.url,
                 headers=headers
             )
+        if not resp.prepared:
+            # local and memory files are sent by aiohttp after we return
+            timestamp = DOWNLOAD_LATENCY.mark(DownloadStage.PREPARE, timestamp)
         type = None
         if resp.status == 200:
             type = db.StatusType.SUCCESS
@@ -1644,14 +2455,16 @@ async def _(request: aweb.Request):
             type = db.StatusType.REDIRECT
         if (type == db.StatusType.SUCCESS or type is None) and request.http_range.stop is not None:
             type = db.StatusType.PARTIAL
-        storage_name = file.storage.unique_id if file.storage is not None else None
-        db.add_file(cluster.id, storage_name, size)
+        record_download(cluster, file, hash, size)
+        DOWNLOAD_LATENCY.mark(DownloadStage.TOTAL, started)
         db.add_response(
             address,
             type or db.StatusType.ERROR,
             user_agent
         )
         return resp
+    except asyncio.CancelledError:
+        raise
     except:
         logger.traceback()
         db.add_response(
@@ -22,6 +22,19 @@ defaults = {
         "github_token": "",
         "measure_storage": False,
         "disallow_public_dashboard": False,
+        "gc": {
+            "enable": False,
+            "dry_run": True,
+            "interval": 86400,
+            "grace_period": 604800,
+            "batch_size": 100,
+            "batch_interval": 1
+        },
+        "journal": {
+            "enable": True,
+            "dir": "./journal",
+            "flush_interval": 1
+        },
     },
     "web": {
         "port": -1,
@@ -45,7 +58,11 @@ defaults = {
     ],
     "database": {
         "type": "sqlite",
-        "url": "./database.db"
+        "url": "./database.db",
+        "pool_size": 4,
+        "hourly_retention": 90,
+        "response_retention": 30,
+        "store_addresses": True
     },
 }
 
@@ -188,6 +205,74 @@ class Const:
     def disallow_public_dashboard(self):
         return Config.get("advanced.disallow_public_dashboard", False) or False
 
+    @property
+    def gc_enable(self) -> bool:
+        return bool(Config.get("advanced.gc.enable", False))
+
+    @property
+    def gc_dry_run(self) -> bool:
+        # only report until it is explicitly turned off
+        return Config.get("advanced.gc.dry_run", True) is not False
+
+    @property
+    def gc_interval(self) -> float:
+        return max(Config.get("advanced.gc.interval", 86400) or 86400, 3600)
+
+    @property
+    def gc_grace_period(self) -> float:
+        grace_period = Config.get("advanced.gc.grace_period", 604800)
+        return max(604800 if grace_period is None else grace_period, 0)
+
+    @property
+    def gc_batch_size(self) -> int:
+        return max(Config.get("advanced.gc.batch_size", 100) or 100, 1)
+
+    @property
+    def gc_batch_interval(self) -> float:
+        batch_interval = Config.get("advanced.gc.batch_interval", 1)
+        return max(1 if batch_interval is None else batch_interval, 0)
+
+    @property
+    def journal_enable(self) -> bool:
+        return Config.get("advanced.journal.enable", True) is not False
+
+    @property
+    def journal_dir(self) -> str:
+        return Config.get("advanced.journal.dir", "./journal") or "./journal"
+
+    @property
+    def journal_flush_interval(self) -> float:
+        # seconds of counters a crash may still lose
+        return max(Config.get("advanced.journal.flush_interval", 1) or 1, 1)
+
+    @property
+    def database_type(self) -> str:
+        return Config.get("database.type", "sqlite") or "sqlite"
+
+    @property
+    def database_url(self) -> str:
+        return Config.get("database.url", "./database.db") or "./database.db"
+
+    @property
+    def database_pool_size(self) -> int:
+        return max(Config.get("database.pool_size", 4) or 4, 1)
+
+    @property
+    def database_store_addresses(self) -> bool:
+        # unique counts come from sketches, the per address table only feeds the geo chart
+        return Config.get("database.store_addresses", True) is not False
+
+    @property
+    def database_hourly_retention(self) -> int:
+        # days, 0 keeps everything
+        hourly_retention = Config.get("database.hourly_retention", 90)
+        return max(90 if hourly_retention is None else hourly_retention, 0)
+
+    @property
+    def database_response_retention(self) -> int:
+        response_retention = Config.get("database.response_retention", 30)
+        return max(30 if response_retention is None else response_retention, 0)
+
 const = Const()
 
 VERSION = "3.5.2"
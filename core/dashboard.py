@@ -13,10 +13,11 @@ import threading
 import time
 from typing import Any, Callable, Optional
 
-import aiohttp
 import psutil
+from sqlalchemy import func
 
-from . import cache, cluster, config, logger, units, utils, scheduler, ipsearcher, database as db
+from . import cache, cluster, config, http, logger, metrics, units, utils, scheduler, ipsearcher, database as db
+from .sketches import HyperLogLog
 
 from .web import (
     routes as route,
@@ -158,6 +159,23 @@ class APIResponseStatistics:
     error: int = 0
     redirect: int = 0
 
+@dataclass
+class APIHashStatistics:
+    hash: str
+    hits: int
+    bytes: int
+    cache_hits: int
+    cache_hit_ratio: float
+
+@dataclass
+class APIHashesStatistics:
+    hits: list[APIHashStatistics]
+    bytes: list[APIHashStatistics]
+    total_hits: int
+    total_bytes: int
+    cache_hits: int
+    cache_hit_ratio: float
+
 @dataclass
 class SSEClient:
     request: web.Request
@@ -419,6 +437,7 @@ IPSEARCHER = ipsearcher.City(
 )
 IPSEARCHER_CACHE: dict[str, ipsearcher.CityInfo] = {}
 IPWARNING: set[str] = set()
+TOP_LIST_LIMIT = 100
 
 @route.get("/service-worker.js")
 async def _(request: web.Request):
@@ -434,6 +453,15 @@ async def _(request: web.Request):
 async def _(request: web.Request):
     return web.FileResponse("./assets/favicon.ico")
 
+@route.get("/metrics")
+async def _(request: web.Request):
+    return web.Response(
+        body=metrics.render().encode("utf-8"),
+        headers={
+            "Content-Type": metrics.CONTENT_TYPE
+        }
+    )
+
 @route.get("/assets/ip2region.xdb") # 禁止访问 ip2region.xdb
 async def _(request: web.Request):
     return web.Response(status=404)
@@ -621,19 +649,19 @@ def _(req_data: Any) -> Any:
 
 @API.on("storage_keys")
 def _(req_data: Any) -> Any:
-    with db.SESSION as session:
+    with db.READ_SESSION as session:
         q = session.query(db.StorageUniqueIDTable)
-    return [
-        {
-            "id": item.unique_id,
-            "data": json.loads(str(item.data) or "{}")
-        } for item in q.all()
-    ]
+        return [
+            {
+                "id": item.unique_id,
+                "data": json.loads(str(item.data) or "{}")
+            } for item in q.all()
+        ]
 
 @API.on("cluster_statistics_hourly")
 def _(req_data: Any) -> Any:
     hour = get_query_day_tohour(0)
-    with db.SESSION as session:
+    with db.READ_SESSION as session:
         q = session.query(db.ClusterStatisticsTable).filter(
             db.ClusterStatisticsTable.hour >= hour
         ).order_by(db.ClusterStatisticsTable.hour, db.ClusterStatisticsTable.cluster)
@@ -648,37 +676,16 @@ def _(req_data: Any) -> Any:
             )
     return hourly_data
 
-@API.on("storage_statistics_daily")
-def _(req_data: Any) -> Any:
-    hour = get_query_day_tohour(30)
-    with db.SESSION as session:
-        q = session.query(db.ClusterStatisticsTable).filter(
-            db.ClusterStatisticsTable.hour >= hour
-        ).order_by(db.ClusterStatisticsTable.hour, db.ClusterStatisticsTable.cluster)
-        temp_data: defaultdict[str, defaultdict[int, APIStatistics]] = defaultdict(lambda: defaultdict(lambda: APIStatistics("", 0, 0)))
-        for item in q.all():
-            cluster_id = str(item.cluster)
-            hits = int(item.hits)  # type: ignore
-            bytes = int(item.bytes) # type: ignore
-            day = (int(item.hour) + UTC // 3600) // 24 # type: ignore
-            temp_data[cluster_id][day].bytes += bytes
-            temp_data[cluster_id][day].hits += hits
-    days_data: defaultdict[str, list[APIStatistics]] = defaultdict(list)
-    for cluster_id, data in temp_data.items():
-        for day, item in data.items():
-            days_data[cluster_id].append(APIStatistics(units.format_date(day * 86400), item.bytes, item.hits))
-    return days_data
-
 @API.on("storage_statistics_hourly")
 def _(req_data: Any) -> Any:
     hour = get_query_day_tohour(0)
-    with db.SESSION as session:
+    with db.READ_SESSION as session:
         q = session.query(db.StorageStatisticsTable).filter(
             db.StorageStatisticsTable.hour >= hour
         ).order_by(db.StorageStatisticsTable.hour)
         hourly_data: defaultdict[str, list[APIStatistics]] = defaultdict(list)
         for item in q.all():
-            hourly_data[item.storage].append( # type: ignore
+            hourly_data[item.storage or None].append( # type: ignore
                 APIStatistics(
                     int(item.hour - hour), # type: ignore
                     int(item.bytes), # type: ignore
@@ -687,39 +694,20 @@ def _(req_data: Any) -> Any:
             )
         return hourly_data
 
-@API.on("storage_statistics_daily")
-def _(req_data: Any) -> Any:
-    hour = get_query_day_tohour(30)
-    with db.SESSION as session:
-        q = session.query(db.StorageStatisticsTable).filter(
-            db.StorageStatisticsTable.hour >= hour
-        ).order_by(db.StorageStatisticsTable.hour)
-        temp_data: defaultdict[str, defaultdict[int, APIStatistics]] = defaultdict(lambda: defaultdict(lambda: APIStatistics("", 0, 0)))
-        for item in q.all():
-            storage_id = str(item.storage)
-            hits = int(item.hits)  # type: ignore
-            bytes = int(item.bytes) # type: ignore
-            day = (int(item.hour) + UTC // 3600) // 24 # type: ignore
-            temp_data[storage_id][day].bytes += bytes
-            temp_data[storage_id][day].hits += hits
-    days_data: defaultdict[str, list[APIStatistics]] = defaultdict(list)
-    for storage_id, data in temp_data.items():
-        for day, item in data.items():
-            days_data[storage_id].append(APIStatistics(units.format_date(day * 86400), item.bytes, item.hits))
-    return days_data
-
 @API.on("clusters_event")
 def _(req_data: Any) -> Any:
     return cluster.clusters.event_logger.read()
 
+@cache.async_cache(timeout=60, error_timeout=5)
+async def fetch_rank() -> Any:
+    async with http.get_session().get(config.const.rank_clusters_url) as resp:
+        return await resp.json()
+
 @API.on("clusters_name")
 async def _(req_data: Any) -> Any:
     clusters: dict[str, str] = {}
-    async with aiohttp.ClientSession() as session:
-        async with session.get(config.const.rank_clusters_url) as resp:
-            resp = await resp.json()
-            for item in resp:
-                clusters[item["_id"]] = item["name"]
+    for item in await fetch_rank():
+        clusters[item["_id"]] = item["name"]
 
     return {
         c.id: clusters.get(c.id, c.id) for c in cluster.clusters.clusters
@@ -727,31 +715,22 @@ async def _(req_data: Any) -> Any:
 
 @API.on("rank")
 async def _(req_data: Any) -> Any:
-    async with aiohttp.ClientSession() as session:
-        async with session.get(config.const.rank_clusters_url) as resp:
-            return await resp.json()
+    return await fetch_rank()
 
 @API.on("response_ip_access")
 def _(req_data: Any) -> Any:
     day = 1
     if isinstance(req_data, int) and req_data == 1 or req_data == 7 or req_data == 30:
         day = req_data
-    query_data = query_addresses(day * 24)
-    temp_data: defaultdict[str, set] = defaultdict(set)
-    if day > 7:
-        for hour, data in query_data.items():
-            date = datetime.datetime.fromtimestamp(hour * 3600)
+    bucket = 24 if day > 7 else 1
+    resp_data: defaultdict[str, int] = defaultdict(int)
+    for hour, count in query_addresses(day * 24, bucket).items():
+        date = datetime.datetime.fromtimestamp(hour * 3600)
+        if day > 7:
             key = f"{date.year:04d}-{date.month:02d}-{date.day:02d}"
-            temp_data[key] |= data.keys()
-    else:
-        for hour, data in query_data.items():
-            date = datetime.datetime.fromtimestamp(hour * 3600)
-            hour = date.hour
+        else:
             key = f"{date.year:04d}-{date.month:02d}-{date.day:02d} {date.hour:02d}:{date.minute:02d}"
-            temp_data[key] |= data.keys()
-    resp_data: defaultdict[str, int] = defaultdict(int)
-    for key, data in temp_data.items():
-        resp_data[key] = len(data)
+        resp_data[key] = count
     return resp_data
 
 @API.on("response_user_agents")
@@ -760,17 +739,89 @@ def _(req_data: Any) -> Any:
     if isinstance(req_data, int) and req_data == 1 or req_data == 7 or req_data == 30:
         day = req_data
     hour = get_query_hour_tohour(day * 24)
-    data: defaultdict[str, int] = defaultdict(int)
-    with db.SESSION as session:
-        q = session.query(db.ResponseTable).filter(
-            db.ResponseTable.hour >= hour
-        ).order_by(db.ResponseTable.hour)
-        for item in q.all():
-            ip_tables = db.decompress(item.user_agents)  # type: ignore
-            for user_agent, count in ip_tables.items():
-                data[user_agent] += count
+    data: dict[str, int] = {}
+    with db.READ_SESSION as session:
+        total = func.sum(db.ResponseUserAgentTable.count)
+        q = session.query(
+            db.UserAgentTable.user_agent,
+            total
+        ).join(
+            db.UserAgentTable, db.UserAgentTable.id == db.ResponseUserAgentTable.user_agent_id
+        ).filter(
+            db.ResponseUserAgentTable.hour >= hour
+        ).group_by(db.ResponseUserAgentTable.user_agent_id).order_by(total.desc()).limit(TOP_LIST_LIMIT)
+        for user_agent, count in q.all():
+            data[user_agent] = int(count)
     return data
 
+@API.on("response_addresses")
+def _(req_data: Any) -> Any:
+    day = 1
+    if isinstance(req_data, int) and req_data == 1 or req_data == 7 or req_data == 30:
+        day = req_data
+    hour = get_query_hour_tohour(day * 24)
+    data: dict[str, int] = {}
+    with db.READ_SESSION as session:
+        total = func.sum(db.ResponseAddressTable.count)
+        q = session.query(
+            db.AddressTable.address,
+            total
+        ).join(
+            db.AddressTable, db.AddressTable.id == db.ResponseAddressTable.address_id
+        ).filter(
+            db.ResponseAddressTable.hour >= hour
+        ).group_by(db.ResponseAddressTable.address_id).order_by(total.desc()).limit(TOP_LIST_LIMIT)
+        for address, count in q.all():
+            data[address] = int(count)
+    return data
+
+@API.on("hash_statistics")
+def _(req_data: Any) -> Any:
+    day = 1
+    if isinstance(req_data, int) and req_data == 1 or req_data == 7 or req_data == 30:
+        day = req_data
+    hour = get_query_hour_tohour(day * 24)
+    hot_storage = cluster.clusters.storage_manager.hot_storage
+    with db.READ_SESSION as session:
+        hits = func.sum(db.HashStatisticsTable.hits)
+        bytes = func.sum(db.HashStatisticsTable.bytes)
+        cache_hits = func.sum(db.HashStatisticsTable.cache_hits)
+        q = session.query(
+            db.HashStatisticsTable.hash,
+            hits,
+            bytes,
+            cache_hits
+        ).filter(
+            db.HashStatisticsTable.hour >= hour
+        ).group_by(db.HashStatisticsTable.hash)
+        top = {
+            order: [
+                APIHashStatistics(hash, int(h), int(b), int(c), int(c) / int(h) if h else 0)
+                for hash, h, b, c in q.order_by(column.desc()).limit(TOP_LIST_LIMIT).all()
+            ] for order, column in (("hits", hits), ("bytes", bytes))
+        }
+        # totals come from the storage counters, they cover every object and not only the kept ones
+        total_hits, total_bytes = session.query(
+            func.coalesce(func.sum(db.StorageStatisticsTable.hits), 0),
+            func.coalesce(func.sum(db.StorageStatisticsTable.bytes), 0)
+        ).filter(db.StorageStatisticsTable.hour >= hour).one()
+        total_cache_hits = 0
+        if hot_storage is not None:
+            total_cache_hits = session.query(
+                func.coalesce(func.sum(db.StorageStatisticsTable.hits), 0)
+            ).filter(
+                db.StorageStatisticsTable.hour >= hour,
+                db.StorageStatisticsTable.storage == hot_storage.storage.unique_id
+            ).scalar()
+    return APIHashesStatistics(
+        top["hits"],
+        top["bytes"],
+        int(total_hits),
+        int(total_bytes),
+        int(total_cache_hits),
+        int(total_cache_hits) / int(total_hits) if total_hits else 0
+    )
+
 @API.on("response_status")
 def _(req_data: Any) -> Any:
     day = 1
@@ -779,7 +830,7 @@ def _(req_data: Any) -> Any:
     hour = get_query_hour_tohour(day * 24)
     data: APIResponseStatistics = APIResponseStatistics()
     data_fields = fields(APIResponseStatistics)
-    with db.SESSION as session:
+    with db.READ_SESSION as session:
         q = session.query(db.ResponseTable).filter(
             db.ResponseTable.hour >= hour
         ).order_by(db.ResponseTable.hour)
@@ -809,45 +860,24 @@ def _(req_data: Any) -> Any:
 
 @API.on("cluster_statistics_daily")
 def _(req_data: Any) -> Any:
-    hour = get_query_day_tohour(30)
-    with db.SESSION as session:
-        q = session.query(db.ClusterStatisticsTable).filter(
-            db.ClusterStatisticsTable.hour >= hour
-        ).order_by(db.ClusterStatisticsTable.hour, db.ClusterStatisticsTable.cluster)
-        temp_data: defaultdict[str, defaultdict[int, APIStatistics]] = defaultdict(lambda: defaultdict(lambda: APIStatistics("", 0, 0)))
-        for item in q.all():
-            cluster_id = str(item.cluster)
-            hits = int(item.hits)  # type: ignore
-            bytes = int(item.bytes) # type: ignore
-            day = (int(item.hour) + UTC // 3600) // 24 # type: ignore
-            temp_data[cluster_id][day].bytes += bytes
-            temp_data[cluster_id][day].hits += hits
-    days_data: defaultdict[str, list[APIStatistics]] = defaultdict(list)
-    for cluster_id, data in temp_data.items():
-        for day, item in data.items():
-            days_data[cluster_id].append(APIStatistics(units.format_date(day * 86400), item.bytes, item.hits))
-    return days_data
+    return query_rollups(db.ClusterStatisticsRollupTable, db.Granularity.DAY)
 
 @API.on("storage_statistics_daily")
 def _(req_data: Any) -> Any:
-    hour = get_query_day_tohour(30)
-    with db.SESSION as session:
-        q = session.query(db.StorageStatisticsTable).filter(
-            db.StorageStatisticsTable.hour >= hour
-        ).order_by(db.StorageStatisticsTable.hour)
-        temp_data: defaultdict[str, defaultdict[int, APIStatistics]] = defaultdict(lambda: defaultdict(lambda: APIStatistics("", 0, 0)))
-        for item in q.all():
-            storage_id = str(item.storage)
-            hits = int(item.hits)  # type: ignore
-            bytes = int(item.bytes) # type: ignore
-            day = (int(item.hour) + UTC // 3600) // 24 # type: ignore
-            temp_data[storage_id][day].bytes += bytes
-            temp_data[storage_id][day].hits += hits
-    days_data: defaultdict[str, list[APIStatistics]] = defaultdict(list)
-    for storage_id, data in temp_data.items():
-        for day, item in data.items():
-            days_data[storage_id].append(APIStatistics(units.format_date(day * 86400), item.bytes, item.hits))
-    return days_data
+    return query_rollups(db.StorageStatisticsRollupTable, db.Granularity.DAY)
+
+@API.on("cluster_statistics_monthly")
+def _(req_data: Any) -> Any:
+    return query_rollups(db.ClusterStatisticsRollupTable, db.Granularity.MONTH)
+
+@API.on("storage_statistics_monthly")
+def _(req_data: Any) -> Any:
+    return query_rollups(db.StorageStatisticsRollupTable, db.Granularity.MONTH)
+
+@API.on("download_latency")
+async def _(req_data: Any) -> Any:
+    # merging iterates the histograms mark updates, so stay on the event loop
+    return cluster.DOWNLOAD_LATENCY.get()
 
 @API.on("clusters_bandwidth")
 def _(req_data: Any) -> Any:
@@ -860,7 +890,7 @@ async def handle_api(
 ) -> Any:
     """if event == "response_hourly":
         hour = get_query_day_tohour(0)
-        with db.SESSION as session:
+        with db.READ_SESSION as session:
             q = session.query(db.ResponseTable).filter(
                 db.ResponseTable.hour >= hour
             ).order_by(db.ResponseTable.hour)
@@ -880,7 +910,7 @@ async def handle_api(
 
     if event == "response_daily":
         day = get_query_day_tohour(30)
-        with db.SESSION as session:
+        with db.READ_SESSION as session:
             q = session.query(db.ResponseTable).filter(
                 db.ResponseTable.hour >= day
             ).order_by(db.ResponseTable.hour)
@@ -927,7 +957,7 @@ async def handle_api(
         if isinstance(req_data, int):
             day = req_data
         day = max(1, min(30, day))
-        with db.SESSION as session:
+        with db.READ_SESSION as session:
             q = session.query(db.ResponseTable).filter(
                 db.ResponseTable.hour >= get_query_day_tohour(day)
             ).order_by(db.ResponseTable.hour)
@@ -994,22 +1024,51 @@ def get_query_hour_tohour(hour: int):
     t = int(time.time())
     return int((t - ((t + UTC) % 3600) - 3600 * hour) / 3600)
 
-def query_addresses(
-    since_hour: int = 24
+def query_rollups(
+    table: Any,
+    granularity: "db.Granularity"
 ):
-    hour = get_query_hour_tohour(since_hour)
-    with db.SESSION as session:
-        q = session.query(db.ResponseTable).filter(
-            db.ResponseTable.hour >= hour
-        ).order_by(db.ResponseTable.hour)
-        data: defaultdict[int, dict[str, int]] = defaultdict(lambda: defaultdict(int))
-        for item in q.all():
-            ip_tables = db.decompress(item.ip_tables)  # type: ignore
-            for ip, count in ip_tables.items():
-                data[item.hour][ip] += count # type: ignore
+    # last 30 days or the last 12 months, read from the rollups
+    since = db.get_period(granularity, get_query_day_tohour(30))
+    if granularity == db.Granularity.MONTH:
+        since -= 11
+    key = table.cluster if table is db.ClusterStatisticsRollupTable else table.storage
+    data: defaultdict[str, list[APIStatistics]] = defaultdict(list)
+    with db.READ_SESSION as session:
+        q = session.query(table.period, key, table.hits, table.bytes).filter(
+            table.granularity == granularity.value,
+            table.period >= since
+        ).order_by(table.period)
+        for period, id, hits, bytes in q.all():
+            if granularity == db.Granularity.DAY:
+                date = units.format_date(period * 86400)
+            else:
+                date = f"{period // 12:04d}-{period % 12 + 1:02d}"
+            data[str(id or None)].append(APIStatistics(date, int(bytes), int(hits)))
     return data
 
-
+def query_addresses(
+    since_hour: int = 24,
+    bucket: int = 1
+):
+    # unique addresses per bucket of hours, buckets start at local midnight
+    hour = get_query_hour_tohour(since_hour)
+    offset = int(datetime.datetime.now().astimezone().utcoffset().total_seconds() // 3600) # type: ignore
+    sketches: dict[int, HyperLogLog] = {}
+    with db.READ_SESSION as session:
+        q = session.query(db.ResponseSketchTable.hour, db.ResponseSketchTable.addresses).filter(
+            db.ResponseSketchTable.hour >= hour
+        )
+        for item, data in q.all():
+            key = (int(item) + offset) // bucket * bucket - offset
+            sketch = db.load_sketch(data)
+            if key in sketches:
+                sketches[key].merge(sketch)
+            else:
+                sketches[key] = sketch
+    return {
+        key: sketch.count() for key, sketch in sketches.items()
+    }
 
 def query_geo(
     day: int,
@@ -1017,50 +1076,24 @@ def query_geo(
 ):
     resp_data: defaultdict[str, int] = defaultdict(int)
     since_hour = get_query_hour_tohour(day * 24)
-    with db.SESSION as session:
-        q = session.query(db.ResponseTable).filter(
-            db.ResponseTable.hour >= since_hour
-        ).order_by(db.ResponseTable.hour)
-        for item in q.all():
-            wait_threads(
-                thread_decompress_data_and_query,
-                [
-                    (item.ip_tables, cn, resp_data)
-                ]
-            )
+    with db.READ_SESSION as session:
+        q = session.query(
+            db.AddressTable.address,
+            func.sum(db.ResponseAddressTable.count)
+        ).join(
+            db.AddressTable, db.AddressTable.id == db.ResponseAddressTable.address_id
+        ).filter(
+            db.ResponseAddressTable.hour >= since_hour
+        ).group_by(db.ResponseAddressTable.address_id)
+        for ip, count in q.all():
+            address = query_ip(ip)
+            if cn and address.country == "CN":
+                resp_data[address.province] += int(count)
+            else:
+                resp_data[address.country] += int(count)
     
     return resp_data
 
-
-def wait_threads(
-    target,
-    args: list[tuple[Any, ...]] = []
-):
-    threads: list[threading.Thread] = []
-    for arg in args:
-        threads.append(threading.Thread(
-            target=target,
-            args=arg
-        ))
-    for thread in threads:
-        thread.start()
-    for thread in threads:
-        thread.join()
-    threads.clear()
-
-def thread_decompress_data_and_query(
-    origin: bytes,
-    cn,
-    resp_data: defaultdict[str, int]
-):
-    data = db.decompress(origin)
-    for k, count in data.items():
-        address = query_ip(k)
-        if cn and address.country == "CN":
-            resp_data[address.province] += count
-        else:
-            resp_data[address.country] += count
-
 def query_ip(
     ip: str
 ):
@@ -1084,7 +1117,7 @@ def query_ip(
 
 """
 def query_geo_address(day: int):
-    with db.SESSION as session:
+    with db.READ_SESSION as session:
         q = session.query(db.ResponseTable).filter(
             db.ResponseTable.hour >= get_query_day_tohour(day)
         ).order_by(db.ResponseTable.hour)
@@ -1168,7 +1201,8 @@ async def fetch_github_repo():
         if not path.startswith("/"):
             path = f"/{path}"
         async with session.get(
-            f"/repos/{GITHUB_REPO}/contents{path}"
+            f"/repos/{GITHUB_REPO}/contents{path}",
+            headers=headers
         ) as resp:
             if resp.status == 200:
                 data = await resp.json()
@@ -1191,7 +1225,8 @@ async def fetch_github_repo():
     
     async def get_file(file: GithubPath):
         async with session.get(
-            f"/repos/{GITHUB_REPO}/git/blobs/{file.sha}"
+            f"/repos/{GITHUB_REPO}/git/blobs/{file.sha}",
+            headers=headers
         ) as resp:
             if resp.status == 200:
                 json_data = await resp.json()
@@ -1248,7 +1283,8 @@ async def fetch_github_repo():
     
     async def check_update():
         async with session.get(
-            f"/repos/{GITHUB_REPO}/releases/latest"
+            f"/repos/{GITHUB_REPO}/releases/latest",
+            headers=headers
         ) as resp:
             if resp.status == 200:
                 json_data = await resp.json()
@@ -1257,18 +1293,13 @@ async def fetch_github_repo():
                     logger.tinfo("dashboard.info.new_version", current=config.VERSION, latest=tag_name)
                     return
 
-    headers = {
-        "User-Agent": config.USER_AGENT
-    }
+    headers = {}
     if config.const.github_token:
         headers["Authorization"] = f"Bearer {config.const.github_token}"
-    async with aiohttp.ClientSession(
-        GITHUB_BASEURL,
-        headers=headers
-    ) as session:
-        tasks = [
-            check_update()
-        ]
-        if config.const.auto_sync_assets:
-            tasks.append(sync_assets())
-        await asyncio.gather(*tasks)
\ No newline at end of file
+    session = http.get_session(GITHUB_BASEURL)
+    tasks = [
+        check_update()
+    ]
+    if config.const.auto_sync_assets:
+        tasks.append(sync_assets())
+    await asyncio.gather(*tasks)
\ No newline at end of file
@@ -1,17 +1,25 @@
+import asyncio
+import base64
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
+import datetime
 from enum import Enum
 import json
+import sys
 import threading
 import time
-from typing import Optional
+from typing import Any, Optional
 import pyzstd
-from sqlalchemy import create_engine, Column, Integer, String, LargeBinary
+from sqlalchemy import BigInteger, Engine, UniqueConstraint, create_engine, Column, Integer, LargeBinary, String, delete, event, func, inspect, select, text
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session as ORMSession
 from sqlalchemy.orm.decl_api import DeclarativeMeta
 
-from core import logger, scheduler, storages, utils
+from core import config, logger, metrics, scheduler, storages, utils
+from core.journal import Journal
+from core.sketches import HyperLogLog, SpaceSaving
 
 @dataclass
 class StorageStatistics:
@@ -46,42 +54,156 @@ class ResponseStatistics:
     error: int = 0
     redirect: int = 0
     partial: int = 0
-    ip_tables: defaultdict[str, int] = field(default_factory=lambda: defaultdict(int))
-    user_agents: defaultdict[str, int] = field(default_factory=lambda: defaultdict(int))
+    # heaviest addresses and user agents only, memory stays flat under floods of new clients
+    ip_tables: SpaceSaving = field(default_factory=lambda: SpaceSaving(ADDRESS_TOP_CAPACITY))
+    user_agents: SpaceSaving = field(default_factory=lambda: SpaceSaving(USER_AGENT_TOP_CAPACITY))
+    # unique addresses of the hour
+    addresses: HyperLogLog = field(default_factory=HyperLogLog)
 
-
-
-engine = create_engine('sqlite:///database.db')
+@dataclass
+class HashStatistics:
+    # heaviest objects of the hour, bytes and cache hits are only kept for the hashes the hits keep
+    hits: SpaceSaving = field(default_factory=lambda: SpaceSaving(HASH_TOP_CAPACITY))
+    bytes: defaultdict[str, int] = field(default_factory=lambda: defaultdict(int))
+    cache_hits: defaultdict[str, int] = field(default_factory=lambda: defaultdict(int))
+
+
+def get_url() -> str:
+    url = config.const.database_url
+    if "://" in url:
+        return url
+    return f"{config.const.database_type}:///{url}"
+
+def _set_sqlite_pragmas(query_only: bool):
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        # readers never wait for the writer in wal mode
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+        if query_only:
+            cursor.execute("PRAGMA query_only=ON")
+        cursor.close()
+    return set_pragmas
+
+def create_engines() -> tuple[Engine, Engine]:
+    # one connection for the writer, a pool for dashboard reads
+    url = get_url()
+    write_engine = create_engine(url, pool_size=1, max_overflow=0)
+    read_engine = create_engine(url, pool_size=config.const.database_pool_size, max_overflow=0)
+    if write_engine.dialect.name == "sqlite":
+        event.listen(write_engine, "connect", _set_sqlite_pragmas(False))
+        event.listen(read_engine, "connect", _set_sqlite_pragmas(True))
+    return write_engine, read_engine
+
+def insert(table: Any):
+    if engine.dialect.name == "postgresql":
+        return postgresql.insert(table)
+    return sqlite.insert(table)
+
+SQLITE_BUSY_TIMEOUT = 5000
+# days and months follow the UTC+8 days of the dashboard
+ROLLUP_UTC_OFFSET = 8
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+COMPACT_INTERVAL = 3600
+engine, read_engine = create_engines()
 Base: DeclarativeMeta = declarative_base()
 
 class ClusterStatisticsTable(Base):
     __tablename__ = 'ClusterStatistics'
+    __table_args__ = (UniqueConstraint('hour', 'cluster'),)
     id = Column(Integer, primary_key=True)
     hour = Column(Integer, nullable=False)
     cluster = Column(String, nullable=False)
-    hits = Column(String, nullable=False)
-    bytes = Column(String, nullable=False)
+    hits = Column(BigInteger, nullable=False, default=0)
+    bytes = Column(BigInteger, nullable=False, default=0)
 
 class StorageStatisticsTable(Base):
     __tablename__ = 'StorageStatistics'
+    __table_args__ = (UniqueConstraint('hour', 'storage'),)
     id = Column(Integer, primary_key=True)
     hour = Column(Integer, nullable=False)
-    storage = Column(String, nullable=True)
-    hits = Column(String, nullable=False)
-    bytes = Column(String, nullable=False)
+    # NO_STORAGE instead of NULL, NULLs never conflict in a unique index
+    storage = Column(String, nullable=False)
+    hits = Column(BigInteger, nullable=False, default=0)
+    bytes = Column(BigInteger, nullable=False, default=0)
+
+class ClusterStatisticsRollupTable(Base):
+    __tablename__ = 'ClusterStatisticsRollups'
+    __table_args__ = (UniqueConstraint('granularity', 'period', 'cluster'),)
+    id = Column(Integer, primary_key=True)
+    granularity = Column(String, nullable=False)
+    period = Column(Integer, nullable=False)
+    cluster = Column(String, nullable=False)
+    hits = Column(BigInteger, nullable=False, default=0)
+    bytes = Column(BigInteger, nullable=False, default=0)
+
+class StorageStatisticsRollupTable(Base):
+    __tablename__ = 'StorageStatisticsRollups'
+    __table_args__ = (UniqueConstraint('granularity', 'period', 'storage'),)
+    id = Column(Integer, primary_key=True)
+    granularity = Column(String, nullable=False)
+    period = Column(Integer, nullable=False)
+    storage = Column(String, nullable=False)
+    hits = Column(BigInteger, nullable=False, default=0)
+    bytes = Column(BigInteger, nullable=False, default=0)
 
 class ResponseTable(Base):
     __tablename__ = 'Responses'
+    __table_args__ = (UniqueConstraint('hour'),)
+    id = Column(Integer, primary_key=True)
+    hour = Column(Integer, nullable=False)
+    success = Column(BigInteger, nullable=False, default=0)
+    partial = Column(BigInteger, nullable=False, default=0)
+    forbidden = Column(BigInteger, nullable=False, default=0)
+    not_found = Column(BigInteger, nullable=False, default=0)
+    error = Column(BigInteger, nullable=False, default=0)
+    redirect = Column(BigInteger, nullable=False, default=0)
+
+class ResponseSketchTable(Base):
+    __tablename__ = 'ResponseSketches'
+    __table_args__ = (UniqueConstraint('hour'),)
+    id = Column(Integer, primary_key=True)
+    hour = Column(Integer, nullable=False)
+    # zstd compressed hyperloglog registers
+    addresses = Column(LargeBinary, nullable=False)
+
+class AddressTable(Base):
+    __tablename__ = 'Addresses'
+    id = Column(Integer, primary_key=True)
+    address = Column(String, nullable=False, unique=True)
+
+class UserAgentTable(Base):
+    __tablename__ = 'UserAgents'
+    id = Column(Integer, primary_key=True)
+    user_agent = Column(String, nullable=False, unique=True)
+
+class ResponseAddressTable(Base):
+    __tablename__ = 'ResponseAddresses'
+    __table_args__ = (UniqueConstraint('hour', 'address_id'),)
+    id = Column(Integer, primary_key=True)
+    hour = Column(Integer, nullable=False)
+    address_id = Column(Integer, nullable=False, index=True)
+    count = Column(BigInteger, nullable=False, default=0)
+
+class ResponseUserAgentTable(Base):
+    __tablename__ = 'ResponseUserAgents'
+    __table_args__ = (UniqueConstraint('hour', 'user_agent_id'),)
     id = Column(Integer, primary_key=True)
     hour = Column(Integer, nullable=False)
-    success = Column(String, nullable=False)
-    partial = Column(String, nullable=False)
-    forbidden = Column(String, nullable=False)
-    not_found = Column(String, nullable=False)
-    error = Column(String, nullable=False)
-    redirect = Column(String, nullable=False)
-    ip_tables = Column(LargeBinary, nullable=False)
-    user_agents = Column(LargeBinary, nullable=False)
+    user_agent_id = Column(Integer, nullable=False, index=True)
+    count = Column(BigInteger, nullable=False, default=0)
+
+class HashStatisticsTable(Base):
+    __tablename__ = 'HashStatistics'
+    __table_args__ = (UniqueConstraint('hour', 'hash'),)
+    id = Column(Integer, primary_key=True)
+    hour = Column(Integer, nullable=False, index=True)
+    hash = Column(String, nullable=False)
+    hits = Column(BigInteger, nullable=False, default=0)
+    bytes = Column(BigInteger, nullable=False, default=0)
+    # served from the hot storage tier
+    cache_hits = Column(BigInteger, nullable=False, default=0)
 
 class StorageUniqueIDTable(Base):
     __tablename__ = 'StorageUniqueID'
@@ -97,108 +219,232 @@ class StatusType(Enum):
     ERROR = "error"
     REDIRECT = "redirect"
 
-class Session:
-    def __init__(self):
-        self.session = sessionmaker(bind=engine)()
-        self.lock = threading.Lock()
+class Granularity(Enum):
+    DAY = "day"
+    MONTH = "month"
 
-    def __del__(self):
-        self.session.close()
-        del self.session    
+class Session:
+    def __init__(self, engine: Engine, lock: bool = True):
+        self.sessionmaker = sessionmaker(bind=engine)
+        self.lock = threading.Lock() if lock else None
+        self.local = threading.local()
 
     def __enter__(self):
-        self.lock.acquire()
-        return self.session
+        if self.lock is not None:
+            self.lock.acquire()
+        self.local.session = self.sessionmaker()
+        return self.local.session
     
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.session.commit()
-        self.lock.release()
+        session: ORMSession = self.local.session
+        try:
+            if exc_type is None:
+                session.commit()
+            else:
+                session.rollback()
+        finally:
+            session.close()
+            if self.lock is not None:
+                self.lock.release()
     
-SESSION = Session()
+SESSION = Session(engine)
+# readers get their own connection each, so they never queue behind commits
+READ_SESSION = Session(read_engine, False)
+WRITE_EXECUTOR = ThreadPoolExecutor(1, "database_write")
+COMMIT_LOCK = asyncio.Lock()
+NO_STORAGE = ""
+ADDRESS_TOP_CAPACITY = 4096
+USER_AGENT_TOP_CAPACITY = 1024
+HASH_TOP_CAPACITY = 8192
+INTERN_BATCH_SIZE = 500
 FILE_CACHE: defaultdict[FileStatisticsKey, FileStatistics] = defaultdict(lambda: FileStatistics())
 RESPONSE_CACHE: defaultdict[int, ResponseStatistics] = defaultdict(lambda: ResponseStatistics())
+HASH_CACHE: defaultdict[int, HashStatistics] = defaultdict(lambda: HashStatistics())
+# every counter delta not yet committed, replayed into the caches after a crash
+JOURNAL = Journal("database")
+JOURNAL_FILE = "f"
+JOURNAL_RESPONSE = "r"
+JOURNAL_HASH = "h"
+# deltas since the last journal write, journaled as one record per key instead of per request
+JOURNAL_FILE_CACHE: defaultdict[FileStatisticsKey, FileStatistics] = defaultdict(lambda: FileStatistics())
+JOURNAL_RESPONSE_CACHE: defaultdict[int, ResponseStatistics] = defaultdict(lambda: ResponseStatistics())
+JOURNAL_HASH_CACHE: defaultdict[int, HashStatistics] = defaultdict(lambda: HashStatistics())
 
 def add_file(cluster: str, storage: Optional[str], bytes: int):
-    global FILE_CACHE
     key = FileStatisticsKey(get_hour(), cluster, storage)
-    FILE_CACHE[key].bytes += bytes
-    FILE_CACHE[key].hits += 1
+    _add_file(FILE_CACHE[key], 1, bytes)
+    if JOURNAL.enabled:
+        _add_file(JOURNAL_FILE_CACHE[key], 1, bytes)
+
+def _add_file(stats: FileStatistics, hits: int, bytes: int):
+    stats.hits += hits
+    stats.bytes += bytes
 
 def add_response(ip: str, type: StatusType, user_agent: str):
-    global RESPONSE_CACHE
     hour = get_hour()
-    RESPONSE_CACHE[hour].ip_tables[ip] += 1
-    RESPONSE_CACHE[hour].user_agents[user_agent] += 1
-    setattr(RESPONSE_CACHE[hour], type.value, getattr(RESPONSE_CACHE[hour], type.value) + 1)
+    _add_response(RESPONSE_CACHE[hour], ip, type, user_agent)
+    if JOURNAL.enabled:
+        _add_response(JOURNAL_RESPONSE_CACHE[hour], ip, type, user_agent)
+
+def _add_response(stats: ResponseStatistics, ip: str, type: StatusType, user_agent: str):
+    stats.ip_tables.add(ip)
+    stats.addresses.add(ip)
+    stats.user_agents.add(user_agent)
+    setattr(stats, type.value, getattr(stats, type.value) + 1)
+
+def _merge_response(stats: ResponseStatistics, other: ResponseStatistics):
+    for type in StatusType:
+        setattr(stats, type.value, getattr(stats, type.value) + getattr(other, type.value))
+    for ip, count in other.ip_tables.items():
+        stats.ip_tables.add(ip, count)
+    for user_agent, count in other.user_agents.items():
+        stats.user_agents.add(user_agent, count)
+    stats.addresses.merge(other.addresses)
+
+def add_hash(hash: str, bytes: int, cached: bool):
+    hour = get_hour()
+    _add_hash(HASH_CACHE[hour], hash, 1, bytes, int(cached))
+    if JOURNAL.enabled:
+        _add_hash(JOURNAL_HASH_CACHE[hour], hash, 1, bytes, int(cached))
+
+def get_hash_hits(hash: str) -> int:
+    # hits recorded since the last commit
+    return sum(value.hits[hash] for value in HASH_CACHE.values())
+
+def query_hash_hits(since_hour: int, min_hits: int, limit: int) -> dict[str, int]:
+    # committed hits of the hottest hashes
+    with READ_SESSION as session:
+        hits = func.sum(HashStatisticsTable.hits)
+        return {
+            hash: int(count) for hash, count in session.execute(
+                select(HashStatisticsTable.hash, hits).where(
+                    HashStatisticsTable.hour >= since_hour
+                ).group_by(HashStatisticsTable.hash).having(hits >= min_hits).order_by(hits.desc()).limit(limit)
+            )
+        }
+
+def _add_hash(stats: HashStatistics, hash: str, hits: int, bytes: int, cache_hits: int):
+    evicted = stats.hits.add(hash, hits)
+    if evicted is not None:
+        stats.bytes.pop(evicted, None)
+        stats.cache_hits.pop(evicted, None)
+    stats.bytes[hash] += bytes
+    if cache_hits:
+        stats.cache_hits[hash] += cache_hits
 
 def get_hour():
     return int(time.time() // 3600)
 
-def _commit_storage(session: ORMSession, hour: int, storage: Optional[str], hits: int, bytes: int):
-    if hits == bytes == 0:
-        return False
-    q = session.query(StorageStatisticsTable).filter_by(hour=hour, storage=storage)
-    r = q.first() or StorageStatisticsTable(hour=hour, storage=storage, hits=str(0), bytes=str(0))
-    if q.count() == 0:
-        session.add(r)
-    q.update(
-        {
-            'hits': str(int(r.hits) + hits), # type: ignore
-            'bytes': str(int(r.bytes) + bytes) # type: ignore
-        }
+def _upsert(session: ORMSession, table: Any, rows: list[dict[str, Any]], keys: list[str], counters: list[str]):
+    # one INSERT ... ON CONFLICT DO UPDATE for every row of the table
+    if not rows:
+        return
+    stmt = insert(table)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=keys,
+        set_={name: table.c[name] + stmt.excluded[name] for name in counters}
     )
-    return True
-
-def _commit_cluster(session: ORMSession, hour: int, cluster: str, hits: int, bytes: int):
-    if hits == bytes == 0:
-        return False
-    q = session.query(ClusterStatisticsTable).filter_by(hour=hour, cluster=cluster)
-    r = q.first() or ClusterStatisticsTable(hour=hour, cluster=cluster, hits=str(0), bytes=str(0))
-    if q.count() == 0:
-        session.add(r)
-    q.update(
-        {
-            'hits': str(int(r.hits) + hits), # type: ignore
-            'bytes': str(int(r.bytes) + bytes) # type: ignore
-        }
-    )
-    return True
-
-def _commit_response(session: ORMSession, hour: int, ip_tables: defaultdict[str, int], user_agents: defaultdict[str, int], success: int = 0, forbidden: int = 0, redirect: int = 0, not_found: int = 0, error: int = 0, partial: int = 0):
-    if ip_tables == {}:
-        return False
-    q = session.query(ResponseTable).filter_by(hour=hour)
-    r = q.first() or ResponseTable(hour=hour, ip_tables=b'', user_agents=b'', success=str(0), forbidden=str(0), redirect=str(0), not_found=str(0), error=str(0), partial=str(0))
-    if q.count() == 0:
-        session.add(r)
-    origin_ip_tables: defaultdict[str, int] = decompress(r.ip_tables) # type: ignore
-    origin_user_agents: defaultdict[str, int] = decompress(r.user_agents) # type: ignore
-    for ip, count in ip_tables.items():
-        origin_ip_tables[ip] += count
-
-    for user_agent, count in user_agents.items():
-        origin_user_agents[user_agent] += count
-    q.update(
-        {
-            'ip_tables': compress(origin_ip_tables), # type: ignore
-            'user_agents': compress(origin_user_agents), # type: ignore
-            'success': str(int(r.success) + success), # type: ignore
-            'forbidden': str(int(r.forbidden) + forbidden), # type: ignore
-            'redirect': str(int(r.redirect) + redirect), # type: ignore
-            'not_found': str(int(r.not_found) + not_found), # type: ignore
-            'error': str(int(r.error) + error), # type: ignore
-            'partial': str(int(r.partial) + partial) # type: ignore
-        }
+    session.execute(stmt, rows)
+
+def _commit_files(session: ORMSession, cache: dict[FileStatisticsKey, FileStatistics]):
+    storages: defaultdict[tuple[int, str], FileStatistics] = defaultdict(FileStatistics)
+    clusters: defaultdict[tuple[int, str], FileStatistics] = defaultdict(FileStatistics)
+    for key, value in cache.items():
+        if value.hits == value.bytes == 0:
+            continue
+        for stats in (
+            storages[(key.hour, key.storage_id or NO_STORAGE)],
+            clusters[(key.hour, key.cluster_id)]
+        ):
+            stats.hits += value.hits
+            stats.bytes += value.bytes
+    _upsert(session, StorageStatisticsTable.__table__, [
+        {"hour": hour, "storage": storage, "hits": value.hits, "bytes": value.bytes} for (hour, storage), value in storages.items()
+    ], ["hour", "storage"], ["hits", "bytes"])
+    _upsert(session, ClusterStatisticsTable.__table__, [
+        {"hour": hour, "cluster": cluster, "hits": value.hits, "bytes": value.bytes} for (hour, cluster), value in clusters.items()
+    ], ["hour", "cluster"], ["hits", "bytes"])
+    _commit_rollups(session, StorageStatisticsRollupTable.__table__, "storage", storages)
+    _commit_rollups(session, ClusterStatisticsRollupTable.__table__, "cluster", clusters)
+
+def dump_sketch(sketch: HyperLogLog) -> bytes:
+    return pyzstd.compress(bytes(sketch))
+
+def load_sketch(data: bytes) -> HyperLogLog:
+    return HyperLogLog.from_bytes(pyzstd.decompress(data))
+
+def _commit_sketches(session: ORMSession, sketches: dict[int, HyperLogLog]):
+    # merging registers is idempotent, a retried commit never counts twice
+    if not sketches:
+        return
+    table = ResponseSketchTable.__table__
+    for hour, data in session.execute(select(table.c.hour, table.c.addresses).where(table.c.hour.in_(sketches.keys()))):
+        sketches[hour] = sketches[hour].copy().merge(load_sketch(data))
+    stmt = insert(table)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["hour"],
+        set_={"addresses": stmt.excluded.addresses}
     )
-    return True
-
-def compress(data: defaultdict[str, int]) -> bytes:
-    output = utils.DataOutputStream()
-    output.write_long(len(data))
-    for key, val in data.items():
-        output.write_string(key)
-        output.write_long(val)
-    return pyzstd.compress(output.getvalue())
+    session.execute(stmt, [{"hour": hour, "addresses": dump_sketch(sketch)} for hour, sketch in sketches.items()])
+
+def get_day(hour: int) -> int:
+    return (hour + ROLLUP_UTC_OFFSET) // 24
+
+def get_month(day: int) -> int:
+    date = datetime.date.fromordinal(EPOCH_ORDINAL + day)
+    return date.year * 12 + date.month - 1
+
+def get_period(granularity: Granularity, hour: int) -> int:
+    day = get_day(hour)
+    if granularity == Granularity.DAY:
+        return day
+    return get_month(day)
+
+def _commit_rollups(session: ORMSession, table: Any, column: str, hourly: dict[tuple[int, str], FileStatistics]):
+    # the daily and monthly totals grow with the same commit as the hourly rows
+    rollups: defaultdict[tuple[str, int, str], FileStatistics] = defaultdict(FileStatistics)
+    for (hour, key), value in hourly.items():
+        for granularity in Granularity:
+            stats = rollups[(granularity.value, get_period(granularity, hour), key)]
+            stats.hits += value.hits
+            stats.bytes += value.bytes
+    _upsert(session, table, [
+        {"granularity": granularity, "period": period, column: key, "hits": value.hits, "bytes": value.bytes} for (granularity, period, key), value in rollups.items()
+    ], ["granularity", "period", column], ["hits", "bytes"])
+
+def _intern(session: ORMSession, table: Any, column: str, values: set[str]) -> dict[str, int]:
+    # map ip addresses or user agents to the ids of their dimension rows
+    if not values:
+        return {}
+    session.execute(insert(table).on_conflict_do_nothing(index_elements=[column]), [{column: value} for value in values])
+    ids: dict[str, int] = {}
+    values_list = list(values)
+    for i in range(0, len(values_list), INTERN_BATCH_SIZE):
+        for id, value in session.execute(select(table.c.id, table.c[column]).where(table.c[column].in_(values_list[i:i + INTERN_BATCH_SIZE]))):
+            ids[value] = id
+    return ids
+
+def _commit_responses(session: ORMSession, cache: dict[int, ResponseStatistics]):
+    _upsert(session, ResponseTable.__table__, [
+        {"hour": hour, **{type.value: getattr(value, type.value) for type in StatusType}} for hour, value in cache.items()
+        if any(getattr(value, type.value) for type in StatusType)
+    ], ["hour"], [type.value for type in StatusType])
+    _commit_sketches(session, {hour: value.addresses for hour, value in cache.items() if value.addresses})
+    if config.const.database_store_addresses:
+        addresses = _intern(session, AddressTable.__table__, "address", {ip for value in cache.values() for ip in value.ip_tables})
+        _upsert(session, ResponseAddressTable.__table__, [
+            {"hour": hour, "address_id": addresses[ip], "count": count} for hour, value in cache.items() for ip, count in value.ip_tables.items() if count
+        ], ["hour", "address_id"], ["count"])
+    user_agents = _intern(session, UserAgentTable.__table__, "user_agent", {user_agent for value in cache.values() for user_agent in value.user_agents})
+    _upsert(session, ResponseUserAgentTable.__table__, [
+        {"hour": hour, "user_agent_id": user_agents[user_agent], "count": count} for hour, value in cache.items() for user_agent, count in value.user_agents.items() if count
+    ], ["hour", "user_agent_id"], ["count"])
+
+def _commit_hashes(session: ORMSession, cache: dict[int, HashStatistics]):
+    _upsert(session, HashStatisticsTable.__table__, [
+        {"hour": hour, "hash": hash, "hits": hits, "bytes": value.bytes.get(hash, 0), "cache_hits": value.cache_hits.get(hash, 0)}
+        for hour, value in cache.items() for hash, hits in value.hits.items() if hits
+    ], ["hour", "hash"], ["hits", "bytes", "cache_hits"])
 
 def decompress(data: bytes) -> defaultdict[str, int]:
     if not data:
@@ -215,65 +461,173 @@ def decompress(data: bytes) -> defaultdict[str, int]:
         logger.ttraceback("database.error.unable.to.decompress", data=data)
         return defaultdict(lambda: 0)
 
-def commit():
+def _commit(cache: dict[FileStatisticsKey, FileStatistics], response_cache: dict[int, ResponseStatistics], hash_cache: dict[int, HashStatistics]):
+    with SESSION as session:
+        _commit_files(session, cache)
+        _commit_responses(session, response_cache)
+        _commit_hashes(session, hash_cache)
+
+def _restore(cache: dict[FileStatisticsKey, FileStatistics], response_cache: dict[int, ResponseStatistics], hash_cache: dict[int, HashStatistics]):
+    # put the counters of a failed commit back for the next one
+    for key, value in cache.items():
+        _add_file(FILE_CACHE[key], value.hits, value.bytes)
+    for hour, value in response_cache.items():
+        _merge_response(RESPONSE_CACHE[hour], value)
+    for hour, value in hash_cache.items():
+        for hash, hits in value.hits.items():
+            _add_hash(HASH_CACHE[hour], hash, hits, value.bytes.get(hash, 0), value.cache_hits.get(hash, 0))
+
+async def commit():
+    # one commit at a time, a failed one restores into the caches the next one swaps out
+    async with COMMIT_LOCK:
+        await _commit_caches()
+
+async def _commit_caches():
+    global FILE_CACHE, RESPONSE_CACHE, HASH_CACHE
+    # swapped on the event loop, requests record into the new caches while we write
+    cache, FILE_CACHE = FILE_CACHE, defaultdict(lambda: FileStatistics())
+    response_cache, RESPONSE_CACHE = RESPONSE_CACHE, defaultdict(lambda: ResponseStatistics())
+    hash_cache, HASH_CACHE = HASH_CACHE, defaultdict(lambda: HashStatistics())
+    if not cache and not response_cache and not hash_cache:
+        return
+    segment = JOURNAL.seal()
+    start = time.perf_counter()
     try:
-        global FILE_CACHE
-        total_hits = 0
-        total_bytes = 0
-        total_storages = 0
-        cache = FILE_CACHE.copy()
-        response_cache = RESPONSE_CACHE.copy()
-        with SESSION as session:
-            clusters: defaultdict[tuple[int, str], FileStatistics] = defaultdict(lambda: FileStatistics(0, 0))
-            for key, value in cache.items():
-                hour = key.hour
-                cluster = key.cluster_id
-                storage = key.storage_id
-                hits = value.hits
-                bytes = value.bytes
-                if _commit_storage(session, hour, storage, hits, bytes):
-                    total_hits += hits
-                    total_bytes += bytes
-                    total_storages += 1
-                    clusters[(hour, cluster)].hits += hits
-                    clusters[(hour, cluster)].bytes += bytes
-            for cluster, value in clusters.items():
-                _commit_cluster(session,cluster[0], cluster[1], value.hits, value.bytes)
-
-            for hour, value in response_cache.items():
-                _commit_response(session,hour, value.ip_tables, value.user_agents, value.success, value.forbidden, value.redirect, value.not_found, value.error, value.partial)
-
-        old_keys = []
-        for key, value in cache.items():
-            FILE_CACHE[key].hits -= value.hits
-            FILE_CACHE[key].bytes -= value.bytes
-            if FILE_CACHE[key].hits == FILE_CACHE[key].bytes == 0:
-                old_keys.append(key)
-        for key in old_keys:
-            del FILE_CACHE[key]
-
-        old_keys.clear()
-
-        for hour, value in response_cache.items():
-            RESPONSE_CACHE[hour].success -= value.success
-            RESPONSE_CACHE[hour].forbidden -= value.forbidden
-            RESPONSE_CACHE[hour].redirect -= value.redirect
-            RESPONSE_CACHE[hour].not_found -= value.not_found
-            RESPONSE_CACHE[hour].error -= value.error
-            ip_hits = 0
-            user_agent_hits = 0
-            for ip, hits in value.ip_tables.items():
-                RESPONSE_CACHE[hour].ip_tables[ip] -= hits
-                ip_hits += RESPONSE_CACHE[hour].ip_tables[ip]
-            for user_agent, hits in value.user_agents.items():
-                RESPONSE_CACHE[hour].user_agents[user_agent] -= hits
-                user_agent_hits += RESPONSE_CACHE[hour].user_agents[user_agent]
-            if RESPONSE_CACHE[hour].success == RESPONSE_CACHE[hour].forbidden == RESPONSE_CACHE[hour].redirect == RESPONSE_CACHE[hour].not_found == RESPONSE_CACHE[hour].error == ip_hits == user_agent_hits == 0:
-                old_keys.append(hour)
-        for key in old_keys:
-            del RESPONSE_CACHE[key]
+        await asyncio.get_running_loop().run_in_executor(WRITE_EXECUTOR, _commit, cache, response_cache, hash_cache)
     except:
-        logger.terror("database.error.write")
+        metrics.DATABASE_COMMIT_DURATION.observe(time.perf_counter() - start, ("error",))
+        logger.ttraceback("database.error.write")
+        # the segments stay until a commit covers the restored counters
+        _restore(cache, response_cache, hash_cache)
+        return
+    metrics.DATABASE_COMMIT_DURATION.observe(time.perf_counter() - start, ("success",))
+    await JOURNAL.truncate(segment)
+
+def replay():
+    records = JOURNAL.open()
+    for record in records:
+        try:
+            kind, hour, *args = record
+            if kind == JOURNAL_FILE:
+                cluster, storage, hits, bytes = args
+                _add_file(FILE_CACHE[FileStatisticsKey(hour, cluster, storage)], hits, bytes)
+            elif kind == JOURNAL_RESPONSE:
+                types, addresses, ip_tables, user_agents = args
+                value = ResponseStatistics(**types, addresses=load_sketch(base64.b64decode(addresses)))
+                for ip, count in ip_tables:
+                    value.ip_tables.add(ip, count)
+                for user_agent, count in user_agents:
+                    value.user_agents.add(user_agent, count)
+                _merge_response(RESPONSE_CACHE[hour], value)
+            elif kind == JOURNAL_HASH:
+                for hash, hits, bytes, cache_hits in args[0]:
+                    _add_hash(HASH_CACHE[hour], hash, hits, bytes, cache_hits)
+        except:
+            logger.traceback()
+    if records:
+        logger.tinfo("database.info.replay", count=len(records))
+
+def migrate():
+    # tables from older versions kept counters as strings without a unique key
+    # and the ip and user agent tables of each hour as zstd blobs
+    tables: list[tuple[Any, list[str]]] = [
+        (ClusterStatisticsTable.__table__, ["hour", "cluster"]),
+        (StorageStatisticsTable.__table__, ["hour", "storage"]),
+        (ResponseTable.__table__, ["hour"]),
+    ]
+    inspector = inspect(engine)
+    legacy = [
+        (table, keys) for table, keys in tables
+        if inspector.has_table(table.name) and (
+            not inspector.get_unique_constraints(table.name) or
+            {column["name"] for column in inspector.get_columns(table.name)} - set(table.columns.keys())
+        )
+    ]
+    if not legacy:
+        return
+    logger.tinfo("database.info.migrate", tables=", ".join(table.name for table, _ in legacy))
+    with engine.begin() as conn:
+        for table, _ in legacy:
+            conn.execute(text(f'ALTER TABLE "{table.name}" RENAME TO "{table.name}_legacy"'))
+    Base.metadata.create_all(engine)
+    with SESSION as session:
+        for table, keys in legacy:
+            rows = session.execute(text(f'SELECT * FROM "{table.name}_legacy"')).mappings().all()
+            if table is ResponseTable.__table__:
+                # exact counts, the stored tables were never trimmed
+                cache: defaultdict[int, ResponseStatistics] = defaultdict(lambda: ResponseStatistics(
+                    ip_tables=SpaceSaving(sys.maxsize),
+                    user_agents=SpaceSaving(sys.maxsize)
+                ))
+                for row in rows:
+                    value = cache[int(row["hour"])]
+                    for type in StatusType:
+                        setattr(value, type.value, getattr(value, type.value) + int(row[type.value] or 0))
+                    for ip, count in decompress(row.get("ip_tables")).items():
+                        value.ip_tables.add(ip, count)
+                        value.addresses.add(ip)
+                    for user_agent, count in decompress(row.get("user_agents")).items():
+                        value.user_agents.add(user_agent, count)
+                _commit_responses(session, cache)
+            else:
+                _upsert(session, table, [
+                    {
+                        **{key: row[key] if key != "storage" else (row[key] or NO_STORAGE) for key in keys},
+                        "hits": int(row["hits"] or 0),
+                        "bytes": int(row["bytes"] or 0)
+                    } for row in rows
+                ], keys, ["hits", "bytes"])
+            session.execute(text(f'DROP TABLE "{table.name}_legacy"'))
+
+def backfill_rollups():
+    # hourly rows written before the rollup tables existed
+    tables: list[tuple[Any, Any, str]] = [
+        (StorageStatisticsTable.__table__, StorageStatisticsRollupTable.__table__, "storage"),
+        (ClusterStatisticsTable.__table__, ClusterStatisticsRollupTable.__table__, "cluster"),
+    ]
+    with SESSION as session:
+        for hourly_table, rollup_table, column in tables:
+            if session.execute(select(rollup_table.c.id).limit(1)).first() is not None:
+                continue
+            hourly: dict[tuple[int, str], FileStatistics] = {
+                (int(hour), key): FileStatistics(int(hits), int(bytes)) for hour, key, hits, bytes in session.execute(
+                    select(hourly_table.c.hour, hourly_table.c[column], hourly_table.c.hits, hourly_table.c.bytes)
+                )
+            }
+            _commit_rollups(session, rollup_table, column, hourly)
+
+def backfill_sketches():
+    # hours recorded before the sketches existed
+    with SESSION as session:
+        if session.execute(select(ResponseSketchTable.id).limit(1)).first() is not None:
+            return
+        sketches: defaultdict[int, HyperLogLog] = defaultdict(HyperLogLog)
+        for hour, address in session.execute(
+            select(ResponseAddressTable.hour, AddressTable.address).join(AddressTable, AddressTable.id == ResponseAddressTable.address_id)
+        ):
+            sketches[int(hour)].add(address)
+        _commit_sketches(session, sketches)
+
+def _compact(hourly_retention: int, response_retention: int):
+    hour = get_hour()
+    with SESSION as session:
+        if hourly_retention > 0:
+            for table in (ClusterStatisticsTable, StorageStatisticsTable):
+                session.execute(delete(table).where(table.hour < hour - hourly_retention * 24))
+        if response_retention > 0:
+            for table in (ResponseTable, ResponseSketchTable, ResponseAddressTable, ResponseUserAgentTable, HashStatisticsTable):
+                session.execute(delete(table).where(table.hour < hour - response_retention * 24))
+            # addresses and user agents nobody refers to anymore
+            session.execute(delete(AddressTable).where(AddressTable.id.not_in(select(ResponseAddressTable.address_id))))
+            session.execute(delete(UserAgentTable).where(UserAgentTable.id.not_in(select(ResponseUserAgentTable.user_agent_id))))
+
+async def compact():
+    try:
+        await asyncio.get_running_loop().run_in_executor(
+            WRITE_EXECUTOR, _compact, config.const.database_hourly_retention, config.const.database_response_retention
+        )
+    except:
+        logger.ttraceback("database.error.compact")
 
 def init_storages_key(*storage: storages.iStorage):
     with SESSION as session:
@@ -298,9 +652,49 @@ def init_storages_key(*storage: storages.iStorage):
                 q.update({"data": content})
         session.commit()
 
+@JOURNAL.collector
+def _():
+    global JOURNAL_FILE_CACHE, JOURNAL_RESPONSE_CACHE, JOURNAL_HASH_CACHE
+    files, JOURNAL_FILE_CACHE = JOURNAL_FILE_CACHE, defaultdict(lambda: FileStatistics())
+    responses, JOURNAL_RESPONSE_CACHE = JOURNAL_RESPONSE_CACHE, defaultdict(lambda: ResponseStatistics())
+    hashes, JOURNAL_HASH_CACHE = JOURNAL_HASH_CACHE, defaultdict(lambda: HashStatistics())
+    for key, value in files.items():
+        yield JOURNAL_FILE, key.hour, key.cluster_id, key.storage_id, value.hits, value.bytes
+    # unique addresses travel as the sketch, raw addresses only if they are stored anyway
+    store_addresses = config.const.database_store_addresses
+    for hour, value in responses.items():
+        yield (
+            JOURNAL_RESPONSE,
+            hour,
+            {type.value: getattr(value, type.value) for type in StatusType if getattr(value, type.value)},
+            base64.b64encode(dump_sketch(value.addresses)).decode("ascii"),
+            list(value.ip_tables.items()) if store_addresses else [],
+            list(value.user_agents.items()),
+        )
+    for hour, value in hashes.items():
+        yield JOURNAL_HASH, hour, [
+            (hash, hits, value.bytes.get(hash, 0), value.cache_hits.get(hash, 0)) for hash, hits in value.hits.items() if hits
+        ]
+
+@metrics.QUEUE_DEPTH.collector
+def _():
+    yield ("database_files",), len(FILE_CACHE)
+    yield ("database_responses",), len(RESPONSE_CACHE)
+    yield ("database_hashes",), sum(len(value.hits) for value in list(HASH_CACHE.values()))
+    yield ("database_journal",), len(JOURNAL.buffer) + len(JOURNAL_FILE_CACHE) + len(JOURNAL_RESPONSE_CACHE) + len(JOURNAL_HASH_CACHE)
+
 async def init():
+    migrate()
     Base.metadata.create_all(engine)
+    backfill_rollups()
+    backfill_sketches()
+    replay()
     scheduler.run_repeat_later(commit, 5, 10)
+    scheduler.run_repeat_later(compact, 60, COMPACT_INTERVAL)
 
 async def unload():
-    commit()
\ No newline at end of file
+    await commit()
+    await JOURNAL.close()
+    WRITE_EXECUTOR.shutdown()
+    engine.dispose()
+    read_engine.dispose()
\ No newline at end of file
@@ -0,0 +1,41 @@
+from typing import Optional
+
+import aiohttp
+
+from . import config
+
+sessions: dict[str, aiohttp.ClientSession] = {}
+
+def get_session(base_url: Optional[str] = None) -> aiohttp.ClientSession:
+    # one keep-alive pool per base url, shared by every control-plane call
+    key = base_url or ""
+    session = sessions.get(key)
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(
+            base_url,
+            connector=aiohttp.TCPConnector(
+                limit=HTTP_LIMIT,
+                limit_per_host=HTTP_LIMIT_PER_HOST,
+                keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+                ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+            ),
+            # aiohttp waits up to 300 seconds by default, bound stalls but not long downloads
+            timeout=aiohttp.ClientTimeout(sock_connect=HTTP_CONNECT_TIMEOUT, sock_read=HTTP_READ_TIMEOUT),
+            headers={
+                "User-Agent": config.USER_AGENT
+            }
+        )
+        sessions[key] = session
+    return session
+
+async def close():
+    while sessions:
+        _, session = sessions.popitem()
+        await session.close()
+
+HTTP_LIMIT = 256
+HTTP_LIMIT_PER_HOST = 64
+HTTP_KEEPALIVE_TIMEOUT = 60
+HTTP_DNS_CACHE_TTL = 300
+HTTP_CONNECT_TIMEOUT = 10
+HTTP_READ_TIMEOUT = 60
@@ -0,0 +1,105 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+from pathlib import Path
+from typing import Any, Callable, Iterable, Optional, Sequence
+
+from . import config, logger, scheduler
+
+
+class Journal:
+    # append only log of counter deltas, a segment is deleted once its counters are confirmed elsewhere
+    def __init__(self, name: str):
+        self.name = name
+        self.path = Path(config.const.journal_dir) / name
+        self.enabled = config.const.journal_enable
+        self.buffer: list[str] = []
+        self.segment = 0
+        self.flush_task: Optional[int] = None
+        # aggregated deltas, drained into the buffer right before each write
+        self.collectors: list[Callable[[], Iterable[Sequence[Any]]]] = []
+
+    def open(self) -> list[list[Any]]:
+        # returns the records a crash left behind, their segments stay until the next truncate
+        if not self.enabled:
+            return []
+        self.path.mkdir(parents=True, exist_ok=True)
+        segments = self.segments()
+        self.segment = segments[-1] + 1 if segments else 0
+        records: list[list[Any]] = []
+        for segment in segments:
+            with open(self._file(segment), "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except:
+                        # torn tail of the batch that was being written
+                        logger.tdebug("journal.debug.torn_record", name=self.name, segment=segment)
+        self.flush_task = scheduler.run_repeat_later(self.flush, config.const.journal_flush_interval, config.const.journal_flush_interval)
+        return records
+
+    def append(self, *record: Any):
+        if self.enabled:
+            self.buffer.append(json.dumps(record, separators=(",", ":")))
+
+    def collector(self, func: Callable[[], Iterable[Sequence[Any]]]):
+        self.collectors.append(func)
+        return func
+
+    def seal(self) -> int:
+        # records appended after this go to the next segment
+        segment = self.segment
+        self._submit(segment)
+        self.segment += 1
+        return segment
+
+    async def flush(self):
+        await self._submit(self.segment)
+
+    async def truncate(self, segment: int):
+        # one thread for every write, a segment is never deleted before its last batch landed
+        if self.enabled:
+            await asyncio.get_running_loop().run_in_executor(EXECUTOR, self._truncate, segment)
+
+    async def close(self):
+        scheduler.cancel(self.flush_task)
+        await self.flush()
+
+    def segments(self) -> list[int]:
+        return sorted(int(file.stem) for file in self.path.glob("*.journal") if file.stem.isdigit())
+
+    def _file(self, segment: int) -> Path:
+        return self.path / f"{segment:010d}.journal"
+
+    def _submit(self, segment: int) -> asyncio.Future:
+        for collector in self.collectors:
+            try:
+                for record in collector():
+                    self.append(*record)
+            except:
+                logger.traceback()
+        buffer, self.buffer = self.buffer, []
+        return asyncio.get_running_loop().run_in_executor(EXECUTOR, self._write, segment, buffer)
+
+    def _write(self, segment: int, buffer: list[str]):
+        if not buffer:
+            return
+        try:
+            self.path.mkdir(parents=True, exist_ok=True)
+            with open(self._file(segment), "a", encoding="utf-8") as f:
+                f.write("\n".join(buffer) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+        except:
+            logger.ttraceback("journal.error.write", name=self.name)
+
+    def _truncate(self, segment: int):
+        try:
+            for old in self.segments():
+                if old <= segment:
+                    self._file(old).unlink(missing_ok=True)
+        except:
+            logger.ttraceback("journal.error.truncate", name=self.name)
+
+EXECUTOR = ThreadPoolExecutor(1, "journal")
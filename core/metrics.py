@@ -0,0 +1,168 @@
+import asyncio
+import bisect
+from collections import defaultdict
+from typing import Callable, Iterable, Optional
+
+from . import logger
+
+# every update happens on the event loop, plain dicts and lists need no locks
+
+Samples = Iterable[tuple[tuple[str, ...], float]]
+
+class Metric:
+    type = "unknown"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        REGISTRY.append(self)
+
+    def samples(self) -> Iterable[tuple[str, tuple[str, ...], float]]:
+        return ()
+
+    def render(self) -> list[str]:
+        lines = [
+            f"# TYPE {self.name} {self.type}",
+            f"# HELP {self.name} {escape(self.help)}",
+        ]
+        for suffix, values, value in self.samples():
+            lines.append(f"{self.name}{suffix}{format_labels(self.labels, values)} {format_value(value)}")
+        return lines
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, help, labels)
+        self.values: defaultdict[tuple[str, ...], float] = defaultdict(float)
+
+    def inc(self, value: float = 1, labels: tuple[str, ...] = ()):
+        self.values[labels] += value
+
+    def samples(self):
+        for labels, value in list(self.values.items()):
+            yield "_total", labels, value
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, help, labels)
+        self.values: dict[tuple[str, ...], float] = {}
+        # read when scraped, for state owned by other modules
+        self.collectors: list[Callable[[], Samples]] = []
+
+    def set(self, value: float, labels: tuple[str, ...] = ()):
+        self.values[labels] = value
+
+    def collector(self, func: Callable[[], Samples]):
+        self.collectors.append(func)
+        return func
+
+    def samples(self):
+        for labels, value in list(self.values.items()):
+            yield "", labels, value
+        for collector in self.collectors:
+            for labels, value in collector():
+                yield "", labels, value
+
+class HistogramValue:
+    def __init__(self, size: int):
+        self.counts = [0] * size
+        self.sum = 0.0
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: Optional[tuple[float, ...]] = None):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets or LATENCY_BUCKETS))
+        self.values: dict[tuple[str, ...], HistogramValue] = {}
+
+    def observe(self, value: float, labels: tuple[str, ...] = ()):
+        histogram = self.values.get(labels)
+        if histogram is None:
+            # the last slot is +Inf
+            histogram = self.values[labels] = HistogramValue(len(self.buckets) + 1)
+        histogram.counts[bisect.bisect_left(self.buckets, value)] += 1
+        histogram.sum += value
+
+    def render(self) -> list[str]:
+        lines = [
+            f"# TYPE {self.name} {self.type}",
+            f"# HELP {self.name} {escape(self.help)}",
+        ]
+        for values, histogram in list(self.values.items()):
+            count = 0
+            for bucket, bucket_count in zip((*self.buckets, float("inf")), histogram.counts):
+                count += bucket_count
+                lines.append(f"{self.name}_bucket{format_labels((*self.labels, 'le'), (*values, format_value(float(bucket))))} {count}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, values)} {count}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, values)} {format_value(histogram.sum)}")
+        return lines
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace("\"", "\\\"")
+
+def format_labels(names: tuple[str, ...], values: tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f"{name}=\"{escape(str(value))}\"" for name, value in zip(names, values)) + "}"
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return f"{value:.1f}"
+    return str(value)
+
+def render() -> str:
+    lines: list[str] = []
+    for metric in REGISTRY:
+        try:
+            lines.extend(metric.render())
+        except:
+            logger.traceback()
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+async def monitor_event_loop():
+    # how late a sleep wakes up is how long the loop was blocked
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(EVENT_LOOP_INTERVAL)
+        EVENT_LOOP_LAG.observe(max(0, loop.time() - start - EVENT_LOOP_INTERVAL))
+
+async def init():
+    global monitor_task
+    monitor_task = asyncio.create_task(monitor_event_loop())
+
+async def unload():
+    if monitor_task is not None:
+        monitor_task.cancel()
+
+REGISTRY: list[Metric] = []
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+EVENT_LOOP_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+EVENT_LOOP_INTERVAL = 0.5
+monitor_task: Optional[asyncio.Task] = None
+
+HTTP_REQUEST_DURATION = Histogram("openbmclapi_http_request_duration_seconds", "Time spent handling http requests", ("status",))
+SERVED_HITS = Counter("openbmclapi_served_hits", "Files served", ("cluster", "storage"))
+SERVED_BYTES = Counter("openbmclapi_served_bytes", "Bytes served", ("cluster", "storage"))
+HOT_STORAGE_REQUESTS = Counter("openbmclapi_hot_storage_requests", "Downloads by whether the hot storage tier served them", ("result",))
+EVENT_LOOP_LAG = Histogram("openbmclapi_event_loop_lag_seconds", "Delay of event loop wake ups", buckets=EVENT_LOOP_BUCKETS)
+DATABASE_COMMIT_DURATION = Histogram("openbmclapi_database_commit_duration_seconds", "Time spent committing statistics", ("result",))
+QUEUE_DEPTH = Gauge("openbmclapi_queue_depth", "Items waiting in internal queues", ("queue",))
+SYNC_FILES = Gauge("openbmclapi_sync_files", "Files of the current or last sync", ("state",))
+SYNC_BYTES = Gauge("openbmclapi_sync_bytes", "Bytes of the current or last sync", ("state",))
+CLUSTER_ENABLED = Gauge("openbmclapi_cluster_enabled", "Whether the cluster is enabled", ("cluster",))
+STORAGE_UP = Gauge("openbmclapi_storage_up", "Whether the storage passed its last availability check", ("storage", "type", "name"))
+STORAGE_LATENCY = Gauge("openbmclapi_storage_latency_seconds", "Moving average of storage lookup latency", ("storage",))
+STORAGE_ERRORS = Gauge("openbmclapi_storage_error_ratio", "Moving average of failed storage lookups", ("storage",))
+STORAGE_INFLIGHT = Gauge("openbmclapi_storage_inflight", "Storage lookups in flight", ("storage",))
+STORAGE_CIRCUIT_OPEN = Gauge("openbmclapi_storage_circuit_open", "Whether the storage circuit breaker is open", ("storage",))
+HOT_STORAGE_BYTES = Gauge("openbmclapi_hot_storage_bytes", "Bytes held by the hot storage tier", ("state",))
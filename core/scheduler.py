@@ -14,7 +14,8 @@ from weakref import WeakValueDictionary
 from . import units
 
 background = SyncBackground()
-async_background: AsyncBackground
+# created up front, coroutine jobs added before init wait until it starts on the loop
+async_background = AsyncBackground()
 tasks: WeakValueDictionary[int, Job] = WeakValueDictionary()
 _async_id: int = 0
 _sync_id: int = 0
@@ -22,11 +23,6 @@ MAX_INSTANCES = 9999
 
 
 async def init():
-    global async_background
-    async_background = AsyncBackground(
-        event_loop=asyncio.get_event_loop()
-    )
-
     background.start()
     async_background.start()
 
@@ -34,7 +30,6 @@ async def init():
 
 
 async def unload():
-    global async_background
     background.shutdown()
     async_background.shutdown()
     logger.success('Background scheduler unloaded')
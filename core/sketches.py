@@ -0,0 +1,177 @@
+from collections import defaultdict
+import hashlib
+import heapq
+import math
+from typing import Optional
+
+
+def hash64(value: str) -> int:
+    # stable across processes, unlike hash()
+    return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+
+class HyperLogLog:
+    def __init__(self, precision: int = 12, registers: Optional[bytes] = None):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(registers) if registers else bytearray(self.size)
+        if len(self.registers) != self.size:
+            raise ValueError(f"expected {self.size} registers, got {len(self.registers)}")
+
+    def add(self, value: str):
+        hash = hash64(value)
+        index = hash >> (64 - self.precision)
+        bits = 64 - self.precision
+        rank = bits - (hash & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: 'HyperLogLog'):
+        if other.precision != self.precision:
+            raise ValueError("cannot merge sketches of different precision")
+        # bytewise max on big integers, registers stay below 0x80 so no byte borrows from the next
+        a = int.from_bytes(self.registers, "big")
+        b = int.from_bytes(other.registers, "big")
+        high = int.from_bytes(b"\x80" * self.size, "big")
+        mask = ((((a | high) - b) & high) >> 7) * 0xFF
+        self.registers = bytearray(((a & mask) | (b & ~mask)).to_bytes(self.size, "big"))
+        return self
+
+    def count(self) -> int:
+        alpha = 0.7213 / (1 + 1.079 / self.size)
+        estimate = alpha * self.size * self.size / sum(2.0 ** -register for register in self.registers)
+        zeros = self.registers.count(0)
+        # linear counting is more accurate for small sets
+        if estimate <= 2.5 * self.size and zeros:
+            return round(self.size * math.log(self.size / zeros))
+        return round(estimate)
+
+    def copy(self) -> 'HyperLogLog':
+        return HyperLogLog(self.precision, bytes(self.registers))
+
+    def __len__(self) -> int:
+        return self.count()
+
+    def __bool__(self) -> bool:
+        return any(self.registers)
+
+    def __bytes__(self) -> bytes:
+        return bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'HyperLogLog':
+        return cls(int(math.log2(len(data))), data)
+
+class SpaceSaving:
+    # keeps the heaviest `capacity` keys, a new key replaces the lightest one and inherits its count
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.counts: dict[str, int] = {}
+        # upper bound of how much of a count was inherited
+        self.errors: dict[str, int] = {}
+        self._heap: list[tuple[int, str]] = []
+
+    def add(self, key: str, count: int = 1) -> Optional[str]:
+        # returns the key that was evicted to make room, if any
+        if key in self.counts:
+            self.counts[key] += count
+            return None
+        evicted, error = None, 0
+        if len(self.counts) >= self.capacity:
+            evicted, error = self._evict()
+        self.counts[key] = error + count
+        self.errors[key] = error
+        heapq.heappush(self._heap, (self.counts[key], key))
+        return evicted
+
+    def _evict(self) -> tuple[str, int]:
+        # heap entries go stale as counts grow, refresh them until the top is current
+        while True:
+            count, key = heapq.heappop(self._heap)
+            if self.counts[key] == count:
+                del self.counts[key]
+                del self.errors[key]
+                return key, count
+            heapq.heappush(self._heap, (self.counts[key], key))
+
+    def top(self, n: Optional[int] = None) -> list[tuple[str, int]]:
+        return heapq.nlargest(n or len(self.counts), self.counts.items(), key=lambda item: item[1])
+
+    def guaranteed(self, key: str) -> int:
+        return self.counts.get(key, 0) - self.errors.get(key, 0)
+
+    def items(self):
+        return self.counts.items()
+
+    def __getitem__(self, key: str) -> int:
+        return self.counts.get(key, 0)
+
+    def __iter__(self):
+        return iter(self.counts)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.counts
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    def __bool__(self) -> bool:
+        return bool(self.counts)
+
+class HdrHistogram:
+    # log-linear buckets, a value shares its bucket only with values within 2 ** (1 - precision) of it
+    def __init__(self, precision: int = 8):
+        self.precision = precision
+        self.half = 1 << (precision - 1)
+        self.counts: defaultdict[int, int] = defaultdict(int)
+        self.total = 0
+        self.max = 0
+
+    def add(self, value: int, count: int = 1):
+        value = max(int(value), 0)
+        self.counts[self._index(value)] += count
+        self.total += count
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other: 'HdrHistogram'):
+        if other.precision != self.precision:
+            raise ValueError("cannot merge histograms of different precision")
+        for index, count in other.counts.items():
+            self.counts[index] += count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        return self
+
+    def percentiles(self, *percentiles: float) -> list[int]:
+        # highest value of the bucket each rank falls in, in a single pass
+        results = [0] * len(percentiles)
+        if not self.total:
+            return results
+        ranks = sorted((max(1, math.ceil(self.total * percentile / 100)), i) for i, percentile in enumerate(percentiles))
+        seen = 0
+        current = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            while current < len(ranks) and ranks[current][0] <= seen:
+                results[ranks[current][1]] = min(self._value(index), self.max)
+                current += 1
+            if current == len(ranks):
+                break
+        return results
+
+    def _index(self, value: int) -> int:
+        # values below 2 ** precision get a bucket each, above that each power of two gets half as many
+        shift = max(value.bit_length() - self.precision, 0)
+        return shift * self.half + (value >> shift)
+
+    def _value(self, index: int) -> int:
+        if index < (self.half << 1):
+            return index
+        shift = index // self.half - 1
+        return ((index - shift * self.half + 1) << shift) - 1
+
+    def __len__(self) -> int:
+        return self.total
+
+    def __bool__(self) -> bool:
+        return self.total > 0
@@ -1,5 +1,6 @@
 from collections import defaultdict
 from dataclasses import dataclass
+import importlib.metadata
 import inspect
 from typing import Any, Optional, TypeVar
 
@@ -10,7 +11,8 @@ from .base import (
     iStorage,
     MeasureFile,
     File,
-    iNetworkStorage
+    iNetworkStorage,
+    StorageCapability
 )
 from .alist import (
     AlistStorage
@@ -21,6 +23,9 @@ from .webdav import (
 from .local import (
     LocalStorage
 )
+from .s3 import (
+    S3Storage
+)
  
 
 @dataclass
@@ -51,33 +56,51 @@ abstract_storage_args: defaultdict[type[iStorage], list[Parameter]] = defaultdic
 
 T = TypeVar("T")
 
-async def init():
-    for istorage in (
-        AlistStorage,
-        WebDavStorage,
-        LocalStorage
-    ):
-        if istorage.type == iStorage.type:
-            continue
-        abstract_storages[istorage.type] = istorage
-        arg = inspect.getfullargspec(istorage.__init__)
-        args = arg.args[1:]
-        # defaults 默认的长度和位置都是从后往前数的，
-        # 填充一些空的在前面
-        defaults = [
-            inspect._empty for _ in range(len(args) - len(arg.defaults or []))
-        ]
-        defaults.extend(arg.defaults or [])
-        for idx, arg_name in enumerate(args):
-            if arg_name == "self":
+# third-party storages expose their iStorage subclass under this group
+ENTRY_POINT_GROUP = "openbmclapi.storages"
+
+BUILTIN_STORAGES: tuple[type[iStorage], ...] = (
+    AlistStorage,
+    WebDavStorage,
+    LocalStorage,
+    S3Storage
+)
+
+def register_storage(istorage: type[iStorage]):
+    if istorage.type == iStorage.type:
+        return
+    abstract_storages[istorage.type] = istorage
+    arg = inspect.getfullargspec(istorage.__init__)
+    args = arg.args[1:]
+    # defaults 默认的长度和位置都是从后往前数的，
+    # 填充一些空的在前面
+    defaults = [
+        inspect._empty for _ in range(len(args) - len(arg.defaults or []))
+    ]
+    defaults.extend(arg.defaults or [])
+    abstract_storage_args[istorage] = [
+        Parameter(
+            name=arg_name,
+            type=arg.annotations.get(arg_name, Any),
+            default=defaults[idx]
+        ) for idx, arg_name in enumerate(args) if arg_name != "self"
+    ]
+
+def load_entry_points():
+    for entry_point in importlib.metadata.entry_points(group=ENTRY_POINT_GROUP):
+        try:
+            istorage = entry_point.load()
+            if not inspect.isclass(istorage) or not issubclass(istorage, iStorage):
+                logger.twarning("storage.warning.entry_point", name=entry_point.name, value=entry_point.value)
                 continue
-            abstract_storage_args[istorage].append(
-                Parameter(
-                    name=arg_name,
-                    type=arg.annotations.get(arg_name, Any),
-                    default=defaults[idx]
-                )
-            )
+            register_storage(istorage)
+        except:
+            logger.traceback()
+
+async def init():
+    for istorage in BUILTIN_STORAGES:
+        register_storage(istorage)
+    load_entry_points()
 
     logger.debug("Storage init complete")
     logger.debug(f"Found {len(abstract_storages)} storage types: {', '.join(abstract_storages.keys())}")
\ No newline at end of file
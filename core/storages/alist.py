@@ -1,21 +1,29 @@
 import asyncio
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+import datetime
 import io
 import time
-from typing import Any, Optional
+from typing import Any, AsyncIterator, Optional
 import urllib.parse as urlparse
 
 import aiohttp
 
-from core import cache, config
+from core import cache, config, scheduler, units
 from core import utils
 from core.logger import logger
 from core.utils import WrapperTQDM
 
-from .base import FileInfo, MeasureFile, iNetworkStorage, Range, DOWNLOAD_DIR, File, CollectionFile
+from .base import FileInfo, MeasureFile, StorageCapability, get_range_header, iNetworkStorage, iter_http_range, Range, DOWNLOAD_DIR, File, CollectionFile
 
 
 ALIST_TOKEN_DEAULT_EXPIRY = 86400 * 2
+# links are dropped this long before the backend says they expire
+ALIST_LINK_EXPIRY_MARGIN = 30
+# a link hit this often is refreshed in the background once it is this far into its lifetime
+ALIST_LINK_HOT_HITS = 3
+ALIST_LINK_REFRESH_RATIO = 0.8
+# unchanged shards are still fully relisted once their snapshot is this old
+ALIST_SHARD_SNAPSHOT_EXPIRY = 86400
 
 @dataclass
 class AlistResult:
@@ -38,6 +46,20 @@ class AlistFileInfo:
     sign: str
     raw_url: str
 
+@dataclass
+class AlistLink:
+    url: str
+    expires: float
+    refresh_at: float
+    hits: int = 0
+
+@dataclass
+class AlistShard:
+    modified: float
+    total: int
+    files: list[File]
+    timestamp: float = field(default_factory=time.monotonic)
+
 class AlistError(Exception):
     def __init__(self, result: AlistResult):
         super().__init__(f"Status: {result.code}, Message: {result.message}")
@@ -45,6 +67,7 @@ class AlistError(Exception):
 
 class AlistStorage(iNetworkStorage):
     type = "alist"
+    capabilities = StorageCapability.URL | StorageCapability.STREAM | StorageCapability.BATCH_STAT | StorageCapability.RANGE
 
     def __init__(
         self, 
@@ -58,10 +81,21 @@ class AlistStorage(iNetworkStorage):
         cache_timeout: float = 60,
         retries: int = 3, 
         public_webdav_endpoint: str = "",
-        s3_custom_host: str = ""
+        s3_custom_host: str = "",
+        link_cache_timeout: float = 600,
+        list_per_page: int = 1000,
+        list_refresh: bool = False,
+        proxy: bool = False
     ):
-        super().__init__(path, username, password, endpoint, weight, list_concurrent, name, cache_timeout)
+        super().__init__(path, username, password, endpoint, weight, list_concurrent, name, cache_timeout, proxy)
         self.retries = retries
+        self.link_cache_timeout = link_cache_timeout
+        self.list_per_page = max(1, list_per_page)
+        self.list_refresh = list_refresh
+        self.shards: dict[int, AlistShard] = {}
+        self.links: dict[str, AlistLink] = {}
+        self.link_tasks: dict[str, asyncio.Task[str]] = {}
+        self.link_scheduler = scheduler.run_repeat_later(self._prune_links, link_cache_timeout, link_cache_timeout)
         self.last_token: Optional[AlistToken] = None
         self.session = aiohttp.ClientSession(
             headers={
@@ -97,7 +131,7 @@ class AlistStorage(iNetworkStorage):
             raise AlistError(AlistResult(500, "Failed to fetch token", None))
         return self.last_token.value
     
-    async def __action_data(self, method: str, path: str, data: Any, headers: dict[str, Any] = {}, _authentication: bool = False, _retries: int = 0):
+    async def __action_data(self, method: str, path: str, data: Any, headers: dict[str, Any] = {}, _authentication: bool = False, _retries: int = 0, _cache: bool = True):
         key = hash((
             method,
             path,
@@ -105,7 +139,7 @@ class AlistStorage(iNetworkStorage):
             repr(data)
         ))
         res = self.cache.get(key)
-        if res is not cache.EMPTY:
+        if _cache and res is not cache.EMPTY:
             return res
         async with self.session.request(
             method, f"{self.endpoint}{path}",
@@ -121,10 +155,10 @@ class AlistStorage(iNetworkStorage):
                 )
                 if result.code == 401 and not _authentication:
                     self.last_token = None
-                    return await self.__action_data(method, path, data, headers, True, _retries + 1)
+                    return await self.__action_data(method, path, data, headers, True, _retries + 1, _cache)
                 if result.code != 200:
                     if _retries < self.retries:
-                        return await self.__action_data(method, path, data, headers, _authentication, _retries + 1)
+                        return await self.__action_data(method, path, data, headers, _authentication, _retries + 1, _cache)
                     logger.terror("storage.error.action_alist", method=method, url=resp.url, status=result.code, message=result.message)
                     logger.debug(data)
                     logger.debug(result)
@@ -139,27 +173,93 @@ class AlistStorage(iNetworkStorage):
                 logger.terror("storage.error.alist", status=resp.status, message=await resp.text())
                 raise
     
+    async def _list_dir(self, sem: asyncio.Semaphore, path: str, page: int = 1, per_page: int = 0) -> tuple[int, list[dict[str, Any]]]:
+        async with sem:
+            async with self.session.post(
+                f"{self.endpoint}/api/fs/list",
+                headers={
+                    "Authorization": await self._get_token()
+                },
+                json={
+                    "path": path,
+                    "password": "",
+                    "page": page,
+                    "per_page": per_page or self.list_per_page,
+                    "refresh": self.list_refresh
+                }
+            ) as resp:
+                result = AlistResult(
+                    **await resp.json()
+                )
+        if result.code == 401:
+            self.last_token = None
+        if result.code != 200:
+            raise AlistError(result)
+        data = result.data or {}
+        return data.get("total", None) or 0, data.get("content", None) or []
+
+    async def _list_all_dir(self, sem: asyncio.Semaphore, path: str) -> list[dict[str, Any]]:
+        total, content = await self._list_dir(sem, path)
+        pages = (total + self.list_per_page - 1) // self.list_per_page
+        for _, result in await asyncio.gather(*(
+            self._list_dir(sem, path, page)
+            for page in range(2, pages + 1)
+        )):
+            content.extend(result)
+        if len(content) < total:
+            raise AlistError(AlistResult(500, f"Listed {len(content)} of {total} items in {path}", None))
+        return content
+
     async def list_files(self, pbar: WrapperTQDM) -> set[File]:
         @utils.retry(5, 10)
-        async def get_files(root_id: int):
-            root = self.path / DOWNLOAD_DIR / f"{root_id:02x}"
+        async def get_files(root_id: int) -> list[File]:
+            name = f"{root_id:02x}"
+            root = str(self.path / DOWNLOAD_DIR / name)
+            snapshot = self.shards.get(root_id)
+            if snapshot is not None and time.monotonic() - snapshot.timestamp > ALIST_SHARD_SNAPSHOT_EXPIRY:
+                snapshot = None
+            modified = 0.0
+            if dirs is not None:
+                if name not in dirs:
+                    self.shards.pop(root_id, None)
+                    return []
+                modified = dirs[name]
+                # drivers without directory times (S3) report year 1
+                if snapshot is not None and modified > 0 and snapshot.modified == modified:
+                    return snapshot.files
+            try:
+                if snapshot is not None and modified <= 0:
+                    total, _ = await self._list_dir(sem, root, 1, 1)
+                    if total == snapshot.total:
+                        return snapshot.files
+                content = await self._list_all_dir(sem, root)
+            except AlistError:
+                # without the parent listing a missing shard looks like an error
+                if dirs is not None:
+                    raise
+                return []
+            files = [
+                File(
+                    file["name"],
+                    file["size"],
+                    utils.parse_isotime_to_timestamp(file["modified"]),
+                    file["name"]
+                ) for file in content if not file.get("is_dir", False)
+            ]
+            self.shards[root_id] = AlistShard(
+                modified,
+                len(content),
+                files
+            )
+            return files
+
+        async def get_shard(root_id: int) -> list[File]:
             try:
-                async with sem:
-                    async with self.session.post(
-                        f"{self.endpoint}/api/fs/list",
-                        headers={
-                            "Authorization": await self._get_token()
-                        },
-                        data={
-                            "path": str(root),
-                        }
-                    ) as resp:
-                        result = AlistResult(
-                            **await resp.json()
-                        )
-                        return ((result.data or {}).get("content", None) or [])
+                return await get_files(root_id)
             except asyncio.CancelledError:
                 raise
+            except AlistError as e:
+                logger.debug(f"Unable to list alist shard {root_id:02x}: {e}")
             except:
                 logger.traceback()
             finally:
@@ -167,29 +267,35 @@ class AlistStorage(iNetworkStorage):
             return []
 
         sem = asyncio.Semaphore(self.list_concurrent)
+        dirs: Optional[dict[str, float]] = None
+        try:
+            dirs = {
+                item["name"]: get_dir_modified(item["modified"])
+                for item in await self._list_all_dir(sem, str(self.path / DOWNLOAD_DIR))
+                if item.get("is_dir", False)
+            }
+        except asyncio.CancelledError:
+            raise
+        except:
+            logger.debug(f"Unable to list alist directory {self.path / DOWNLOAD_DIR}, listing every shard")
         results = set()
         for root_id, result in zip(
             Range(),
             await asyncio.gather(*(
-                get_files(root_id)
+                get_shard(root_id)
                 for root_id in Range()
             )
         )):
             for file in result:
-                self.filelist[str(self.path / DOWNLOAD_DIR / f"{root_id:02x}" / file["name"])] = FileInfo(
-                    file["size"],
-                    utils.parse_isotime_to_timestamp(file["modified"]),
+                self.filelist[str(self.path / DOWNLOAD_DIR / f"{root_id:02x}" / file.name)] = FileInfo(
+                    file.size,
+                    file.mtime,
                 )
-                results.add(File(
-                    file["name"],
-                    file["size"],
-                    utils.parse_isotime_to_timestamp(file["modified"]),
-                    file["name"]
-                ))
+                results.add(file)
 
         return results
     
-    async def __info_file(self, file: CollectionFile) -> AlistFileInfo:
+    async def __info_file(self, file: CollectionFile, _cache: bool = True) -> AlistFileInfo:
         r = await self.__action_data(
             "post",
             "/api/fs/get",
@@ -197,6 +303,7 @@ class AlistStorage(iNetworkStorage):
                 "path": str(self.get_path(file)),
                 "password": ""
             },
+            _cache=_cache
         )
         name = file.hash if isinstance(file, File) else str(file.size)
         if r.code == 500:
@@ -227,14 +334,79 @@ class AlistStorage(iNetworkStorage):
             info.raw_url
         ) as resp:
             return io.BytesIO(await resp.read())
+
+    async def iter_file(self, file: CollectionFile, chunk_size: int = 1024 * 256) -> AsyncIterator[bytes]:
+        async for chunk in self.read_range(file, chunk_size=chunk_size):
+            yield chunk
+
+    async def read_range(self, file: CollectionFile, start: int = 0, end: Optional[int] = None, chunk_size: int = 1024 * 256) -> AsyncIterator[bytes]:
+        # streamed from the resolved raw url, the backend serves the range
+        info = await self.__info_file(file)
+        if info.size == -1 or not info.raw_url:
+            return
+        async with self.session.get(
+            info.raw_url,
+            headers=get_range_header(start, end)
+        ) as resp:
+            resp.raise_for_status()
+            async for chunk in iter_http_range(resp, start, end, chunk_size):
+                yield chunk
         
     async def get_url(self, file: CollectionFile) -> str:
         if self._s3_custom_host:
             return f"{self._s3_custom_host}{str(self.get_path(file))}"
         if self._public_webdav_endpoint:
             return f"{self._public_webdav_endpoint}{str(self.get_path(file))}"
-        info = await self.__info_file(file)
-        return '' if info.size == -1 else info.raw_url
+        key = str(self.get_path(file))
+        link = self.links.get(key)
+        current = time.monotonic()
+        if link is None or link.expires <= current:
+            return await asyncio.shield(self._fetch_link(file, key))
+        link.hits += 1
+        if link.refresh_at <= current and link.hits >= ALIST_LINK_HOT_HITS:
+            self._fetch_link(file, key)
+        return link.url
+
+    def _fetch_link(self, file: CollectionFile, key: str) -> asyncio.Task[str]:
+        # concurrent lookups of the same file share one /api/fs/get request
+        task = self.link_tasks.get(key)
+        if task is None:
+            task = asyncio.create_task(self._get_link(file, key))
+            task.add_done_callback(lambda task: self._fetch_link_done(key, task))
+            self.link_tasks[key] = task
+        return task
+
+    def _fetch_link_done(self, key: str, task: asyncio.Task[str]):
+        self.link_tasks.pop(key, None)
+        if not task.cancelled() and task.exception() is not None:
+            logger.debug(f"Failed to fetch alist link {key}: {task.exception()!r}")
+
+    async def _get_link(self, file: CollectionFile, key: str) -> str:
+        info = await self.__info_file(file, False)
+        if info.size == -1 or not info.raw_url:
+            self.links.pop(key, None)
+            return ''
+        current = time.time()
+        ttl = self.link_cache_timeout
+        expires = get_link_expires(info.raw_url, info.sign)
+        if expires is not None:
+            ttl = min(ttl, expires - current - ALIST_LINK_EXPIRY_MARGIN)
+        if ttl <= 0:
+            self.links.pop(key, None)
+            return info.raw_url
+        self.links[key] = AlistLink(
+            info.raw_url,
+            time.monotonic() + ttl,
+            time.monotonic() + ttl * ALIST_LINK_REFRESH_RATIO,
+        )
+        logger.tdebug("storage.info.alist.link_cache", url=self.endpoint, path=key, time=units.format_count_datetime(ttl), raw=units.format_datetime_from_timestamp(current + ttl))
+        return info.raw_url
+
+    async def _prune_links(self):
+        # a coroutine runs on the event loop, never while a request inserts into self.links
+        current = time.monotonic()
+        for key in [key for key, link in self.links.items() if link.expires <= current]:
+            self.links.pop(key, None)
     
     async def write_file(self, file: MeasureFile | File, content: io.BytesIO):
         path = str(self.get_path(file))
@@ -255,6 +427,7 @@ class AlistStorage(iNetworkStorage):
         return result.code == 200
     
     async def close(self):
+        scheduler.cancel(self.link_scheduler)
         await self.session.close()
 
     async def delete_file(self, file: MeasureFile | File):
@@ -292,4 +465,30 @@ class AlistStorage(iNetworkStorage):
             info.modified
         )
         return max(0, info.size)
- 
\ No newline at end of file
+
+def get_link_expires(url: str, sign: str = "") -> Optional[float]:
+    # unix time the link stops working, alist signs (xxx:expires) and S3 presigned urls
+    results: list[float] = []
+    query = dict(urlparse.parse_qsl(urlparse.urlparse(url).query))
+    for value in (sign, query.get("sign", "")):
+        if ":" not in value:
+            continue
+        expires = value.rsplit(":", 1)[1]
+        # alist uses 0 for links without expiry
+        if expires.isdigit() and int(expires) > 0:
+            results.append(int(expires))
+    if "X-Amz-Date" in query and query.get("X-Amz-Expires", "").isdigit():
+        try:
+            date = datetime.datetime.strptime(query["X-Amz-Date"], "%Y%m%dT%H%M%SZ").replace(tzinfo=datetime.timezone.utc)
+            results.append(date.timestamp() + int(query["X-Amz-Expires"]))
+        except ValueError:
+            ...
+    elif query.get("Expires", "").isdigit():
+        results.append(int(query["Expires"]))
+    return min(results) if results else None
+
+def get_dir_modified(modified: str) -> float:
+    try:
+        return utils.parse_isotime_to_timestamp(modified)
+    except (ValueError, OverflowError, OSError):
+        return 0
@@ -1,9 +1,13 @@
 import abc
 import collections
 from dataclasses import dataclass
+import enum
 import hashlib
 import io
-from typing import Any, Optional
+from pathlib import Path
+from typing import Any, AsyncIterator, Optional
+
+import aiohttp
 
 from core import cache
 from core.utils import WrapperTQDM
@@ -11,6 +15,7 @@ from core.utils import WrapperTQDM
 
 DOWNLOAD_DIR = "download"
 MEASURE_DIR = "measure"
+NETWORK_STORAGE_CACHE_SIZE = 65536
 
 @dataclass
 class File:
@@ -127,8 +132,22 @@ class FileList:
         return f"FileList({self._data})"
     
 
+class StorageCapability(enum.Flag):
+    NONE = 0
+    # files are on this machine, served with sendfile
+    PATH = enum.auto()
+    # clients can be redirected to get_url
+    URL = enum.auto()
+    # iter_file streams instead of buffering the whole file
+    STREAM = enum.auto()
+    # list_files reports size and mtime of every file
+    BATCH_STAT = enum.auto()
+    # reads can start at an offset
+    RANGE = enum.auto()
+
 class iStorage(metaclass=abc.ABCMeta):
     type: str = "_interface"
+    capabilities: StorageCapability = StorageCapability.NONE
     def __init__(
         self, 
         path: str, 
@@ -139,7 +158,6 @@ class iStorage(metaclass=abc.ABCMeta):
         self.path = FilePath(path)
         self.weight = weight
         self.list_concurrent = list_concurrent
-        self.current_weight = 0
         self._name = name
         self.filelist = FileList()
     
@@ -192,6 +210,25 @@ class iStorage(metaclass=abc.ABCMeta):
         else:
             return self.path / DOWNLOAD_DIR / file.hash[:2] / file.hash
 
+    def get_local_path(self, file: CollectionFile) -> Path:
+        raise NotImplementedError("get_local_path not implemented")
+
+    async def get_url(self, file: CollectionFile) -> str:
+        raise NotImplementedError("get_url not implemented")
+
+    async def iter_file(self, file: CollectionFile, chunk_size: int = 1024 * 256) -> AsyncIterator[bytes]:
+        data = (await self.read_file(file)).getbuffer() # type: ignore
+        for i in range(0, len(data), chunk_size):
+            yield bytes(data[i:i + chunk_size])
+
+    async def read_range(self, file: CollectionFile, start: int = 0, end: Optional[int] = None, chunk_size: int = 1024 * 256) -> AsyncIterator[bytes]:
+        # end is inclusive, storages without RANGE have to skip through the whole file
+        async for chunk in iter_range(self.iter_file(file, chunk_size), start, end):
+            yield chunk
+
+    async def close(self):
+        ...
+
 
 class iNetworkStorage(iStorage):
     def __init__(
@@ -204,12 +241,16 @@ class iNetworkStorage(iStorage):
         list_concurrent: int = 32, 
         name: Optional[str] = None,
         cache_timeout: float = 60,
+        proxy: bool = False
     ):
         super().__init__(path, weight, list_concurrent, name)
         self.username = username
         self.password = password
         self.endpoint = endpoint.rstrip("/")
-        self.cache = cache.TimeoutCache(cache_timeout)
+        self.cache = cache.TimeoutCache(cache_timeout, NETWORK_STORAGE_CACHE_SIZE)
+        if proxy:
+            # serve the body ourselves instead of redirecting to the backend
+            self.capabilities = self.capabilities & ~StorageCapability.URL
 
     @property
     def unique_id(self):
@@ -217,3 +258,30 @@ class iNetworkStorage(iStorage):
     
     def __repr__(self):
         return f"{self.__class__.__name__}(path={self.path}, endpoint={self.endpoint})"
+
+
+def get_range_header(start: int = 0, end: Optional[int] = None) -> dict[str, str]:
+    if start == 0 and end is None:
+        return {}
+    return {
+        "Range": f"bytes={start}-{'' if end is None else end}"
+    }
+
+async def iter_range(content: AsyncIterator[bytes], start: int = 0, end: Optional[int] = None) -> AsyncIterator[bytes]:
+    pos = 0
+    async for chunk in content:
+        chunk_start = pos
+        pos += len(chunk)
+        if pos <= start:
+            continue
+        if end is not None and chunk_start > end:
+            break
+        yield chunk[max(0, start - chunk_start):None if end is None else end - chunk_start + 1]
+
+async def iter_http_range(resp: aiohttp.ClientResponse, start: int = 0, end: Optional[int] = None, chunk_size: int = 1024 * 256) -> AsyncIterator[bytes]:
+    content = resp.content.iter_chunked(chunk_size)
+    if resp.status != 206:
+        # the backend ignored the range header
+        content = iter_range(content, start, end)
+    async for chunk in content:
+        yield chunk
@@ -5,16 +5,17 @@ import hashlib
 import io
 import os
 from pathlib import Path
-from typing import Any, Optional
+from typing import Any, AsyncIterator, Optional
 
 import aiofiles
 
-from .base import DOWNLOAD_DIR, File, iStorage, CollectionFile
+from .base import DOWNLOAD_DIR, File, StorageCapability, iStorage, CollectionFile, Range
 from core.utils import WrapperTQDM
 
 
 class LocalStorage(iStorage):
     type = "local"
+    capabilities = StorageCapability.PATH | StorageCapability.STREAM | StorageCapability.BATCH_STAT | StorageCapability.RANGE
 
     def __init__(self, path: str, weight: int = 0, list_concurrent: int = 32, name: Optional[str] = None):
         super().__init__(path, weight, list_concurrent, name)
@@ -51,7 +52,7 @@ class LocalStorage(iStorage):
             pbar.update(1)
             return results
 
-        return set().union(*await asyncio.gather(*[self._to_coroutine(get_files, root_id) for root_id in os.listdir(str(self.path))]))
+        return set().union(*await asyncio.gather(*[self._to_coroutine(get_files, root_id) for root_id in (f"{root_id:02x}" for root_id in Range())]))
             
     
     async def write_file(self, file: CollectionFile, content: io.BytesIO):
@@ -63,12 +64,32 @@ class LocalStorage(iStorage):
         file_path = Path(str(path))
         async with aiofiles.open(file_path, "wb") as f:
             await f.write(await self._to_coroutine(content.read))
+        return True
 
     async def read_file(self, file: File) -> io.BytesIO:
         path = self.get_path(file)
         with open(Path(str(path)), "rb") as f:
             return io.BytesIO(await self._to_coroutine(f.read))
         
+    async def iter_file(self, file: CollectionFile, chunk_size: int = 1024 * 256) -> AsyncIterator[bytes]:
+        async for chunk in self.read_range(file, chunk_size=chunk_size):
+            yield chunk
+
+    async def read_range(self, file: CollectionFile, start: int = 0, end: Optional[int] = None, chunk_size: int = 1024 * 256) -> AsyncIterator[bytes]:
+        async with aiofiles.open(self.get_local_path(file), "rb") as f:
+            await f.seek(start)
+            remaining = None if end is None else end - start + 1
+            while remaining is None or remaining > 0:
+                chunk = await f.read(chunk_size if remaining is None else min(chunk_size, remaining))
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
+    def get_local_path(self, file: CollectionFile) -> Path:
+        return Path(str(self.get_path(file)))
+
     async def delete_file(self, file: CollectionFile):
         path = self.get_path(file)
         os.remove(Path(str(path)))
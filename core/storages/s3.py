@@ -0,0 +1,462 @@
+import asyncio
+from dataclasses import dataclass
+import datetime
+import hashlib
+import hmac
+import io
+import time
+from typing import Any, AsyncIterable, AsyncIterator, Optional
+import urllib.parse as urlparse
+from xml.etree import ElementTree
+
+import aiohttp
+from yarl import URL
+
+from core import cache, config
+from core import utils
+from core.logger import logger
+from core.utils import WrapperTQDM
+
+from .base import DOWNLOAD_DIR, FileInfo, FilePath, MeasureFile, StorageCapability, get_range_header, iNetworkStorage, iter_http_range, File, CollectionFile, Range
+
+
+S3_ALGORITHM = "AWS4-HMAC-SHA256"
+S3_UNSIGNED_PAYLOAD = "UNSIGNED-PAYLOAD"
+S3_CHUNK_SIZE = 1024 * 256
+# S3 rejects multipart parts smaller than 5 MiB (except the last one)
+S3_MIN_PART_SIZE = 1024 * 1024 * 5
+S3_KEEPALIVE_TIMEOUT = 60
+
+@dataclass
+class S3FileInfo:
+    key: str
+    size: int
+    modified: float
+
+class S3Error(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(f"Status: {status}, Message: {message}")
+        self.status = status
+        self.message = message
+
+class S3Signer:
+    def __init__(
+        self,
+        access_key: str,
+        secret_key: str,
+        region: str,
+        service: str = "s3"
+    ):
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.service = service
+        self._signing_keys: dict[str, bytes] = {}
+
+    def _get_signing_key(self, date: str) -> bytes:
+        if date not in self._signing_keys:
+            key = f"AWS4{self.secret_key}".encode("utf-8")
+            for value in (date, self.region, self.service, "aws4_request"):
+                key = hmac.new(key, value.encode("utf-8"), hashlib.sha256).digest()
+            # the key only depends on the date, keep today's
+            self._signing_keys = {
+                date: key
+            }
+        return self._signing_keys[date]
+
+    def _sign(self, method: str, url: urlparse.ParseResult, query: list[tuple[str, str]], headers: dict[str, str], payload_hash: str, amz_date: str) -> tuple[str, str, str]:
+        date = amz_date[:8]
+        scope = f"{date}/{self.region}/{self.service}/aws4_request"
+        canonical_headers = "".join(
+            f"{key}:{value.strip()}\n" for key, value in sorted(headers.items())
+        )
+        signed_headers = ";".join(sorted(headers))
+        canonical_request = "\n".join((
+            method,
+            url.path or "/",
+            "&".join(
+                f"{key}={value}" for key, value in sorted((quote(key), quote(value)) for key, value in query)
+            ),
+            canonical_headers,
+            signed_headers,
+            payload_hash
+        ))
+        string_to_sign = "\n".join((
+            S3_ALGORITHM,
+            amz_date,
+            scope,
+            hashlib.sha256(canonical_request.encode("utf-8")).hexdigest()
+        ))
+        signature = hmac.new(self._get_signing_key(date), string_to_sign.encode("utf-8"), hashlib.sha256).hexdigest()
+        return scope, signed_headers, signature
+
+    def sign_headers(self, method: str, url: str, query: list[tuple[str, str]] = [], payload_hash: str = S3_UNSIGNED_PAYLOAD) -> dict[str, str]:
+        urlobject = urlparse.urlparse(url)
+        amz_date = get_amz_date()
+        headers = {
+            "host": get_host(urlobject),
+            "x-amz-content-sha256": payload_hash,
+            "x-amz-date": amz_date
+        }
+        scope, signed_headers, signature = self._sign(method, urlobject, query, headers, payload_hash, amz_date)
+        headers["authorization"] = f"{S3_ALGORITHM} Credential={self.access_key}/{scope}, SignedHeaders={signed_headers}, Signature={signature}"
+        return headers
+
+    def presign(self, method: str, url: str, expires: int) -> str:
+        urlobject = urlparse.urlparse(url)
+        amz_date = get_amz_date()
+        query = [
+            ("X-Amz-Algorithm", S3_ALGORITHM),
+            ("X-Amz-Credential", f"{self.access_key}/{amz_date[:8]}/{self.region}/{self.service}/aws4_request"),
+            ("X-Amz-Date", amz_date),
+            ("X-Amz-Expires", str(expires)),
+            ("X-Amz-SignedHeaders", "host"),
+        ]
+        _, _, signature = self._sign(method, urlobject, query, {
+            "host": get_host(urlobject)
+        }, S3_UNSIGNED_PAYLOAD, amz_date)
+        query.append(("X-Amz-Signature", signature))
+        return f"{urlobject.scheme}://{urlobject.netloc}{urlobject.path}?" + "&".join(
+            f"{quote(key)}={quote(value)}" for key, value in query
+        )
+
+class S3Storage(iNetworkStorage):
+    type = "s3"
+    capabilities = StorageCapability.URL | StorageCapability.STREAM | StorageCapability.BATCH_STAT | StorageCapability.RANGE
+
+    def __init__(
+        self,
+        path: str,
+        endpoint: str,
+        access_key: str,
+        secret_key: str,
+        bucket: str,
+        region: str = "us-east-1",
+        weight: int = 0,
+        list_concurrent: int = 32,
+        name: Optional[str] = None,
+        cache_timeout: float = 60,
+        path_style: bool = True,
+        public_endpoint: str = "",
+        custom_host: str = "",
+        presign_expires: int = 3600,
+        part_size: int = 1024 * 1024 * 16,
+        max_connections: int = 64,
+        proxy: bool = False
+    ):
+        super().__init__(path, access_key, secret_key, endpoint, weight, list_concurrent, name, cache_timeout, proxy)
+        self.bucket = bucket
+        self.region = region
+        self.path_style = path_style
+        self.public_endpoint = public_endpoint.rstrip("/")
+        self.custom_host = custom_host.rstrip("/")
+        self.presign_expires = presign_expires
+        self.part_size = max(S3_MIN_PART_SIZE, part_size)
+        self.signer = S3Signer(access_key, secret_key, region)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=max_connections,
+                limit_per_host=max_connections,
+                keepalive_timeout=S3_KEEPALIVE_TIMEOUT,
+                ttl_dns_cache=300,
+            ),
+            headers={
+                "User-Agent": config.USER_AGENT
+            },
+            timeout=aiohttp.ClientTimeout(
+                sock_connect=10,
+                sock_read=60
+            )
+        )
+
+    @property
+    def unique_id(self):
+        return hashlib.md5(f"{self.type},{self.path},{self.endpoint},{self.bucket}".encode("utf-8")).hexdigest()
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(path={self.path}, endpoint={self.endpoint}, bucket={self.bucket})"
+
+    def get_key(self, path: FilePath | str) -> str:
+        return str(path).lstrip("/")
+
+    def _get_url(self, key: str = "", endpoint: Optional[str] = None) -> str:
+        endpoint = endpoint or self.endpoint
+        if self.path_style:
+            return f"{endpoint}/{self.bucket}/{quote(key, '/')}"
+        urlobject = urlparse.urlparse(endpoint)
+        return f"{urlobject.scheme}://{self.bucket}.{urlobject.netloc}{urlobject.path}/{quote(key, '/')}"
+
+    async def _request(
+        self,
+        method: str,
+        key: str = "",
+        query: list[tuple[str, str]] = [],
+        data: Any = None,
+        headers: dict[str, str] = {},
+        missing_ok: bool = False
+    ) -> aiohttp.ClientResponse:
+        url = self._get_url(key)
+        if query:
+            url += "?" + "&".join(f"{quote(k)}={quote(v)}" for k, v in query)
+        resp = await self.session.request(
+            method,
+            URL(url, encoded=True),
+            data=data,
+            headers={
+                **headers,
+                **self.signer.sign_headers(method, url, query)
+            }
+        )
+        if resp.status >= 400 and not (missing_ok and resp.status == 404):
+            message = await resp.text()
+            resp.release()
+            raise S3Error(resp.status, message)
+        return resp
+
+    async def list_files(self, pbar: WrapperTQDM) -> set[File]:
+        @utils.retry(5, 10)
+        async def get_files(root_id: int) -> list[S3FileInfo]:
+            prefix = self.get_key(self.path / DOWNLOAD_DIR / f"{root_id:02x}") + "/"
+            results: list[S3FileInfo] = []
+            token = None
+            while True:
+                query = [
+                    ("list-type", "2"),
+                    ("prefix", prefix),
+                    ("max-keys", "1000"),
+                ]
+                if token is not None:
+                    query.append(("continuation-token", token))
+                async with sem:
+                    async with await self._request("GET", "", query) as resp:
+                        body = await resp.read()
+                root = ElementTree.fromstring(body)
+                for content in find_all(root, "Contents"):
+                    results.append(S3FileInfo(
+                        key=find_text(content, "Key"),
+                        size=int(find_text(content, "Size") or 0),
+                        modified=utils.parse_isotime_to_timestamp(find_text(content, "LastModified")),
+                    ))
+                token = find_text(root, "NextContinuationToken") or None
+                if find_text(root, "IsTruncated") != "true" or token is None:
+                    break
+            return results
+
+        async def get_shard(root_id: int) -> list[S3FileInfo]:
+            try:
+                return await get_files(root_id)
+            except asyncio.CancelledError:
+                raise
+            except:
+                logger.traceback()
+            finally:
+                pbar.update(1)
+            return []
+
+        sem = asyncio.Semaphore(self.list_concurrent)
+        results = set()
+        for root_id, result in zip(
+            Range(),
+            await asyncio.gather(*(
+                get_shard(root_id)
+                for root_id in Range()
+            ))
+        ):
+            for info in result:
+                name = info.key.rsplit("/", 1)[-1]
+                self.filelist[str(self.path / DOWNLOAD_DIR / f"{root_id:02x}" / name)] = FileInfo(
+                    size=info.size,
+                    mtime=info.modified,
+                )
+                results.add(File(
+                    name=name,
+                    hash=name,
+                    size=info.size,
+                    mtime=info.modified,
+                ))
+        return results
+
+    async def _info_file(self, file: CollectionFile) -> S3FileInfo:
+        key = hash(file)
+        res = self.cache.get(key)
+        if res is not cache.EMPTY:
+            return res
+        return await self._fetch_info_file(file)
+
+    @cache.async_cache(0, key=lambda self, file: (self, hash(file)))
+    async def _fetch_info_file(self, file: CollectionFile) -> S3FileInfo:
+        key = hash(file)
+        object_key = self.get_key(self.get_path(file))
+        async with await self._request("HEAD", object_key, missing_ok=True) as resp:
+            if resp.status == 404:
+                return S3FileInfo(object_key, -1, 0)
+            result = S3FileInfo(
+                object_key,
+                int(resp.headers.get("Content-Length", 0)),
+                utils.parse_gmttime_to_timestamp(resp.headers["Last-Modified"]) if "Last-Modified" in resp.headers else 0
+            )
+        self.cache.set(key, result, 60)
+        return result
+
+    async def get_mtime(self, file: MeasureFile | File) -> float:
+        path = str(self.get_path(file))
+        if path in self.filelist:
+            return self.filelist[path].mtime
+        info = await self._info_file(file)
+        if info.size >= 0:
+            self.filelist[path] = FileInfo(
+                size=info.size,
+                mtime=info.modified,
+            )
+        return info.modified
+
+    async def get_size(self, file: MeasureFile | File) -> int:
+        path = str(self.get_path(file))
+        if path in self.filelist:
+            return self.filelist[path].size
+        info = await self._info_file(file)
+        if info.size >= 0:
+            self.filelist[path] = FileInfo(
+                size=info.size,
+                mtime=info.modified,
+            )
+        return max(0, info.size)
+
+    async def exists(self, file: MeasureFile | File) -> bool:
+        path = str(self.get_path(file))
+        return path in self.filelist
+
+    async def delete_file(self, file: MeasureFile | File):
+        path = self.get_path(file)
+        async with await self._request("DELETE", self.get_key(path), missing_ok=True):
+            ...
+        if str(path) in self.filelist:
+            del self.filelist[str(path)]
+        self.cache.delete(hash(file))
+        return True
+
+    async def read_file(self, file: File) -> io.BytesIO:
+        data = io.BytesIO()
+        async for chunk in self.iter_file(file):
+            data.write(chunk)
+        return data
+
+    async def iter_file(self, file: CollectionFile, chunk_size: int = S3_CHUNK_SIZE) -> AsyncIterator[bytes]:
+        async for chunk in self.read_range(file, chunk_size=chunk_size):
+            yield chunk
+
+    async def read_range(self, file: CollectionFile, start: int = 0, end: Optional[int] = None, chunk_size: int = S3_CHUNK_SIZE) -> AsyncIterator[bytes]:
+        async with await self._request("GET", self.get_key(self.get_path(file)), headers=get_range_header(start, end), missing_ok=True) as resp:
+            if resp.status == 404:
+                return
+            async for chunk in iter_http_range(resp, start, end, chunk_size):
+                yield chunk
+
+    async def get_url(self, file: CollectionFile) -> str:
+        key = self.get_key(self.get_path(file))
+        if self.custom_host:
+            return f"{self.custom_host}/{quote(key, '/')}"
+        return self.signer.presign(
+            "GET",
+            self._get_url(key, self.public_endpoint or None),
+            self.presign_expires
+        )
+
+    async def write_file(self, file: MeasureFile | File, content: io.BytesIO | AsyncIterable[bytes]):
+        path = self.get_path(file)
+        key = self.get_key(path)
+        try:
+            if isinstance(content, io.BytesIO) and content.getbuffer().nbytes <= self.part_size:
+                size = content.getbuffer().nbytes
+                async with await self._request("PUT", key, data=content.getvalue()):
+                    ...
+            else:
+                size = await self._write_multipart(key, content)
+        except asyncio.CancelledError:
+            raise
+        except:
+            logger.traceback()
+            return False
+        self.filelist[str(path)] = FileInfo(
+            size=size,
+            mtime=time.time(),
+        )
+        self.cache.delete(hash(file))
+        return True
+
+    async def _write_multipart(self, key: str, content: io.BytesIO | AsyncIterable[bytes]) -> int:
+        async with await self._request("POST", key, [("uploads", "")]) as resp:
+            upload_id = find_text(ElementTree.fromstring(await resp.read()), "UploadId")
+        parts: list[tuple[int, str]] = []
+        size = 0
+        try:
+            async for part in iter_parts(content, self.part_size):
+                async with await self._request("PUT", key, [
+                    ("partNumber", str(len(parts) + 1)),
+                    ("uploadId", upload_id)
+                ], data=part) as resp:
+                    parts.append((len(parts) + 1, resp.headers["ETag"]))
+                size += len(part)
+            body = "".join((
+                "<CompleteMultipartUpload>",
+                *(f"<Part><PartNumber>{number}</PartNumber><ETag>{etag}</ETag></Part>" for number, etag in parts),
+                "</CompleteMultipartUpload>"
+            ))
+            async with await self._request("POST", key, [("uploadId", upload_id)], data=body.encode("utf-8")) as resp:
+                # the request can fail after the 200 status was sent
+                result = await resp.read()
+                if b"<Error>" in result:
+                    raise S3Error(resp.status, result.decode("utf-8", "ignore"))
+        except:
+            try:
+                async with await self._request("DELETE", key, [("uploadId", upload_id)]):
+                    ...
+            except:
+                logger.traceback()
+            raise
+        return size
+
+    async def close(self):
+        await self.session.close()
+
+
+def quote(value: str, safe: str = "") -> str:
+    return urlparse.quote(value, safe=f"-_.~{safe}")
+
+def get_amz_date() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+
+def get_host(url: urlparse.ParseResult) -> str:
+    host = url.hostname or ""
+    if ":" in host:
+        host = f"[{host}]"
+    if url.port is not None and (url.scheme, url.port) not in (("http", 80), ("https", 443)):
+        host = f"{host}:{url.port}"
+    return host
+
+def find_all(element: ElementTree.Element, tag: str) -> list[ElementTree.Element]:
+    # responses are namespaced (or not, depending on the server)
+    return [child for child in element if child.tag.rsplit("}", 1)[-1] == tag]
+
+def find_text(element: ElementTree.Element, tag: str) -> str:
+    for child in find_all(element, tag):
+        return child.text or ""
+    return ""
+
+async def iter_parts(content: io.BytesIO | AsyncIterable[bytes], part_size: int) -> AsyncIterator[bytes]:
+    if isinstance(content, io.BytesIO):
+        buffer = content.getbuffer()
+        for offset in range(0, buffer.nbytes, part_size):
+            yield bytes(buffer[offset:offset + part_size])
+        return
+    part = bytearray()
+    parts = 0
+    async for chunk in content:
+        part.extend(chunk)
+        while len(part) >= part_size:
+            yield bytes(part[:part_size])
+            del part[:part_size]
+            parts += 1
+    # an upload needs at least one (possibly empty) part
+    if part or parts == 0:
+        yield bytes(part)
@@ -2,7 +2,7 @@ import asyncio
 from dataclasses import dataclass, field
 import io
 import time
-from typing import Any, Optional
+from typing import Any, AsyncIterable, AsyncIterator, Optional
 import urllib.parse as urlparse
 
 import aiohttp
@@ -12,11 +12,14 @@ from core import utils
 from core.logger import logger
 from core.utils import WrapperTQDM
 
-from .base import DOWNLOAD_DIR, FileInfo, MeasureFile, iNetworkStorage, File, CollectionFile, Range
+from .base import DOWNLOAD_DIR, FileInfo, FilePath, MeasureFile, StorageCapability, get_range_header, iNetworkStorage, iter_http_range, File, CollectionFile, Range
 
 import aiowebdav.client as webdav3_client
 import aiowebdav.exceptions as webdav3_exceptions
 
+WEBDAV_CHUNK_SIZE = 1024 * 256
+WEBDAV_KEEPALIVE_TIMEOUT = 60
+
 @dataclass
 class WebDavFileInfo:
     created: float
@@ -46,6 +49,7 @@ class WebDavFile:
 
 class WebDavStorage(iNetworkStorage):
     type = "webdav"
+    capabilities = StorageCapability.URL | StorageCapability.STREAM | StorageCapability.BATCH_STAT | StorageCapability.RANGE
     def __init__(
         self, 
         path: str, 
@@ -57,23 +61,41 @@ class WebDavStorage(iNetworkStorage):
         name: Optional[str] = None, 
         cache_timeout: int = 60,
         public_endpoint: str = "", 
-        retries: int = 3
+        retries: int = 3,
+        max_connections: int = 64,
+        proxy: bool = False
     ):
-        super().__init__(path, username, password, endpoint, weight, list_concurrent, name, cache_timeout)
-        self.client = webdav3_client.Client({
-            "webdav_hostname": endpoint,
-            "webdav_login": username,
-            "webdav_password": password,
-            "User-Agent": config.USER_AGENT
-        })
+        super().__init__(path, username, password, endpoint, weight, list_concurrent, name, cache_timeout, proxy)
         self.public_endpoint = public_endpoint
         self.client_lock = asyncio.Lock()
+        # one keep-alive pool for every webdav request (PROPFIND, MKCOL, PUT, GET, DELETE)
         self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=max_connections,
+                limit_per_host=max_connections,
+                keepalive_timeout=WEBDAV_KEEPALIVE_TIMEOUT,
+                ttl_dns_cache=300,
+            ),
             auth=aiohttp.BasicAuth(username, password),
             headers={
                 "User-Agent": config.USER_AGENT
-            }
+            },
+            timeout=aiohttp.ClientTimeout(
+                sock_connect=10,
+                sock_read=60
+            )
         )
+        self.client = webdav3_client.Client({
+            "webdav_hostname": endpoint,
+            "webdav_login": username,
+            "webdav_password": password,
+            "webdav_disable_check": True,
+            "User-Agent": config.USER_AGENT
+        })
+        # aiowebdav only parses PROPFIND for us, its requests go through our pool
+        self._client_session = self.client.session
+        self.client.session = self.session
+        self.dirs: set[str] = set()
         urlobject = urlparse.urlparse(f"{self.public_endpoint or self.endpoint}")
         self.base_url = f"{urlobject.scheme}://{urlparse.quote(self.username)}:{urlparse.quote(self.password)}@{urlobject.hostname}:{urlobject.port}{urlobject.path}"
         self.retries = retries
@@ -90,6 +112,7 @@ class WebDavStorage(iNetworkStorage):
                             str(root),
                             True
                         )
+                    self._add_dirs(root)
                     return [WebDavFileInfo(
                         created=utils.parse_isotime_to_timestamp(r["created"]),
                         modified=utils.parse_gmttime_to_timestamp(r["modified"]),
@@ -134,6 +157,11 @@ class WebDavStorage(iNetworkStorage):
         res = self.cache.get(key)
         if res is not cache.EMPTY:
             return res
+        return await self._fetch_info_file(file)
+
+    @cache.async_cache(0, key=lambda self, file: (self, hash(file)))
+    async def _fetch_info_file(self, file: CollectionFile) -> WebDavFileInfo:
+        key = hash(file)
         try:
             res = await self.client.info(str(self.get_path(file)))
         except:
@@ -179,24 +207,68 @@ class WebDavStorage(iNetworkStorage):
         return path in self.filelist
     
     async def delete_file(self, file: MeasureFile | File):
-        await self.client.unpublish(str(self.get_path(file)))
+        path = self.get_path(file)
+        async with self.session.delete(
+            self._get_url(path)
+        ) as resp:
+            if resp.status not in (200, 204, 404):
+                resp.raise_for_status()
+        if str(path) in self.filelist:
+            del self.filelist[str(path)]
+        self.cache.delete(hash(file))
         return True
     
     async def read_file(self, file: File) -> io.BytesIO:
         data = io.BytesIO()
-        if (await self._info_file(file)).size == -1:
-            return data
-        await self.client.download_from(data, str(self.get_path(file)))
+        try:
+            async for chunk in self.iter_file(file):
+                data.write(chunk)
+        except webdav3_exceptions.RemoteResourceNotFound:
+            return io.BytesIO()
         return data
+
+    async def iter_file(self, file: CollectionFile, chunk_size: int = WEBDAV_CHUNK_SIZE) -> AsyncIterator[bytes]:
+        async for chunk in self.read_range(file, chunk_size=chunk_size):
+            yield chunk
+
+    async def read_range(self, file: CollectionFile, start: int = 0, end: Optional[int] = None, chunk_size: int = WEBDAV_CHUNK_SIZE) -> AsyncIterator[bytes]:
+        path = self.get_path(file)
+        async with self.session.get(
+            self._get_url(path),
+            headers=get_range_header(start, end)
+        ) as resp:
+            if resp.status == 404:
+                raise webdav3_exceptions.RemoteResourceNotFound(str(path))
+            resp.raise_for_status()
+            async for chunk in iter_http_range(resp, start, end, chunk_size):
+                yield chunk
+
+    def _get_url(self, path: FilePath | str) -> str:
+        path = str(path)
+        if not path.startswith("/"):
+            path = f"/{path}"
+        return f"{self.endpoint}{urlparse.quote(path)}"
+
+    def _add_dirs(self, dir: FilePath):
+        for parent in (*dir.parents, dir):
+            if parent.path:
+                self.dirs.add(parent.path)
     
-    async def _mkdir(self, dir: str):
+    async def _mkdir(self, dir: FilePath):
+        if dir.path in self.dirs:
+            return
         async with self.client_lock:
-            d = ""
-            for x in dir.split("/"):
-                d += x
-                if d:
-                    await self.client.mkdir(d)
-                d += "/"
+            for parent in (*dir.parents, dir):
+                if not parent.path or parent.path in self.dirs:
+                    continue
+                async with self.session.request(
+                    "MKCOL",
+                    self._get_url(parent) + "/"
+                ) as resp:
+                    # 405: the collection already exists
+                    if resp.status not in (200, 201, 405):
+                        resp.raise_for_status()
+                self.dirs.add(parent.path)
     
     async def get_file(self, file: CollectionFile) -> WebDavFile:
         # by old code
@@ -210,21 +282,46 @@ class WebDavStorage(iNetworkStorage):
         url = f"{self.base_url}{self.get_path(file)}"
         f.url = url
         return f
+
+    async def get_url(self, file: CollectionFile) -> str:
+        return (await self.get_file(file)).url or ""
     
-    async def write_file(self, file: MeasureFile | File, content: io.BytesIO):
+    async def write_file(self, file: MeasureFile | File, content: io.BytesIO | AsyncIterable[bytes]):
         path = self.get_path(file)
-        await self._mkdir(str(path.parent))
+        size = 0
+        async def counter(content: AsyncIterable[bytes]):
+            nonlocal size
+            async for chunk in content:
+                size += len(chunk)
+                yield chunk
+        if isinstance(content, io.BytesIO):
+            content.seek(0)
+            size = content.getbuffer().nbytes
+            data = content
+        else:
+            data = counter(content)
         try:
-            await self.client.upload_to(
-                content,
-                str(path),
-            )
+            await self._mkdir(path.parent)
+            async with self.session.put(
+                self._get_url(path),
+                data=data
+            ) as resp:
+                if resp.status == 409:
+                    # the parent collection was removed behind our back
+                    self.dirs.discard(path.parent.path)
+                resp.raise_for_status()
+        except asyncio.CancelledError:
+            raise
         except:
             logger.traceback()
             return False
         self.filelist[str(path)] = FileInfo(
-            size=file.size,
+            size=size,
             mtime=time.time(),
         )
+        self.cache.delete(hash(file))
         return True
-    
\ No newline at end of file
+
+    async def close(self):
+        await self._client_session.close()
+        await self.session.close()
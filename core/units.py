@@ -42,6 +42,19 @@ def format_bytes(n: float) -> str:
         i += 1
     return f'{n:.2f}{BYTES_UNITS[i][0]}'
 
+def parse_bytes(value: int | float | str) -> int:
+    if isinstance(value, (int, float)):
+        return int(value)
+    value = value.strip()
+    number = value.rstrip("BbIiKkMmGgTtPpEeZzYy ")
+    unit = value[len(number):].strip().upper().removesuffix("B").removesuffix("I")
+    n = float(number)
+    for u, un in BYTES_UNITS[1:]:
+        n *= un
+        if u[0] == unit:
+            return int(n)
+    return int(float(number))
+
 def format_number(n: float) -> str:
     i = 0
     for u, un in NUMBER_UNITS[1:]:
@@ -401,11 +401,15 @@ def check_sign_without_time(hash: str, secret: str, s: str, e: str):
 def equals_hash(origin: str, content: bytes):
     return get_hash_hexdigest(origin, content) == origin
 
-def get_hash_hexdigest(origin: str, content: bytes):
-    h = hashlib.sha1
+def get_hash_obj(origin: str):
     if len(origin) == 32:
-        h = hashlib.md5
-    return h(content).hexdigest()
+        return hashlib.md5()
+    return hashlib.sha1()
+
+def get_hash_hexdigest(origin: str, content: bytes):
+    h = get_hash_obj(origin)
+    h.update(content)
+    return h.hexdigest()
 
 def pause():
     try:
@@ -10,7 +10,7 @@ import time
 from typing import Any, Optional, Callable
 from aiohttp import web
 from aiohttp.web_urldispatcher import SystemRoute
-from core import config, scheduler, units, utils
+from core import config, metrics, scheduler, units, utils
 from .logger import logger
 
 from cryptography import x509
@@ -105,6 +105,7 @@ async def middleware(request: web.Request, handler: Any) -> web.Response:
             if request.http_range.start is not None and status == 200:
                 status = 206
             end = time.perf_counter_ns()
+            metrics.HTTP_REQUEST_DURATION.observe((end - start) / 1e9, (str(status),))
             logger.tdebug("web.debug.request_info", time=units.format_count_time(end - start, 4).rjust(16), host=request.host, address=(address).rjust(16), user_agent=request.headers.get("User-Agent"), real_path=request.raw_path, method=request.method.ljust(9), status=status)
     finally:
         request.match_info.current_app = old_app
@@ -0,0 +1,13 @@
+import os
+from pathlib import Path
+import shutil
+import sys
+import tempfile
+
+# core reads its assets and i18n and writes its config, logs and database relative to the working directory
+ROOT = Path(__file__).resolve().parent.parent
+WORKDIR = Path(tempfile.mkdtemp(prefix="openbmclapi-tests-"))
+for directory in ("assets", "i18n"):
+    shutil.copytree(ROOT / directory, WORKDIR / directory)
+sys.path.insert(0, str(ROOT))
+os.chdir(WORKDIR)
@@ -0,0 +1,165 @@
+import asyncio
+from collections import defaultdict
+import time
+
+import pytest
+
+from core import cluster, config, database as db, scheduler, storages
+from core.journal import Journal
+
+HOUR = 480000
+HASH = "0" * 40
+ADDRESS = "203.0.113.7"
+USER_AGENT = "openbmclapi-test"
+
+
+@pytest.fixture(autouse=True)
+def isolate(tmp_path, monkeypatch):
+    # open() schedules a periodic flush, the tests flush by hand
+    monkeypatch.setattr(scheduler, "run_repeat_later", lambda *args, **kwargs: None)
+    monkeypatch.setattr(db.JOURNAL, "path", tmp_path / "database")
+    monkeypatch.setattr(db.JOURNAL, "enabled", True)
+    monkeypatch.setattr(db.JOURNAL, "segment", 0)
+    monkeypatch.setattr(db.JOURNAL, "buffer", [])
+    monkeypatch.setattr(db, "get_hour", lambda: HOUR)
+    restart_database(monkeypatch)
+
+def restart_database(monkeypatch):
+    # everything that lives only in memory is gone after a crash
+    monkeypatch.setattr(db, "FILE_CACHE", defaultdict(lambda: db.FileStatistics()))
+    monkeypatch.setattr(db, "RESPONSE_CACHE", defaultdict(lambda: db.ResponseStatistics()))
+    monkeypatch.setattr(db, "HASH_CACHE", defaultdict(lambda: db.HashStatistics()))
+    monkeypatch.setattr(db, "JOURNAL_FILE_CACHE", defaultdict(lambda: db.FileStatistics()))
+    monkeypatch.setattr(db, "JOURNAL_RESPONSE_CACHE", defaultdict(lambda: db.ResponseStatistics()))
+    monkeypatch.setattr(db, "JOURNAL_HASH_CACHE", defaultdict(lambda: db.HashStatistics()))
+    monkeypatch.setattr(db.JOURNAL, "buffer", [])
+
+def tear(journal: Journal):
+    # a crash in the middle of a write leaves half a record behind
+    with open(journal._file(journal.segment), "a", encoding="utf-8") as f:
+        f.write('["f",1,"clus')
+
+def set_store_addresses(monkeypatch, value: bool):
+    monkeypatch.setattr(config.Const, "database_store_addresses", property(lambda self: value))
+
+def record_database():
+    for _ in range(2):
+        db.add_file("cluster", "storage", 100)
+        db.add_response(ADDRESS, db.StatusType.SUCCESS, USER_AGENT)
+    db.add_hash(HASH, 100, True)
+    db.add_hash(HASH, 100, False)
+
+def assert_database_replayed():
+    assert db.FILE_CACHE[db.FileStatisticsKey(HOUR, "cluster", "storage")] == db.FileStatistics(2, 200)
+    response = db.RESPONSE_CACHE[HOUR]
+    assert response.success == 2
+    assert response.user_agents[USER_AGENT] == 2
+    assert response.addresses.count() == 1
+    hashes = db.HASH_CACHE[HOUR]
+    assert hashes.hits[HASH] == 2
+    assert hashes.bytes[HASH] == 200
+    assert hashes.cache_hits[HASH] == 1
+
+def test_database_replay_and_truncate(monkeypatch):
+    set_store_addresses(monkeypatch, True)
+    committed = []
+    def fail(*caches):
+        raise RuntimeError("database is gone")
+    def succeed(*caches):
+        committed.append(caches)
+
+    async def main():
+        record_database()
+        await db.JOURNAL.flush()
+        tear(db.JOURNAL)
+
+        restart_database(monkeypatch)
+        db.replay()
+        assert_database_replayed()
+        assert db.RESPONSE_CACHE[HOUR].ip_tables[ADDRESS] == 2
+
+        # a failed commit restores the counters and keeps the segments that hold them
+        monkeypatch.setattr(db, "_commit", fail)
+        await db.commit()
+        assert db.JOURNAL.segments() == [0]
+        assert_database_replayed()
+
+        monkeypatch.setattr(db, "_commit", succeed)
+        await db.commit()
+        assert db.JOURNAL.segments() == []
+        files, responses, hashes = committed[0]
+        assert files[db.FileStatisticsKey(HOUR, "cluster", "storage")] == db.FileStatistics(2, 200)
+        assert responses[HOUR].success == 2
+        assert hashes[HOUR].hits[HASH] == 2
+
+        # nothing left to replay once committed
+        restart_database(monkeypatch)
+        db.replay()
+        assert not db.FILE_CACHE and not db.RESPONSE_CACHE and not db.HASH_CACHE
+
+    asyncio.run(main())
+
+def test_database_journal_is_aggregated(monkeypatch):
+    set_store_addresses(monkeypatch, False)
+
+    async def main():
+        record_database()
+        await db.JOURNAL.flush()
+        with open(db.JOURNAL._file(0), "r", encoding="utf-8") as f:
+            content = f.read()
+        # one record per key, and no raw address when addresses are not stored
+        assert len(content.splitlines()) == 3
+        assert ADDRESS not in content
+
+        restart_database(monkeypatch)
+        db.replay()
+        assert_database_replayed()
+        assert db.RESPONSE_CACHE[HOUR].ip_tables[ADDRESS] == 0
+
+    asyncio.run(main())
+
+def test_keepalive_replay_and_truncate(tmp_path, monkeypatch):
+    storage = storages.LocalStorage(str(tmp_path / "storage"))
+    unique_storages = {storage.unique_id: storage}
+    emitted = []
+    results = [None, cluster.SocketIOEmitResult(None, int(time.time() * 1000))]
+
+    def start_cluster():
+        instance = cluster.Cluster("cluster", "secret")
+        instance.journal.path = tmp_path / "keepalive"
+        instance.journal.enabled = True
+        async def emit(event, data=None, timeout=None):
+            emitted.append(data)
+            return results.pop(0)
+        monkeypatch.setattr(instance.socket_io, "emit", emit)
+        return instance
+
+    async def main():
+        instance = start_cluster()
+        instance.hit(storage, 100)
+        instance.hit(storage, 100)
+        instance.hit(None, 50)
+        await instance.journal.flush()
+        tear(instance.journal)
+
+        instance = start_cluster()
+        instance.replay_counter(unique_storages)
+        assert instance.counter[storage] == cluster.ClusterCounter(2, 200)
+        assert instance.no_storage_counter == cluster.ClusterCounter(1, 50)
+
+        # no ack, the counters and their segments wait for the next keep-alive
+        await instance.keepalive()
+        assert instance.journal.segments() == [0]
+        assert instance.counter[storage] == cluster.ClusterCounter(2, 200)
+
+        await instance.keepalive()
+        assert emitted[-1]["hits"] == 3 and emitted[-1]["bytes"] == 250
+        assert instance.journal.segments() == []
+        assert instance.counter[storage] == cluster.ClusterCounter(0, 0)
+        assert instance.no_storage_counter == cluster.ClusterCounter(0, 0)
+
+        instance = start_cluster()
+        instance.replay_counter(unique_storages)
+        assert not instance.counter and instance.no_storage_counter == cluster.ClusterCounter(0, 0)
+
+    asyncio.run(main())